@@ -0,0 +1,86 @@
+#include <BrakeProfile.h>
+
+BrakeProfile::BrakeProfile()
+{
+    clear();
+}
+
+void BrakeProfile::clear() {
+    length = 0;
+    stop();
+}
+
+bool BrakeProfile::append(uint16_t offset, uint16_t setpoint) {
+    if (length >= BRAKE_PROFILE_MAX_STEPS) {
+        return false;
+    }
+    offsets[length] = offset;
+    setpoints[length] = setpoint;
+    length++;
+    return true;
+}
+
+bool BrakeProfile::appendHex(String steps) {
+    if (steps.length() % 8 != 0) {
+        return false;
+    }
+    char word[5];
+    word[4] = '\0';
+    for (unsigned int index = 0; index < steps.length(); index += 8) {
+        steps.substring(index, index + 4).toCharArray(word, 5);
+        uint16_t offset = (uint16_t)strtoul(word, NULL, 16);
+        steps.substring(index + 4, index + 8).toCharArray(word, 5);
+        uint16_t setpoint = (uint16_t)strtoul(word, NULL, 16);
+        if (!append(offset, setpoint)) {
+            return false;
+        }
+    }
+    return true;
+}
+
+void BrakeProfile::start() {
+    running = length > 0;
+    nextStep = 0;
+    edgeTime = 0;
+    startTime = millis();
+}
+
+void BrakeProfile::stop() {
+    running = false;
+    nextStep = 0;
+}
+
+bool BrakeProfile::isRunning() {
+    return running;
+}
+
+int BrakeProfile::update() {
+    if (!running) {
+        return -1;
+    }
+
+    uint32_t elapsed = millis() - startTime;
+    if (elapsed < (uint32_t)offsets[nextStep] * BRAKE_PROFILE_TIME_UNIT_MS) {
+        return -1;
+    }
+
+    int step = nextStep;
+    edgeTime = elapsed;
+    nextStep++;
+    if (nextStep >= length) {
+        running = false;  // the last set point holds until the next command
+    }
+    return step;
+}
+
+int BrakeProfile::getLength() {
+    return length;
+}
+
+double BrakeProfile::getSetPoint_mA(int index) {
+    return setpoints[index] * BRAKE_PROFILE_CURRENT_UNIT_MA;
+}
+
+uint32_t BrakeProfile::getEdgeTime_ms() {
+    return edgeTime;
+}
@@ -0,0 +1,39 @@
+#include <Arduino.h>
+
+// Table of brake set points played back on the controller's own clock.
+// Steps are stored as uint16s to fit in the Uno's RAM:
+//     offset from profile start in 10ms units, set point in 0.01mA units
+#define BRAKE_PROFILE_MAX_STEPS 128
+#define BRAKE_PROFILE_TIME_UNIT_MS 10
+#define BRAKE_PROFILE_CURRENT_UNIT_MA 0.01
+
+class BrakeProfile
+{
+    public:
+        BrakeProfile();
+
+        void clear();
+        bool append(uint16_t offset, uint16_t setpoint);
+        bool appendHex(String steps);  // 8 hex characters per step: 4 for the offset, 4 for the set point
+
+        void start();
+        void stop();
+        bool isRunning();
+
+        // returns the index of the step that's due, -1 if none is
+        int update();
+
+        int getLength();
+        double getSetPoint_mA(int index);
+        uint32_t getEdgeTime_ms();
+
+    private:
+        uint16_t offsets[BRAKE_PROFILE_MAX_STEPS];
+        uint16_t setpoints[BRAKE_PROFILE_MAX_STEPS];
+        int length;
+
+        bool running;
+        int nextStep;
+        uint32_t startTime;
+        uint32_t edgeTime;  // ms since start that the last step was applied
+};
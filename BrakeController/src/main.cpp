@@ -2,17 +2,20 @@
 #include <Wire.h>
 #include <Adafruit_INA219.h>
 #include <ParticleBrake.h>
+#include <BrakeProfile.h>
 #include "ArduinoFactoryBridge.h"
 
 #define CURRENT_CONTROL_PIN 6
 
 Adafruit_INA219 ina219;
 ParticleBrake brake(&ina219, CURRENT_CONTROL_PIN);
+BrakeProfile profile;
 
 ArduinoFactoryBridge bridge("brake_controller");
 
 uint32_t prev_time;
 uint32_t current_time;
+int profile_step;
 
 double setpoint;
 double read_pid_constant;
@@ -47,6 +50,12 @@ void setup(void)
 void loop(void)
 {
     if (!bridge.isPaused()) {
+        profile_step = profile.update();
+        if (profile_step >= 0) {
+            brake.set(profile.getSetPoint_mA(profile_step));
+            bridge.write("edge", "dff", profile_step, (double)profile.getEdgeTime_ms(), profile.getSetPoint_mA(profile_step));
+        }
+
         brake.update();
         current_time = millis();
         if ((current_time - prev_time) > 100) {
@@ -70,6 +79,7 @@ void loop(void)
             case 0:  // command
                 switch (command.charAt(0)) {
                     case 'b':
+                        profile.stop();  // a direct command overrides the profile
                         setpoint = command.substring(1).toDouble();
                         brake.set(setpoint);
                         break;
@@ -81,12 +91,24 @@ void loop(void)
                             case 'i': brake.Ki = read_pid_constant; break;
                             case 'd': brake.Kd = read_pid_constant; break;
                         }
+                        break;
+
+                    case 'p':
+                        switch (command.charAt(1)) {
+                            case 'c': profile.clear(); break;
+                            case 'a': profile.appendHex(command.substring(2)); break;
+                            case 's': profile.start(); break;
+                            case 'x': profile.stop(); break;
+                        }
+                        break;
                 }
                 break;
             case 1:  // start
+                profile.stop();
                 brake.reset();
                 break;
             case 2:  // stop
+                profile.stop();
                 brake.reset();
                 break;
         }
@@ -1,17 +1,25 @@
+import os
 import time
 import math
+import asyncio
 import numpy as np
 from atlasbuggy import Orchestrator, Node, run
 
-from data_processing.experiment_helpers.plot_helpers import *
+from data_processing.experiment_helpers.plot_helpers import new_fig, save_fig
 from data_processing.experiment_helpers.k_calculator_helpers import *
+from data_processing.experiment_helpers.k_pipeline import analyze_session
+from data_processing.experiment_helpers.abs_encoder_calibration import format_estimate
+from data_processing.experiment_helpers.frequency_response import session_frequency_response, format_response
 from data_processing.hardware_playback import *
 from data_processing.torque_table import TorqueTable
+from data_processing.stage_cache import StageCache
+from data_processing.clock_alignment import align_streams
 
 
 class DataAggregator(Node):
     def __init__(self, torque_table_path, filename, directory, conical_annulus_size, save_figures=True, enabled=True,
-                 enable_smoothing=False, use_abs_encoders=False, abs_encoder_fixed_diff=0.0):
+                 enable_smoothing=False, use_abs_encoders=False, abs_encoder_fixed_diff=None, show_figures=True,
+                 stage_cache=None, align_clocks=False, motor_load_index=0):
         super(DataAggregator, self).__init__(enabled)
 
         self.torque_table = TorqueTable(torque_table_path)
@@ -19,9 +27,18 @@ class DataAggregator(Node):
         self.log_directory = directory
         self.conical_annulus_size = conical_annulus_size
         self.save_figures = save_figures
+        self.show_figures = show_figures
         self.enable_smoothing = enable_smoothing
         self.use_abs_encoders = use_abs_encoders
+        # None estimates it from the session's unloaded samples
         self.abs_encoder_fixed_diff = abs_encoder_fixed_diff
+        # fit each arduino's clock against every packet's receive time instead of anchoring on the first packet
+        self.align_clocks = align_clocks
+
+        # re-running with one setting changed only recomputes the analysis stages after that setting
+        if stage_cache is None:
+            stage_cache = StageCache()
+        self.stage_cache = stage_cache
 
         self.brake_tag = "brake"
         self.brake_sub = self.define_subscription(self.brake_tag, message_type=packet.Packet,
@@ -41,6 +58,13 @@ class DataAggregator(Node):
         self.experiment_stop_time = 0.0
         self.motor_direction_switch_time = 0.0
 
+        # read back from the SMC, columns in the order of the bridge's telemetry_variables
+        # (hardware/smc_telemetry.py). motor_load_index picks the one compared against the deflection.
+        # speed by default, current_mA on controllers that measure it
+        self.motor_telemetry_timestamps = []
+        self.motor_telemetry = []
+        self.motor_load_index = motor_load_index
+
         self.experiment_tag = "experiment"
         self.experiment_sub = self.define_subscription(self.experiment_tag, message_type=tuple,
                                                        callback=self.experiment_callback)
@@ -48,12 +72,16 @@ class DataAggregator(Node):
 
         self.brake_start_time = 0.0
         self.brake_timestamps = []
+        self.brake_device_timestamps = []
+        self.brake_receive_times = []
         self.brake_current = []
 
         self.exit_event = asyncio.Event()
 
         self.encoder_start_time = 0.0
         self.encoder_timestamps = []
+        self.encoder_device_timestamps = []
+        self.encoder_receive_times = []
         self.abs_encoder_1_ticks = []
         self.abs_encoder_2_ticks = []
         self.diff_encoder_1_ticks = []
@@ -77,6 +105,8 @@ class DataAggregator(Node):
             self.brake_start_time = message.receive_time
             print("brake start time: %s" % self.brake_start_time)
         self.brake_timestamps.append(message.timestamp + self.brake_start_time)
+        self.brake_device_timestamps.append(message.timestamp)
+        self.brake_receive_times.append(message.receive_time)
         self.brake_current.append(message.data[2])
 
     def encoders_callback(self, message):
@@ -85,6 +115,8 @@ class DataAggregator(Node):
             self.encoder_start_time = message.receive_time - message.timestamp
             print("encoder start time: %s" % self.encoder_start_time)
         self.encoder_timestamps.append(message.timestamp + self.encoder_start_time)
+        self.encoder_device_timestamps.append(message.timestamp)
+        self.encoder_receive_times.append(message.receive_time)
         self.abs_encoder_1_ticks.append(message.data[2])
         self.abs_encoder_2_ticks.append(message.data[3])
         self.diff_encoder_1_ticks.append(message.data[4])
@@ -99,6 +131,9 @@ class DataAggregator(Node):
         elif message[0] == "command":
             if message[1] > 0 and self.motor_direction_switch_time == 0.0:
                 self.motor_direction_switch_time = message[2]
+        elif message[0] == "telemetry":
+            self.motor_telemetry_timestamps.append(message[1].receive_time)
+            self.motor_telemetry.append(message[1].data)
 
     def experiment_callback(self, message):
         pass
@@ -110,59 +145,84 @@ class DataAggregator(Node):
         else:
             return False
 
-    async def teardown(self):
-        formatted_abs_enc_1_ticks = format_abs_enc_ticks(self.abs_encoder_1_ticks, abs_ticks_per_rotation, 0.0)
-        formatted_abs_enc_2_ticks = format_abs_enc_ticks(self.abs_encoder_2_ticks, abs_ticks_per_rotation, self.abs_encoder_fixed_diff)
+    def motor_load_vs_deflection(self, encoder_timestamps, encoder_delta, session_epoch):
+        """Motor telemetry next to the deflection at the same time. Returns (timestamps, load, deflection)
+        rebased like the analysis, or None if the session has no telemetry"""
+        if len(self.motor_telemetry) == 0:
+            return None
+        timestamps = np.array(self.motor_telemetry_timestamps) - session_epoch
+        load = np.array(self.motor_telemetry, dtype=float)[:, self.motor_load_index]
+        in_range = (timestamps >= encoder_timestamps[0]) & (timestamps <= encoder_timestamps[-1])
+        timestamps = timestamps[in_range]
+        load = load[in_range]
+        deflection = np.interp(timestamps, encoder_timestamps, encoder_delta)
+        return timestamps, load, deflection
 
-        session_epoch = self.encoder_timestamps[0]
-        self.encoder_timestamps = np.array(self.encoder_timestamps)
-        formatted_abs_enc_1_ticks = np.array(formatted_abs_enc_1_ticks)
-        formatted_abs_enc_2_ticks = np.array(formatted_abs_enc_2_ticks)
+    async def teardown(self):
         self.diff_encoder_1_ticks = np.array(self.diff_encoder_1_ticks)
         self.diff_encoder_2_ticks = np.array(self.diff_encoder_2_ticks)
-        self.motor_encoder_ticks = np.array(self.motor_encoder_ticks)
-
-        self.brake_timestamps = np.array(self.brake_timestamps)
-        self.brake_current = np.array(self.brake_current)
-
-        self.encoder_timestamps -= session_epoch
-        self.brake_timestamps -= session_epoch
-        self.experiment_start_time -= session_epoch
-        self.experiment_stop_time -= session_epoch
-        self.motor_direction_switch_time -= session_epoch
-
-        basklash_time_compensation = 2.0
-        exp_start_index = (
-            np.abs(self.encoder_timestamps - (self.experiment_start_time + basklash_time_compensation))).argmin()
-
-        formatted_abs_enc_1_ticks = formatted_abs_enc_1_ticks - formatted_abs_enc_1_ticks[exp_start_index]
-        formatted_abs_enc_2_ticks = formatted_abs_enc_2_ticks - formatted_abs_enc_2_ticks[exp_start_index]
-
-        if self.use_abs_encoders:
-            encoder_1_ticks = formatted_abs_enc_1_ticks
-            encoder_2_ticks = formatted_abs_enc_2_ticks
-            enc_ticks_to_rad = abs_enc_ticks_to_rad
-            self.experiment_start_time += basklash_time_compensation
-            enc_type_dir_name = "abs"
-        else:
-            encoder_1_ticks = self.diff_encoder_1_ticks
-            encoder_2_ticks = self.diff_encoder_2_ticks
-            enc_ticks_to_rad = rel_enc_ticks_to_rad
-            enc_type_dir_name = "rel"
-
-        result = compute_k(
-            self.torque_table,
-            self.encoder_timestamps, encoder_1_ticks, encoder_2_ticks, self.motor_encoder_ticks,
-            self.brake_timestamps, self.brake_current,
-            self.motor_direction_switch_time, enc_ticks_to_rad, motor_enc_ticks_to_rad, self.enable_smoothing,
-            self.experiment_start_time, self.experiment_stop_time,
+
+        if self.align_clocks:
+            self.encoder_timestamps, self.brake_timestamps, alignment = align_streams(
+                self.encoder_device_timestamps, self.encoder_receive_times,
+                (self.diff_encoder_1_ticks - self.diff_encoder_2_ticks) * rel_enc_ticks_to_rad,
+                self.brake_device_timestamps, self.brake_receive_times, self.brake_current
+            )
+            self.logger.info("encoder clock: %s, first packet was %0.2fms late" % (
+                alignment.encoder_clock, alignment.encoder_anchor_error * 1000.0))
+            self.logger.info("brake clock: %s, first packet was %0.2fms late" % (
+                alignment.brake_clock, alignment.brake_anchor_error * 1000.0))
+            self.logger.info("deflection lags the brake current by %+0.2fms, brake timestamps shifted %+0.2fms" % (
+                alignment.correlation_lag * 1000.0, alignment.brake_shift * 1000.0))
+
+        analysis = analyze_session(
+            self.stage_cache, self.torque_table,
+            np.array(self.encoder_timestamps), np.array(self.abs_encoder_1_ticks), np.array(self.abs_encoder_2_ticks),
+            self.diff_encoder_1_ticks, self.diff_encoder_2_ticks, np.array(self.motor_encoder_ticks),
+            np.array(self.brake_timestamps), np.array(self.brake_current),
+            self.experiment_start_time, self.experiment_stop_time, self.motor_direction_switch_time,
+            self.use_abs_encoders, self.enable_smoothing, self.abs_encoder_fixed_diff
         )
+        self.logger.info("stage cache: %s" % self.stage_cache.report())
+        if analysis.abs_encoder_offset is not None:
+            self.logger.info("estimated abs encoder fixed diff: %s" % format_estimate(analysis.abs_encoder_offset))
 
-        abs_enc_delta = (formatted_abs_enc_1_ticks - formatted_abs_enc_2_ticks) * abs_enc_ticks_to_rad
+        result = analysis.result
+        session_epoch = self.encoder_timestamps[0]
+        self.encoder_timestamps = analysis.encoder_timestamps
+        self.brake_timestamps = analysis.brake_timestamps
+        self.experiment_start_time = analysis.experiment_start_time
+        self.experiment_stop_time = analysis.experiment_stop_time
+        enc_type_dir_name = analysis.enc_type_dir_name
+
+        abs_enc_delta = (analysis.abs_encoder_1_ticks - analysis.abs_encoder_2_ticks) * abs_enc_ticks_to_rad
         diff_enc_delta = (self.diff_encoder_1_ticks - self.diff_encoder_2_ticks) * rel_enc_ticks_to_rad
         print("backward backlash deg:", math.degrees(result.motor_backward_backlash_rad))
         print("forward backlash deg:", math.degrees(result.motor_forward_backlash_rad))
 
+        motor_load = self.motor_load_vs_deflection(self.encoder_timestamps, diff_enc_delta, session_epoch)
+        if motor_load is not None and len(motor_load[0]) > 2:
+            print("motor load vs. deflection correlation:", np.corrcoef(motor_load[1], motor_load[2])[0, 1])
+
+        motor_direction_switch_time = 0.0
+        if self.motor_direction_switch_time > 0.0:
+            motor_direction_switch_time = self.motor_direction_switch_time - session_epoch
+        try:
+            response = session_frequency_response(
+                self.torque_table, self.encoder_timestamps, diff_enc_delta, self.brake_timestamps,
+                np.array(self.brake_current), motor_direction_switch_time,
+                self.experiment_start_time, self.experiment_stop_time
+            )
+            print("dynamic stiffness:", format_response(response))
+        except ValueError as error:
+            response = None
+            print("no frequency response:", error)
+
+        if not self.save_figures and not self.show_figures:
+            return
+
+        from matplotlib import pyplot as plt
+
         new_fig()
         plt.title("Absolute vs. Incremental Encoder Comparison")
         plt.xlabel("Time (s)")
@@ -225,7 +285,35 @@ class DataAggregator(Node):
                     "%s/%s-%s/%s/torque_vs_angle" % (
                     self.conical_annulus_size, self.log_directory, self.log_filename, enc_type_dir_name))
 
-        plt.show()
+        if response is not None:
+            new_fig()
+            plt.subplot(3, 1, 1)
+            plt.title("Torque to deflection frequency response")
+            plt.loglog(response.frequencies[1:], response.magnitude[1:])
+            plt.ylabel("Magnitude (rad/Nm)")
+            plt.subplot(3, 1, 2)
+            plt.semilogx(response.frequencies[1:], np.degrees(response.phase[1:]))
+            plt.ylabel("Phase (deg)")
+            plt.subplot(3, 1, 3)
+            plt.semilogx(response.frequencies[1:], response.coherence[1:])
+            plt.xlabel("Frequency (Hz)")
+            plt.ylabel("Coherence")
+            if self.save_figures:
+                save_fig("%s/%s-%s/%s/frequency_response" % (
+                    self.conical_annulus_size, self.log_directory, self.log_filename, enc_type_dir_name))
+
+        if motor_load is not None:
+            new_fig()
+            plt.title("Motor load vs. delta angle")
+            plt.xlabel("Delta angle (rad)")
+            plt.ylabel("Motor telemetry column %s" % self.motor_load_index)
+            plt.plot(motor_load[2], motor_load[1], '.', markersize=1.0)
+            if self.save_figures:
+                save_fig("%s/%s-%s/%s/motor_load_vs_angle" % (
+                    self.conical_annulus_size, self.log_directory, self.log_filename, enc_type_dir_name))
+
+        if self.show_figures:
+            plt.show()
 
 
 class PlaybackOrchestrator(Orchestrator):
@@ -236,6 +324,8 @@ class PlaybackOrchestrator(Orchestrator):
 
         use_abs_encoders = False
         save_figures = True
+        show_figures = True
+        align_clocks = True
 
         # filename = "22_35_04.log"
         # directory = "2018_Oct_30"
@@ -294,7 +384,8 @@ class PlaybackOrchestrator(Orchestrator):
         conical_annulus_size = "15x30x9mm with inserts"
         torque_table_path = "brake_torque_data/B15 Torque Table.csv"
         enable_smoothing = True
-        abs_encoder_fixed_diff = 259.0
+        # estimated from the unloaded samples when use_abs_encoders is on. Set it to skip the estimate
+        abs_encoder_fixed_diff = None
 
         # torque range too low for meaningful data
         # filename = "23_23_22.log"
@@ -310,8 +401,9 @@ class PlaybackOrchestrator(Orchestrator):
         self.experiment = ExperimentPlayback(filename, directory)
         self.aggregator = DataAggregator(
             torque_table_path, filename, directory, conical_annulus_size,
-            save_figures=save_figures, enabled=True, enable_smoothing=enable_smoothing,
-            use_abs_encoders=use_abs_encoders, abs_encoder_fixed_diff=abs_encoder_fixed_diff
+            save_figures=save_figures, show_figures=show_figures, enabled=True, enable_smoothing=enable_smoothing,
+            use_abs_encoders=use_abs_encoders, abs_encoder_fixed_diff=abs_encoder_fixed_diff,
+            align_clocks=align_clocks
         )
 
         # self.add_nodes(self.brake, self.motor, self.encoders, self.experiment)
@@ -335,4 +427,5 @@ class PlaybackOrchestrator(Orchestrator):
         print("took: %ss" % (self.t1 - self.t0))
 
 
-run(PlaybackOrchestrator)
+if __name__ == "__main__":
+    run(PlaybackOrchestrator)
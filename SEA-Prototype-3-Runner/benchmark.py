@@ -0,0 +1,66 @@
+import sys
+import argparse
+
+from benchmarks.fixtures import load_recorded_sessions, load_synthetic_session
+from benchmarks.accuracy import print_accuracy
+from benchmarks.runner import run_benchmarks, run_startup_benchmarks
+from benchmarks.history import default_history_path, make_record, append_record, load_history, find_record, \
+    compare_records
+
+
+def print_comparison(comparisons, threshold):
+    num_regressions = 0
+    for name, baseline_time, current_time, ratio, is_regression in comparisons:
+        flag = "REGRESSION" if is_regression else ""
+        print("%-75s %9.4fs -> %9.4fs (%5.2fx) %s" % (name, baseline_time, current_time, ratio, flag))
+        if is_regression:
+            num_regressions += 1
+    print("%s of %s benchmarks slower by more than %0.0f%%" % (num_regressions, len(comparisons), threshold * 100))
+    return num_regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the analysis pipeline against the recorded sessions")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 10, 100],
+                        help="packet rate multipliers for the synthetic sessions")
+    parser.add_argument("--filter", default=None, help="only run benchmarks whose name contains this")
+    parser.add_argument("--history", default=default_history_path, help="where results are appended")
+    parser.add_argument("--label", default=None, help="name this run so it can be used as a baseline later")
+    parser.add_argument("--compare", nargs="?", const="", default=None,
+                        help="compare against a label or revision (default: the previous run)")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="fractional slowdown that counts as a regression")
+    parser.add_argument("--no-startup", action="store_true", help="skip timing the entry points' imports")
+    parser.add_argument("--no-save", action="store_true", help="don't append this run to the history")
+    parser.add_argument("--synthetic", action="store_true",
+                        help="also run against a generated session and check compute_k against its known K")
+    args = parser.parse_args()
+
+    history = load_history(args.history)
+
+    sessions = load_recorded_sessions()
+    if args.synthetic:
+        synthetic_session = load_synthetic_session()
+        print_accuracy(synthetic_session)
+        sessions.append(synthetic_session)
+    results = run_benchmarks(sessions, args.scales, args.filter)
+    if not args.no_startup:
+        results.update(run_startup_benchmarks(args.filter))
+    record = make_record(results, args.label)
+
+    if not args.no_save:
+        append_record(record, args.history)
+        print("Results appended to %s" % args.history)
+
+    if args.compare is not None:
+        baseline = find_record(history, args.compare if len(args.compare) > 0 else None)
+        if baseline is None:
+            print("No baseline found in %s to compare against" % args.history)
+            return
+        print("Comparing against %s (%s)" % (baseline.get("label") or baseline.get("revision"), baseline["time"]))
+        if print_comparison(compare_records(baseline, record, args.threshold), args.threshold) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+from data_processing.experiment_helpers.k_calculator_helpers import compute_k, rel_enc_ticks_to_rad, \
+    motor_enc_ticks_to_rad
+
+
+def check_accuracy(session, enable_smoothing=True):
+    """Run compute_k on a synthetic session and compare against what it was generated with.
+    Returns (name, found, expected) tuples"""
+    result = compute_k(
+        session.torque_table,
+        session.encoder_timestamps, session.encoder_1_ticks, session.encoder_2_ticks, session.motor_encoder_ticks,
+        session.brake_timestamps, session.brake_current,
+        session.motor_direction_switch_time, rel_enc_ticks_to_rad, motor_enc_ticks_to_rad, enable_smoothing,
+        session.experiment_start_time, session.experiment_stop_time,
+    )
+    return [
+        ("k", result.polynomial[0], session.truth.k),
+        ("forward_backlash_rad", result.motor_forward_backlash_rad, session.truth.forward_backlash_rad),
+        ("backward_backlash_rad", result.motor_backward_backlash_rad, session.truth.backward_backlash_rad),
+    ]
+
+
+def print_accuracy(session):
+    for name, found, expected in check_accuracy(session):
+        error = found - expected
+        print("%-40s %-22s found %10.5f, expected %10.5f (%+0.2f%%)" % (
+            session.name, name, found, expected, 100.0 * error / abs(expected) if expected != 0.0 else 0.0))
@@ -0,0 +1,186 @@
+import os
+import tempfile
+import numpy as np
+
+from data_processing.log_parser import iter_packets, iter_motor_events
+from data_processing.compressed_log import CompressedLogWriter, compressed_log_path
+from data_processing.experiment_helpers.k_calculator_helpers import format_abs_enc_ticks, savitzky_golay, \
+    interpolate_encoder_values, compute_k, abs_ticks_per_rotation, rel_enc_ticks_to_rad, motor_enc_ticks_to_rad
+from data_processing.experiment_helpers.chunked_k import chunked_compute_k, array_encoder_chunks
+from data_processing.experiment_helpers.frequency_response import session_frequency_response
+from data_processing.experiment_helpers.abs_encoder_calibration import session_abs_encoder_fixed_diff
+
+
+class NullLine:
+    def set_xdata(self, data):
+        pass
+
+    def set_ydata(self, data):
+        pass
+
+
+class NullAxes:
+    """Lets PlotContainer be timed without the cost of matplotlib drawing"""
+
+    def plot(self, *args, **kwargs):
+        return [NullLine()]
+
+
+def bench_parse_brake_log(session):
+    return lambda: list(iter_packets(None, "brake", raw_lines=session.brake_lines))
+
+
+def write_temporary_log(lines, compressed):
+    """(TemporaryDirectory, path of the log in it). Clean up the directory once the case is timed"""
+    directory = tempfile.TemporaryDirectory()
+    path = os.path.join(directory.name, "session.log")
+    if compressed:
+        writer = CompressedLogWriter(compressed_log_path(path))
+        for line in lines:
+            writer.write(line)
+        writer.close()
+    else:
+        with open(path, "w") as log_file:
+            log_file.writelines(lines)
+    return directory, path
+
+
+def bench_parse_brake_log_file(session):
+    directory, path = write_temporary_log(session.brake_lines, compressed=False)
+    fn = lambda: list(iter_packets(path, "brake"))
+    fn.cleanup = directory.cleanup
+    return fn
+
+
+def bench_parse_compressed_brake_log(session):
+    # same as parse_brake_log_file but through the threaded decompressor
+    directory, path = write_temporary_log(session.brake_lines, compressed=True)
+    fn = lambda: list(iter_packets(path, "brake"))
+    fn.cleanup = directory.cleanup
+    return fn
+
+
+def bench_parse_encoder_log(session):
+    if len(session.encoder_lines) == 0:
+        return None
+    return lambda: list(iter_packets(None, "enc", raw_lines=session.encoder_lines))
+
+
+def bench_parse_motor_log(session):
+    return lambda: list(iter_motor_events(None, raw_lines=session.motor_lines))
+
+
+def bench_format_abs_enc_ticks(session):
+    ticks = list(session.abs_encoder_2_ticks)
+    return lambda: format_abs_enc_ticks(ticks, abs_ticks_per_rotation, 274.0)
+
+
+def bench_savitzky_golay(session):
+    encoder_delta = (session.encoder_1_ticks - session.encoder_2_ticks) * rel_enc_ticks_to_rad
+    return lambda: savitzky_golay(encoder_delta, 501, 5)
+
+
+def bench_interpolate_encoder_values(session):
+    return lambda: interpolate_encoder_values(
+        session.encoder_timestamps, session.encoder_1_ticks, session.encoder_2_ticks, rel_enc_ticks_to_rad,
+        session.brake_timestamps, False
+    )
+
+
+def bench_compute_k(session):
+    return lambda: compute_k(
+        session.torque_table,
+        session.encoder_timestamps, session.encoder_1_ticks, session.encoder_2_ticks, session.motor_encoder_ticks,
+        session.brake_timestamps, session.brake_current,
+        session.motor_direction_switch_time, rel_enc_ticks_to_rad, motor_enc_ticks_to_rad, True,
+        session.experiment_start_time, session.experiment_stop_time,
+    )
+
+
+def bench_chunked_compute_k(session, chunk_size=4096):
+    chunks = array_encoder_chunks(
+        chunk_size, session.encoder_timestamps, session.abs_encoder_1_ticks, session.abs_encoder_2_ticks,
+        session.encoder_1_ticks, session.encoder_2_ticks, session.motor_encoder_ticks
+    )
+    return lambda: chunked_compute_k(
+        session.torque_table, chunks, session.brake_timestamps, session.brake_current,
+        session.experiment_start_time, session.experiment_stop_time, session.motor_direction_switch_time,
+        False, True, 0.0
+    )
+
+
+def bench_frequency_response(session):
+    encoder_delta = (session.encoder_1_ticks - session.encoder_2_ticks) * rel_enc_ticks_to_rad
+    return lambda: session_frequency_response(
+        session.torque_table, session.encoder_timestamps, encoder_delta,
+        session.brake_timestamps, session.brake_current, session.motor_direction_switch_time
+    )
+
+
+def bench_abs_encoder_offset(session):
+    return lambda: session_abs_encoder_fixed_diff(
+        session.encoder_timestamps, session.abs_encoder_1_ticks, session.abs_encoder_2_ticks,
+        session.encoder_1_ticks, session.encoder_2_ticks, session.brake_timestamps, session.brake_current
+    )
+
+
+def bench_torque_table_to_torque(session):
+    brake_current = np.tile(session.brake_current, session.scale)
+
+    def convert():
+        session.torque_table.to_torque(True, brake_current)
+        session.torque_table.to_torque(False, brake_current)
+
+    return convert
+
+
+def bench_torque_table_to_current(session):
+    torques = np.linspace(0.0, session.torque_table.max_torque, len(session.brake_current) * session.scale)
+
+    def convert():
+        session.torque_table.to_current_mA(True, torques)
+        session.torque_table.to_current_mA(False, torques)
+
+    return convert
+
+
+def bench_plot_container_update_lines(session, update_interval=10):
+    from gui.data_plotter import PlotContainer, LineArgsContainer
+
+    timestamps = session.encoder_timestamps
+    encoder_delta = (session.encoder_1_ticks - session.encoder_2_ticks) * rel_enc_ticks_to_rad
+
+    def stream():
+        # mirrors the diff plot in DataPlotter: 120 second window, lines updated as packets arrive
+        container = PlotContainer(
+            "diff", NullAxes(),
+            LineArgsContainer("rel", '-', enabled=True, label="rel diff"),
+            x_data_window=120.0
+        )
+        for index in range(len(timestamps)):
+            container.append_x(timestamps[index])
+            container.append_y("rel", encoder_delta[index])
+            if index % update_interval == 0:
+                container.update_lines()
+
+    return stream
+
+
+# name -> function that takes a BenchmarkSession and returns the callable to time (or None to skip)
+benchmark_cases = [
+    ("parse_brake_log", bench_parse_brake_log),
+    ("parse_brake_log_file", bench_parse_brake_log_file),
+    ("parse_compressed_brake_log", bench_parse_compressed_brake_log),
+    ("parse_encoder_log", bench_parse_encoder_log),
+    ("parse_motor_log", bench_parse_motor_log),
+    ("format_abs_enc_ticks", bench_format_abs_enc_ticks),
+    ("savitzky_golay", bench_savitzky_golay),
+    ("interpolate_encoder_values", bench_interpolate_encoder_values),
+    ("compute_k", bench_compute_k),
+    ("chunked_compute_k", bench_chunked_compute_k),
+    ("frequency_response", bench_frequency_response),
+    ("abs_encoder_offset", bench_abs_encoder_offset),
+    ("torque_table_to_torque", bench_torque_table_to_torque),
+    ("torque_table_to_current", bench_torque_table_to_current),
+    ("plot_container_update_lines", bench_plot_container_update_lines),
+]
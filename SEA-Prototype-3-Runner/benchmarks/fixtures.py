@@ -0,0 +1,201 @@
+import tempfile
+import numpy as np
+
+from data_processing.log_parser import session_log_path, iter_packets, iter_motor_events, estimate_log_time_offset, \
+    iter_raw_lines
+from data_processing.compressed_log import find_log
+from data_processing.torque_table import TorqueTable
+from data_processing.synthetic_session import generate_session, load_truth, default_synthetic_config
+from data_processing.clock_alignment import align_streams
+from data_processing.experiment_helpers.k_calculator_helpers import rel_enc_ticks_to_rad, motor_enc_ticks_to_rad, \
+    abs_enc_ticks_to_rad, abs_ticks_per_rotation
+
+# (directory, filename, torque table) of the sessions checked into logs/
+recorded_sessions = [
+    ("2018_Oct_30", "22_35_04.log", "brake_torque_data/B15 Torque Table.csv"),
+    ("2018_Nov_06", "23_45_11.log", "brake_torque_data/B5Z Torque Table.csv"),
+    ("2019_Mar_01", "00_40_48.log", "brake_torque_data/B15 Torque Table.csv"),
+    ("2019_Mar_01", "22_08_46.log", "brake_torque_data/B15 Torque Table.csv"),
+    ("2019_Mar_01", "23_23_22.log", "brake_torque_data/B5Z Torque Table.csv"),
+]
+
+# stand-in spring used when a session has no encoder log
+synthetic_k = 5.0
+encoder_packet_interval = 0.01
+
+
+class BenchmarkSession:
+    """Arrays for one session, laid out the way DataAggregator.teardown hands them to compute_k"""
+
+    def __init__(self, name, torque_table, brake_lines, motor_lines, encoder_lines):
+        self.name = name
+        self.torque_table = torque_table
+        self.brake_lines = brake_lines
+        self.motor_lines = motor_lines
+        self.encoder_lines = encoder_lines
+        self.scale = 1
+        # SyntheticTruth for generated sessions
+        self.truth = None
+
+        self.brake_timestamps = None
+        self.brake_current = None
+        self.encoder_timestamps = None
+        self.abs_encoder_1_ticks = None
+        self.abs_encoder_2_ticks = None
+        self.encoder_1_ticks = None
+        self.encoder_2_ticks = None
+        self.motor_encoder_ticks = None
+        self.experiment_start_time = 0.0
+        self.experiment_stop_time = 0.0
+        self.motor_direction_switch_time = 0.0
+
+    def __str__(self):
+        return "%s (x%s)" % (self.name, self.scale)
+
+
+def read_lines(path):
+    if find_log(path) is None:
+        return []
+    return list(iter_raw_lines(path))
+
+
+def load_session(directory, filename, torque_table_path, log_root="logs", align_clocks=False):
+    brake_path = session_log_path(directory, filename, "brake", log_root)
+    session = BenchmarkSession(
+        "%s/%s" % (directory, filename),
+        TorqueTable(torque_table_path),
+        read_lines(brake_path),
+        read_lines(session_log_path(directory, filename, "motor", log_root)),
+        read_lines(session_log_path(directory, filename, "encoders", log_root)),
+    )
+
+    brake_packets = list(iter_packets(brake_path, "brake", raw_lines=session.brake_lines))
+    brake_start_time = brake_packets[0].receive_time
+    session.brake_timestamps = np.array([packet.timestamp for packet in brake_packets]) + brake_start_time
+    session.brake_current = np.array([packet.data[2] for packet in brake_packets], dtype=float)
+
+    time_offset = estimate_log_time_offset(brake_path)
+    for event in iter_motor_events(None, raw_lines=session.motor_lines, time_offset=time_offset):
+        if event[0] == "start":
+            session.experiment_start_time = event[1]
+        elif event[0] == "stop":
+            session.experiment_stop_time = event[1]
+        elif event[0] == "command" and event[1] > 0 and session.motor_direction_switch_time == 0.0:
+            session.motor_direction_switch_time = event[2]
+
+    if len(session.encoder_lines) > 0:
+        encoder_packets = list(iter_packets(None, "enc", raw_lines=session.encoder_lines))
+        encoder_start_time = encoder_packets[0].receive_time - encoder_packets[0].timestamp
+        session.encoder_timestamps = np.array([packet.timestamp for packet in encoder_packets]) + encoder_start_time
+        data = np.array([packet.data for packet in encoder_packets], dtype=float)
+        session.abs_encoder_1_ticks = data[:, 2]
+        session.abs_encoder_2_ticks = data[:, 3]
+        session.encoder_1_ticks = data[:, 4]
+        session.encoder_2_ticks = data[:, 5]
+        session.motor_encoder_ticks = data[:, 6]
+
+        if align_clocks:
+            session.encoder_timestamps, session.brake_timestamps, _ = align_streams(
+                [packet.timestamp for packet in encoder_packets], [packet.receive_time for packet in encoder_packets],
+                (session.encoder_1_ticks - session.encoder_2_ticks) * rel_enc_ticks_to_rad,
+                [packet.timestamp for packet in brake_packets], [packet.receive_time for packet in brake_packets],
+                session.brake_current
+            )
+    else:
+        synthesize_encoders(session)
+
+    rebase_session(session)
+    return session
+
+
+def synthesize_encoders(session, seed=0):
+    """The checked in sessions only have brake and motor logs. Build encoder data that a spring of
+    stiffness synthetic_k would have produced under the recorded brake current."""
+    random = np.random.RandomState(seed)
+    timestamps = np.arange(session.brake_timestamps[0], session.brake_timestamps[-1], encoder_packet_interval)
+
+    forward = timestamps < session.motor_direction_switch_time
+    current = np.interp(timestamps, session.brake_timestamps, session.brake_current)
+    torque = np.where(
+        forward,
+        session.torque_table.to_torque(True, current),
+        -session.torque_table.to_torque(True, current)
+    )
+    delta_rad = torque / synthetic_k
+
+    motor_rad = np.cumsum(np.where(forward, 1.0, -1.0)) * encoder_packet_interval * 2.0
+    encoder_1_rad = motor_rad + random.normal(0.0, 0.002, len(timestamps))
+    encoder_2_rad = encoder_1_rad - delta_rad
+
+    session.encoder_timestamps = timestamps
+    session.encoder_1_ticks = np.round(encoder_1_rad / rel_enc_ticks_to_rad)
+    session.encoder_2_ticks = np.round(encoder_2_rad / rel_enc_ticks_to_rad)
+    session.motor_encoder_ticks = np.round(motor_rad / motor_enc_ticks_to_rad)
+    session.abs_encoder_1_ticks = np.round(encoder_1_rad / abs_enc_ticks_to_rad) % abs_ticks_per_rotation
+    session.abs_encoder_2_ticks = np.round(encoder_2_rad / abs_enc_ticks_to_rad) % abs_ticks_per_rotation
+
+
+def rebase_session(session):
+    session_epoch = session.encoder_timestamps[0]
+    session.encoder_timestamps = session.encoder_timestamps - session_epoch
+    session.brake_timestamps = session.brake_timestamps - session_epoch
+    session.experiment_start_time -= session_epoch
+    session.experiment_stop_time -= session_epoch
+    session.motor_direction_switch_time -= session_epoch
+
+
+def densify(timestamps, values, scale):
+    dense_timestamps = np.linspace(timestamps[0], timestamps[-1], len(timestamps) * scale)
+    return dense_timestamps, np.interp(dense_timestamps, timestamps, values)
+
+
+def scale_session(session, scale):
+    """Resample a session's encoder stream at scale times its packet rate. The brake stream stays at its
+    recorded rate since compute_k's ramp detection works in brake samples (peakutils min_dist). Log lines
+    are repeated scale times for the parsers."""
+    if scale == 1:
+        return session
+
+    scaled = BenchmarkSession(
+        session.name, session.torque_table,
+        session.brake_lines * scale, session.motor_lines, session.encoder_lines * scale
+    )
+    scaled.scale = scale
+    scaled.truth = session.truth
+    scaled.experiment_start_time = session.experiment_start_time
+    scaled.experiment_stop_time = session.experiment_stop_time
+    scaled.motor_direction_switch_time = session.motor_direction_switch_time
+    scaled.brake_timestamps = session.brake_timestamps
+    scaled.brake_current = session.brake_current
+
+    for name in ("abs_encoder_1_ticks", "abs_encoder_2_ticks", "encoder_1_ticks", "encoder_2_ticks",
+                 "motor_encoder_ticks"):
+        timestamps, values = densify(session.encoder_timestamps, getattr(session, name), scale)
+        setattr(scaled, name, np.round(values))
+    scaled.encoder_timestamps = timestamps
+
+    return scaled
+
+
+def load_recorded_sessions(log_root="logs"):
+    sessions = []
+    for directory, filename, torque_table_path in recorded_sessions:
+        if find_log(session_log_path(directory, filename, "brake", log_root)) is None:
+            print("Skipping missing session %s/%s" % (directory, filename))
+            continue
+        sessions.append(load_session(directory, filename, torque_table_path, log_root))
+    return sessions
+
+
+def load_synthetic_session(config=default_synthetic_config, log_root=None, align_clocks=False):
+    """Generate a session with a known K and backlash and load it like a recorded one. Without a log_root the logs
+    go in a temporary directory that's removed once they're read"""
+    if log_root is None:
+        with tempfile.TemporaryDirectory() as log_root:
+            return load_synthetic_session(config, log_root, align_clocks)
+    directory = "synthetic"
+    filename = "k%s.log" % config.k
+    generate_session(directory, filename, config, log_root)
+    session = load_session(directory, filename, config.torque_table_path, log_root, align_clocks)
+    session.truth = load_truth(directory, filename, log_root)
+    return session
@@ -0,0 +1,72 @@
+import os
+import json
+import time
+import platform
+import subprocess
+
+default_history_path = "benchmarks/history.jsonl"
+
+
+def git_revision():
+    try:
+        output = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.decode().strip()
+
+
+def make_record(results, label=None):
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "revision": git_revision(),
+        "label": label,
+        "python": platform.python_version(),
+        "machine": platform.node(),
+        "results": results,
+    }
+
+
+def append_record(record, path=default_history_path):
+    directory = os.path.split(path)[0]
+    if len(directory) > 0 and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, "a") as history_file:
+        history_file.write(json.dumps(record, sort_keys=True) + "\n")
+
+
+def load_history(path=default_history_path):
+    if not os.path.isfile(path):
+        return []
+    records = []
+    with open(path) as history_file:
+        for line in history_file:
+            line = line.strip()
+            if len(line) > 0:
+                records.append(json.loads(line))
+    return records
+
+
+def find_record(records, reference):
+    """Find a record by label or revision. Defaults to the most recent one"""
+    if reference is None:
+        return records[-1] if len(records) > 0 else None
+    for record in reversed(records):
+        if record.get("label") == reference or record.get("revision") == reference:
+            return record
+    return None
+
+
+def compare_records(baseline, current, threshold):
+    """Returns (name, baseline seconds, current seconds, ratio, is regression) for every
+    benchmark present in both records. Medians are compared since they're less noisy than means."""
+    comparisons = []
+    for name, result in sorted(current["results"].items()):
+        if name not in baseline["results"]:
+            continue
+        baseline_time = baseline["results"][name]["median"]
+        current_time = result["median"]
+        if baseline_time <= 0.0:
+            continue
+        ratio = current_time / baseline_time
+        comparisons.append((name, baseline_time, current_time, ratio, ratio > 1.0 + threshold))
+    return comparisons
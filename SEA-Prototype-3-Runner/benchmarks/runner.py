@@ -0,0 +1,82 @@
+import time
+import statistics
+
+from .cases import benchmark_cases
+from .fixtures import scale_session
+from diagnostics.import_report import time_import
+
+# entry points whose cold start is timed. Nothing in these should pull in matplotlib or tkinter until used
+startup_modules = ["main", "analyzer", "multi_rig", "replay_session"]
+
+# fewer repeats on the bigger sessions so a full run stays under a few minutes
+default_repeats = {1: 5, 10: 3, 100: 1}
+
+
+def time_callable(fn, repeats):
+    durations = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - t0)
+    return durations
+
+
+def run_startup_benchmarks(name_filter=None, repeats=3):
+    """Time a fresh interpreter importing each entry point. Results are keyed by 'startup[module]'"""
+    results = {}
+    for module_name in startup_modules:
+        key = "startup[%s]" % module_name
+        if name_filter is not None and name_filter not in key:
+            continue
+        try:
+            durations = [time_import(module_name) for _ in range(repeats)]
+        except ImportError as error:
+            print("Skipping %s: %s" % (key, error))
+            continue
+
+        results[key] = {
+            "min": min(durations),
+            "median": statistics.median(durations),
+            "repeats": len(durations),
+        }
+        print("%-75s %10.4fs" % (key, results[key]["median"]))
+    return results
+
+
+def run_benchmarks(sessions, scales=(1, 10, 100), name_filter=None, repeats=None):
+    """Time every benchmark case against every session at every scale.
+    Results are keyed by 'case[session]@xscale'."""
+    if repeats is None:
+        repeats = default_repeats
+
+    results = {}
+    for scale in scales:
+        for base_session in sessions:
+            session = scale_session(base_session, scale)
+            for case_name, make_case in benchmark_cases:
+                if name_filter is not None and name_filter not in case_name:
+                    continue
+                key = "%s[%s]@x%s" % (case_name, session.name, scale)
+                try:
+                    fn = make_case(session)
+                except ImportError as error:
+                    print("Skipping %s: %s" % (key, error))
+                    continue
+                if fn is None:
+                    continue
+
+                try:
+                    durations = time_callable(fn, repeats.get(scale, 1))
+                finally:
+                    # cases that write files for themselves remove them here
+                    if hasattr(fn, "cleanup"):
+                        fn.cleanup()
+                results[key] = {
+                    "min": min(durations),
+                    "median": statistics.median(durations),
+                    "repeats": len(durations),
+                    "encoder_samples": len(session.encoder_timestamps),
+                    "brake_samples": len(session.brake_timestamps),
+                }
+                print("%-75s %10.4fs" % (key, results[key]["median"]))
+    return results
@@ -0,0 +1,108 @@
+import numpy as np
+
+# the brake controller stores each step as two uint16s: time offset in 10ms units and set point in 0.01mA units
+profile_time_resolution = 0.01
+profile_current_resolution = 0.01
+max_step_value = 0xffff
+
+# the Uno has 2KB of RAM, the table gets 512 bytes of it
+max_profile_steps = 128
+
+# steps per upload command. Keeps each command inside the Uno's 64 byte serial buffer
+steps_per_command = 6
+
+# commands understood by the brake controller
+clear_profile_command = "pc"
+append_profile_command = "pa"
+start_profile_command = "ps"
+stop_profile_command = "px"
+
+# packet the brake controller sends every time it applies a step: index, ms since profile start, set point
+edge_packet_name = "edge"
+
+
+class BrakeProfile:
+    """Table of (time offset from profile start, set point) steps the brake controller plays back on its own clock"""
+
+    def __init__(self, offsets=None, currents_mA=None):
+        self.offsets = [] if offsets is None else list(offsets)
+        self.currents_mA = [] if currents_mA is None else list(currents_mA)
+
+    def append(self, offset, current_mA):
+        if len(self.offsets) > 0 and offset < self.offsets[-1]:
+            raise ValueError("Profile steps must be in time order: %s comes after %s" % (offset, self.offsets[-1]))
+        self.offsets.append(offset)
+        self.currents_mA.append(float(current_mA))
+
+    @property
+    def duration(self):
+        """Time from the profile start to its last step"""
+        return self.offsets[-1] if len(self.offsets) > 0 else 0.0
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def encode(self):
+        """Profile -> list of commands to write to the brake controller, in order"""
+        if len(self) > max_profile_steps:
+            raise ValueError("Profile has %s steps, the brake controller holds at most %s" % (
+                len(self), max_profile_steps))
+
+        words = []
+        for offset, current_mA in zip(self.offsets, self.currents_mA):
+            offset_units = int(round(offset / profile_time_resolution))
+            current_units = int(round(current_mA / profile_current_resolution))
+            if not (0 <= offset_units <= max_step_value and 0 <= current_units <= max_step_value):
+                raise ValueError("Step (%ss, %smA) doesn't fit in the brake controller's table" % (offset, current_mA))
+            words.append("%04x%04x" % (offset_units, current_units))
+
+        commands = [clear_profile_command]
+        for index in range(0, len(words), steps_per_command):
+            commands.append(append_profile_command + "".join(words[index: index + steps_per_command]))
+        return commands
+
+    @classmethod
+    def decode(cls, commands):
+        """Inverse of encode. Used by the simulated brake controller"""
+        profile = cls()
+        for command in commands:
+            if command == clear_profile_command:
+                profile = cls()
+            elif command.startswith(append_profile_command):
+                payload = command[len(append_profile_command):]
+                for index in range(0, len(payload), 8):
+                    profile.append(int(payload[index: index + 4], 16) * profile_time_resolution,
+                                   int(payload[index + 4: index + 8], 16) * profile_current_resolution)
+        return profile
+
+    def quantized(self):
+        """The profile as the brake controller will see it"""
+        return self.decode(self.encode())
+
+
+def ramp_currents_mA(torque_table, is_forcing, num_steps, min_torque, max_torque):
+    """Set points for equal torque steps from just above min_torque up to max_torque"""
+    percent_torque = np.arange(1, num_steps + 1) / num_steps
+    torques = percent_torque * (max_torque - min_torque) + min_torque
+    return torque_table.to_current_mA(is_forcing, torques)
+
+
+def build_ramp_profile(torque_table, step_duration, num_steps, min_current_mA, max_current_mA=None):
+    """Ramp the brake up through the forcing curve and back down through the unforcing curve,
+    the same steps ExperimentNode.ramp_up_brake and ramp_down_brake send one at a time"""
+    min_torque_forcing = torque_table.to_torque(True, min_current_mA)
+    min_torque_unforcing = torque_table.to_torque(False, min_current_mA)
+    if max_current_mA is None:
+        max_torque_forcing = torque_table.max_torque
+        max_torque_unforcing = torque_table.max_torque
+    else:
+        max_torque_forcing = torque_table.to_torque(True, max_current_mA)
+        max_torque_unforcing = torque_table.to_torque(False, max_current_mA)
+
+    ramp_up = ramp_currents_mA(torque_table, True, num_steps, min_torque_forcing, max_torque_forcing)
+    ramp_down = ramp_currents_mA(torque_table, False, num_steps, min_torque_unforcing, max_torque_unforcing)[::-1]
+
+    profile = BrakeProfile()
+    for index, current_mA in enumerate(np.concatenate((ramp_up, ramp_down))):
+        profile.append(index * step_duration, current_mA)
+    return profile
@@ -0,0 +1,205 @@
+from collections import namedtuple
+
+import numpy as np
+
+AlignmentReport = namedtuple(
+    "AlignmentReport",
+
+    "encoder_clock "
+    "brake_clock "
+    "correlation_lag "  # seconds the deflection lags the brake current by after the clock fits, nan if unmeasured
+    "brake_shift "  # seconds that were actually added to the brake timestamps
+    "encoder_anchor_error "  # how far off anchoring on the first packet alone would have been
+    "brake_anchor_error "
+)
+
+# the most the brake timestamps get moved to match the deflection. The coil and the spring put tens of ms of real lag
+# between the current and the deflection; only what's left of the clocks' error after the fits should be taken out
+default_max_clock_error = 0.01
+
+
+class ClockFit:
+    """host time = host_start + offset + rate * (device time - device_start)"""
+
+    def __init__(self, device_start, host_start, offset, rate, residual_std, num_samples):
+        self.device_start = device_start
+        self.host_start = host_start
+        self.offset = offset
+        self.rate = rate
+        self.residual_std = residual_std
+        self.num_samples = num_samples
+
+    def to_host(self, device_times):
+        return self.host_start + self.offset + self.rate * (np.asarray(device_times) - self.device_start)
+
+    @property
+    def drift_ppm(self):
+        return (self.rate - 1.0) * 1E6
+
+    def __str__(self):
+        return "drift %+0.1fppm, residual std %0.2fms over %s packets" % (
+            self.drift_ppm, self.residual_std * 1000.0, self.num_samples)
+
+
+def fit_device_clock(device_times, receive_times, iterations=10, huber_threshold=1.345, latency_quantile=1.0):
+    """Robust line through (device time, receive time) for every packet in a session.
+
+    USB latency only ever makes packets late, so after an iteratively reweighted (Huber) fit the line is moved
+    down to the latency_quantile percentile of the residuals, which are the packets that got through fastest.
+    Each iteration is O(n).
+    """
+    device_times = np.asarray(device_times, dtype=float)
+    receive_times = np.asarray(receive_times, dtype=float)
+    if len(device_times) < 2:
+        raise ValueError("Need at least two packets to fit a clock, got %s" % len(device_times))
+
+    # fit relative to the first packet to keep the numbers well conditioned
+    x = device_times - device_times[0]
+    y = receive_times - receive_times[0]
+    weights = np.ones(len(x))
+    offset = 0.0
+    rate = 1.0
+    for _ in range(iterations):
+        sum_w = np.sum(weights)
+        mean_x = np.sum(weights * x) / sum_w
+        mean_y = np.sum(weights * y) / sum_w
+        variance = np.sum(weights * (x - mean_x) ** 2)
+        if variance <= 0.0:
+            break
+        rate = np.sum(weights * (x - mean_x) * (y - mean_y)) / variance
+        offset = mean_y - rate * mean_x
+
+        residuals = y - (offset + rate * x)
+        scale = 1.4826 * np.median(np.abs(residuals - np.median(residuals)))
+        if scale <= 0.0:
+            break
+        normalized = np.abs(residuals) / (huber_threshold * scale)
+        weights = np.where(normalized <= 1.0, 1.0, 1.0 / np.maximum(normalized, 1E-12))
+
+    residuals = y - (offset + rate * x)
+    offset += np.percentile(residuals, latency_quantile)
+    residuals = y - (offset + rate * x)
+    return ClockFit(device_times[0], receive_times[0], offset, rate, float(np.std(residuals)), len(x))
+
+
+def cross_correlation_lag(times_a, values_a, times_b, values_b, sample_interval=0.01, max_lag=2.0):
+    """Seconds to add to times_b to line values_b up with values_a, found from the peak of their cross correlation.
+    Both are resampled onto a shared grid and correlated with FFTs, O(n log n) in the session length."""
+    start = max(times_a[0], times_b[0])
+    stop = min(times_a[-1], times_b[-1])
+    if stop - start < 2.0 * max_lag:
+        raise ValueError("Streams only overlap for %0.1fs" % (stop - start))
+
+    grid = np.arange(start, stop, sample_interval)
+    a = np.interp(grid, times_a, values_a)
+    b = np.interp(grid, times_b, values_b)
+    a = (a - np.mean(a)) / (np.std(a) or 1.0)
+    b = (b - np.mean(b)) / (np.std(b) or 1.0)
+
+    # zero pad to avoid wrapping around
+    size = 1 << int(2 * len(grid) - 1).bit_length()
+    correlation = np.fft.irfft(np.fft.rfft(a, size) * np.conj(np.fft.rfft(b, size)), size)
+
+    # correlation[k] = sum a[n + k] b[n], negative lags wrap around to the end
+    max_samples = min(int(max_lag / sample_interval), len(grid) - 1)
+    lags = np.arange(-max_samples, max_samples + 1)
+    window = correlation[lags % size]
+    peak = int(np.argmax(window))
+
+    # parabola through the peak and its neighbors for a sub-sample estimate
+    shift = 0.0
+    if 0 < peak < len(window) - 1:
+        left, center, right = window[peak - 1], window[peak], window[peak + 1]
+        denominator = left - 2.0 * center + right
+        if denominator != 0.0:
+            shift = 0.5 * (left - right) / denominator
+
+    return (lags[peak] + shift) * sample_interval
+
+
+def deflection_envelope(encoder_timestamps, encoder_delta, brake_timestamps, brake_current):
+    """Deflection magnitude away from where it sits with the brake off. Torque flips sign with the motor
+    but the brake current doesn't, so this is what lines up with the current"""
+    current = np.interp(encoder_timestamps, brake_timestamps, brake_current)
+    brake_off = current <= np.percentile(current, 10.0)
+    baseline = np.median(encoder_delta[brake_off])
+    return np.abs(encoder_delta - baseline)
+
+
+def align_streams(encoder_device_times, encoder_receive_times, encoder_delta,
+                  brake_device_times, brake_receive_times, brake_current,
+                  apply_correlation_lag=False, max_lag=2.0, max_clock_error=default_max_clock_error):
+    """Put both streams on the host clock using every packet instead of the first one.
+
+    Returns encoder timestamps, brake timestamps and an AlignmentReport. The lag between the brake current and the
+    encoder deflection is measured for the report. Most of it is the coil and spring responding, not the clocks,
+    so it's only taken out of the brake timestamps with apply_correlation_lag, and then no more than
+    max_clock_error of it.
+    """
+    encoder_device_times = np.asarray(encoder_device_times, dtype=float)
+    encoder_receive_times = np.asarray(encoder_receive_times, dtype=float)
+    brake_device_times = np.asarray(brake_device_times, dtype=float)
+    brake_receive_times = np.asarray(brake_receive_times, dtype=float)
+
+    encoder_clock = fit_device_clock(encoder_device_times, encoder_receive_times)
+    brake_clock = fit_device_clock(brake_device_times, brake_receive_times)
+    encoder_timestamps = encoder_clock.to_host(encoder_device_times)
+    brake_timestamps = brake_clock.to_host(brake_device_times)
+
+    envelope = deflection_envelope(encoder_timestamps, np.asarray(encoder_delta, dtype=float),
+                                   brake_timestamps, np.asarray(brake_current, dtype=float))
+    try:
+        correlation_lag = cross_correlation_lag(encoder_timestamps, envelope, brake_timestamps, brake_current,
+                                                max_lag=max_lag)
+    except ValueError:
+        correlation_lag = np.nan
+
+    brake_shift = 0.0
+    if apply_correlation_lag and np.isfinite(correlation_lag):
+        brake_shift = float(np.clip(correlation_lag, -max_clock_error, max_clock_error))
+        brake_timestamps = brake_timestamps + brake_shift
+
+    report = AlignmentReport(
+        encoder_clock, brake_clock, correlation_lag, brake_shift,
+        encoder_receive_times[0] - encoder_timestamps[0],
+        brake_receive_times[0] - brake_clock.to_host(brake_device_times[0]),
+    )
+    return encoder_timestamps, brake_timestamps, report
+
+
+if __name__ == '__main__':
+    def test():
+        random = np.random.RandomState(1)
+
+        # correlation: b is a copied 0.23s early
+        times = np.arange(0.0, 300.0, 0.01)
+        signal = np.cumsum(random.normal(0.0, 1.0, len(times)))
+        lag = cross_correlation_lag(times, signal, times - 0.23, signal)
+        assert abs(lag - 0.23) < 0.005, lag
+
+        # clock: 40ppm fast device, first packet stuck in the USB stack for 80ms
+        device_times = 1000.0 + np.arange(0.0, 600.0, 0.01) * (1.0 + 40E-6)
+        host_times = 1551496126.0 + np.arange(0.0, 600.0, 0.01)
+        receive_times = host_times + random.exponential(0.002, len(host_times)) + 0.0005
+        receive_times[0] += 0.08
+        clock = fit_device_clock(device_times, receive_times)
+        errors = clock.to_host(device_times) - host_times
+        assert np.max(np.abs(errors)) < 0.002, np.max(np.abs(errors))
+        assert abs(clock.drift_ppm + 40.0) < 2.0, clock.drift_ppm
+        anchored_errors = device_times + (receive_times[0] - device_times[0]) - host_times
+        print("clock fit: %s, max error %0.2fms (first packet anchor: %0.2fms)" % (
+            clock, np.max(np.abs(errors)) * 1000.0, np.max(np.abs(anchored_errors)) * 1000.0))
+
+        # brake steps held for a second. The deflection follows them 60ms late on the same clock, which is measured
+        # but not taken out
+        brake_current = np.repeat(random.uniform(0.0, 400.0, 300), 100)
+        deflection = np.interp(times - 0.06, times, brake_current) * 0.001
+        _, brake_timestamps, report = align_streams(times, times, deflection, times, times, brake_current)
+        assert abs(report.correlation_lag - 0.06) < 0.005, report.correlation_lag
+        assert report.brake_shift == 0.0 and np.allclose(brake_timestamps, times)
+        _, _, report = align_streams(times, times, deflection, times, times, brake_current, apply_correlation_lag=True)
+        assert report.brake_shift == default_max_clock_error, report.brake_shift
+        print("correlation lag %0.1fms, applied at most %0.1fms" % (
+            report.correlation_lag * 1000.0, report.brake_shift * 1000.0))
+
+    test()
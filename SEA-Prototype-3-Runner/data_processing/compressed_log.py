@@ -0,0 +1,254 @@
+import io
+import os
+import sys
+import zlib
+import queue
+import struct
+import logging
+import threading
+
+# compressed logs sit next to where the plain log would be: 22_08_46.log -> 22_08_46.log.zb
+compressed_log_extension = ".zb"
+
+# file: magic, then blocks of (compressed size, raw size) + zlib data. Every block decompresses on its own,
+# so a crash only loses the block that was being filled
+log_magic = b"SEALOGZ1"
+block_header = struct.Struct("<II")
+
+default_block_size = 2 ** 16
+
+
+def compressed_log_path(path):
+    return path + compressed_log_extension
+
+
+def find_log(path):
+    """The plain log if it's there, otherwise its compressed version. None if neither exists"""
+    if os.path.isfile(path):
+        return path
+    if os.path.isfile(compressed_log_path(path)):
+        return compressed_log_path(path)
+    return None
+
+
+def is_compressed_log(path):
+    return path.endswith(compressed_log_extension)
+
+
+class CompressedLogWriter:
+    def __init__(self, path, block_size=default_block_size, level=6):
+        directory = os.path.split(path)[0]
+        if len(directory) > 0 and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.path = path
+        self.block_size = block_size
+        self.level = level
+        self.file = open(path, "wb")
+        self.file.write(log_magic)
+        self.pending = []
+        self.pending_size = 0
+
+    def write(self, text):
+        data = text.encode()
+        self.pending.append(data)
+        self.pending_size += len(data)
+        if self.pending_size >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        if self.pending_size == 0:
+            return
+        raw = b"".join(self.pending)
+        compressed = zlib.compress(raw, self.level)
+        self.file.write(block_header.pack(len(compressed), len(raw)))
+        self.file.write(compressed)
+        self.file.flush()
+        self.pending = []
+        self.pending_size = 0
+
+    def close(self):
+        if self.file is None:
+            return
+        self.flush()
+        self.file.close()
+        self.file = None
+
+
+class CompressedLogHandler(logging.Handler):
+    """Drop in replacement for a logging.FileHandler that writes compressed blocks"""
+
+    def __init__(self, path, block_size=default_block_size, level=logging.NOTSET):
+        super(CompressedLogHandler, self).__init__(level)
+        self.writer = CompressedLogWriter(path, block_size)
+
+    def emit(self, record):
+        try:
+            text = self.format(record) + "\n"
+            with self.lock:
+                self.writer.write(text)
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        with self.lock:
+            self.writer.flush()
+
+    def close(self):
+        with self.lock:
+            self.writer.close()
+        super(CompressedLogHandler, self).close()
+
+
+def compress_file_handlers(logger):
+    """Swap every FileHandler on a logger for a CompressedLogHandler writing to the same path + .zb"""
+    for handler in list(logger.handlers):
+        if not isinstance(handler, logging.FileHandler):
+            continue
+        path = handler.baseFilename
+        compressed_handler = CompressedLogHandler(compressed_log_path(path), level=handler.level)
+        compressed_handler.setFormatter(handler.formatter)
+        for log_filter in handler.filters:
+            compressed_handler.addFilter(log_filter)
+
+        logger.removeHandler(handler)
+        handler.close()
+        if os.path.isfile(path) and os.path.getsize(path) == 0:
+            os.remove(path)
+        logger.addHandler(compressed_handler)
+
+
+def iter_compressed_blocks(path):
+    """Yield the decompressed bytes of each block in order"""
+    with open(path, "rb") as file:
+        if file.read(len(log_magic)) != log_magic:
+            raise ValueError("%s isn't a compressed log" % path)
+        while True:
+            header = file.read(block_header.size)
+            if len(header) < block_header.size:
+                break
+            compressed_size, raw_size = block_header.unpack(header)
+            compressed = file.read(compressed_size)
+            if len(compressed) < compressed_size:
+                # the writer didn't finish this block
+                break
+            yield zlib.decompress(compressed, bufsize=raw_size)
+
+
+class BlockStream(io.RawIOBase):
+    """Presents decompressed blocks as a binary file so lines get split by io in C, like reading a plain log"""
+
+    def __init__(self, blocks):
+        super(BlockStream, self).__init__()
+        self.blocks = iter(blocks)
+        self.current = b""
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self.position >= len(self.current):
+            try:
+                self.current = next(self.blocks)
+            except StopIteration:
+                return 0
+            self.position = 0
+
+        size = min(len(buffer), len(self.current) - self.position)
+        buffer[:size] = self.current[self.position: self.position + size]
+        self.position += size
+        return size
+
+
+def iter_block_lines(blocks):
+    with io.TextIOWrapper(io.BufferedReader(BlockStream(blocks), default_block_size)) as lines:
+        for line in lines:
+            yield line
+
+
+class ThreadedBlockReader:
+    """Reads and decompresses blocks on a worker thread while the caller parses the ones already done.
+    zlib releases the GIL, so decompression really does run alongside parsing."""
+
+    def __init__(self, path, max_queued_blocks=8):
+        self.path = path
+        self.blocks = queue.Queue(maxsize=max_queued_blocks)
+        self.error = None
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="log-decompressor", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            for block in iter_compressed_blocks(self.path):
+                if not self.put(block):
+                    return
+        except BaseException as error:
+            self.error = error
+        finally:
+            self.put(None)
+
+    def put(self, block):
+        # gives up once the reader stops instead of blocking forever on a full queue
+        while not self.stop_event.is_set():
+            try:
+                self.blocks.put(block, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __iter__(self):
+        try:
+            while True:
+                block = self.blocks.get()
+                if block is None:
+                    break
+                yield block
+        finally:
+            self.stop()
+        if self.error is not None:
+            raise self.error
+
+    def stop(self):
+        self.stop_event.set()
+
+
+def iter_compressed_lines(path, threaded=True):
+    if threaded:
+        return iter_block_lines(ThreadedBlockReader(path))
+    return iter_block_lines(iter_compressed_blocks(path))
+
+
+def compress_log_file(path, remove_original=False, block_size=default_block_size):
+    writer = CompressedLogWriter(compressed_log_path(path), block_size)
+    with open(path) as file:
+        for line in file:
+            writer.write(line)
+    writer.close()
+    if remove_original:
+        os.remove(path)
+    return compressed_log_path(path)
+
+
+def compress_logs(log_root="logs", remove_original=False):
+    """Compress every plain log under log_root"""
+    plain_size = 0
+    compressed_size = 0
+    for directory, _, filenames in os.walk(log_root):
+        for filename in filenames:
+            if not filename.endswith(".log"):
+                continue
+            path = os.path.join(directory, filename)
+            plain_size += os.path.getsize(path)
+            compressed_size += os.path.getsize(compress_log_file(path, remove_original))
+    return plain_size, compressed_size
+
+
+if __name__ == '__main__':
+    # python -m data_processing.compressed_log [log root] [--remove]
+    arguments = [argument for argument in sys.argv[1:] if not argument.startswith("--")]
+    plain, compressed = compress_logs(arguments[0] if len(arguments) > 0 else "logs", "--remove" in sys.argv)
+    if plain > 0:
+        print("%0.1fMB -> %0.1fMB (%0.1f%%)" % (plain / 1E6, compressed / 1E6, 100.0 * compressed / plain))
@@ -0,0 +1,135 @@
+from collections import namedtuple
+
+import numpy as np
+
+from .encoder_constants import *
+
+AbsOffsetEstimate = namedtuple(
+    "AbsOffsetEstimate",
+
+    "fixed_diff "
+    "disagreement_ticks "
+    "num_samples "
+)
+
+# mA above the brake's resting current that still counts as unloaded
+default_unloaded_margin_mA = 5.0
+
+# residuals further than this many ticks from the incremental deflection cost the same. Keeps wrap glitches and
+# any loaded samples that got into the window from pulling the estimate around
+default_clip_ticks = 8.0
+
+default_max_samples = 20000
+
+
+def wrap_ticks(ticks, ticks_per_rotation=abs_ticks_per_rotation):
+    """Into -ticks_per_rotation / 2 .. ticks_per_rotation / 2"""
+    half_rotation = ticks_per_rotation / 2.0
+    return np.mod(ticks + half_rotation, ticks_per_rotation) - half_rotation
+
+
+def unloaded_mask(encoder_timestamps, brake_timestamps, brake_current, margin_mA=default_unloaded_margin_mA):
+    """Encoder samples taken while the brake was at its resting current, so the spring carries no torque"""
+    current = np.interp(encoder_timestamps, brake_timestamps, brake_current)
+    resting_current = np.percentile(brake_current, 1.0)
+    return current <= resting_current + margin_mA
+
+
+def estimate_abs_encoder_fixed_diff(abs_encoder_1_ticks, abs_encoder_2_ticks, encoder_1_ticks, encoder_2_ticks,
+                                    mask=None, clip_ticks=default_clip_ticks, max_samples=default_max_samples):
+    """The fixed_diff that makes the absolute deflection agree with the incremental one.
+
+    Inputs are raw, still wrapped absolute ticks and raw incremental ticks. Every whole tick from 0 to
+    abs_ticks_per_rotation is tried at once: the residuals only depend on the candidate through a shift, so they're
+    binned into one histogram over a rotation and the clipped cost of every candidate is a single matrix product.
+    The best candidate is refined to a fraction of a tick with the median residual around it.
+    """
+    abs_encoder_1_ticks = np.asarray(abs_encoder_1_ticks, dtype=np.float64)
+    abs_encoder_2_ticks = np.asarray(abs_encoder_2_ticks, dtype=np.float64)
+    encoder_1_ticks = np.asarray(encoder_1_ticks, dtype=np.float64)
+    encoder_2_ticks = np.asarray(encoder_2_ticks, dtype=np.float64)
+    if mask is not None:
+        abs_encoder_1_ticks = abs_encoder_1_ticks[mask]
+        abs_encoder_2_ticks = abs_encoder_2_ticks[mask]
+        encoder_1_ticks = encoder_1_ticks[mask]
+        encoder_2_ticks = encoder_2_ticks[mask]
+    if len(abs_encoder_1_ticks) == 0:
+        raise ValueError("No unloaded encoder samples to estimate the absolute encoder offset from")
+    if len(abs_encoder_1_ticks) > max_samples:
+        step = int(np.ceil(len(abs_encoder_1_ticks) / max_samples))
+        abs_encoder_1_ticks = abs_encoder_1_ticks[::step]
+        abs_encoder_2_ticks = abs_encoder_2_ticks[::step]
+        encoder_1_ticks = encoder_1_ticks[::step]
+        encoder_2_ticks = encoder_2_ticks[::step]
+
+    incremental_delta = (encoder_1_ticks - encoder_2_ticks) * rel_enc_ticks_to_rad / abs_enc_ticks_to_rad
+    residuals = wrap_ticks(abs_encoder_1_ticks - abs_encoder_2_ticks - incremental_delta)
+
+    # residual + candidate for every candidate, without a candidates x samples array
+    num_bins = int(abs_ticks_per_rotation)
+    bins = np.mod(np.round(residuals), num_bins).astype(np.int64)
+    histogram = np.bincount(bins, minlength=num_bins)
+    shifts = np.arange(num_bins)
+    costs = np.minimum(np.abs(wrap_ticks(shifts)), clip_ticks)
+    candidate_costs = costs[np.mod(shifts[:, np.newaxis] + shifts[np.newaxis, :], num_bins)].dot(histogram)
+    best_candidate = int(np.argmin(candidate_costs))
+
+    shifted = wrap_ticks(residuals + best_candidate)
+    inliers = np.abs(shifted) <= clip_ticks
+    fixed_diff = best_candidate - np.median(shifted[inliers])
+    fixed_diff = float(np.mod(fixed_diff, abs_ticks_per_rotation))
+    disagreement = float(np.median(np.abs(wrap_ticks(residuals + fixed_diff))))
+
+    return AbsOffsetEstimate(fixed_diff, disagreement, len(residuals))
+
+
+def session_abs_encoder_fixed_diff(encoder_timestamps, abs_encoder_1_ticks, abs_encoder_2_ticks,
+                                   encoder_1_ticks, encoder_2_ticks, brake_timestamps, brake_current,
+                                   margin_mA=default_unloaded_margin_mA):
+    """estimate_abs_encoder_fixed_diff over a session's unloaded samples"""
+    mask = unloaded_mask(encoder_timestamps, brake_timestamps, brake_current, margin_mA)
+    return estimate_abs_encoder_fixed_diff(abs_encoder_1_ticks, abs_encoder_2_ticks, encoder_1_ticks,
+                                           encoder_2_ticks, mask)
+
+
+def format_estimate(estimate):
+    return "%0.2f ticks (median disagreement %0.2f ticks over %s unloaded samples)" % (
+        estimate.fixed_diff, estimate.disagreement_ticks, estimate.num_samples)
+
+
+if __name__ == '__main__':
+    def test():
+        import time
+
+        random = np.random.RandomState(0)
+        fixed_diff = 259.0
+        num_samples = 200000
+        timestamps = np.arange(num_samples) * 0.01
+        brake_timestamps = np.arange(0.0, timestamps[-1], 0.1)
+        brake_current = np.where(brake_timestamps < 300.0, 0.0, 150.0) + random.normal(0.0, 1.0,
+                                                                                       len(brake_timestamps))
+
+        encoder_1_rad = np.cumsum(random.normal(0.0, 0.01, num_samples))
+        loaded = np.interp(timestamps, brake_timestamps, brake_current) > 75.0
+        encoder_2_rad = encoder_1_rad - np.where(loaded, 0.3, 0.0) - random.normal(0.0, 0.002, num_samples)
+
+        encoder_1_ticks = np.round(encoder_1_rad / rel_enc_ticks_to_rad)
+        encoder_2_ticks = np.round(encoder_2_rad / rel_enc_ticks_to_rad)
+        abs_encoder_1_ticks = np.mod(np.round(encoder_1_rad / abs_enc_ticks_to_rad), abs_ticks_per_rotation)
+        abs_encoder_2_ticks = np.round(encoder_2_rad / abs_enc_ticks_to_rad + fixed_diff)
+        glitches = random.uniform(size=num_samples) < 0.01
+        abs_encoder_2_ticks[glitches] += random.uniform(310.0, 714.0, np.count_nonzero(glitches)).round()
+        abs_encoder_2_ticks = np.mod(abs_encoder_2_ticks, abs_ticks_per_rotation)
+
+        t0 = time.time()
+        estimate = session_abs_encoder_fixed_diff(timestamps, abs_encoder_1_ticks, abs_encoder_2_ticks,
+                                                  encoder_1_ticks, encoder_2_ticks, brake_timestamps, brake_current)
+        print("estimated %s in %0.3fs" % (format_estimate(estimate), time.time() - t0))
+        assert abs(estimate.fixed_diff - fixed_diff) < 0.5, estimate
+
+        # the incremental deflection follows the load, so loaded samples agree as well when the encoders are ideal
+        everything = estimate_abs_encoder_fixed_diff(abs_encoder_1_ticks, abs_encoder_2_ticks,
+                                                     encoder_1_ticks, encoder_2_ticks)
+        assert abs(everything.fixed_diff - fixed_diff) < 0.5, everything
+
+    test()
@@ -0,0 +1,318 @@
+import math
+from collections import namedtuple
+
+import numpy as np
+
+from .k_calculator_helpers import *
+from .k_pipeline import basklash_time_compensation, shared_abs_zeros
+from .abs_encoder_calibration import unloaded_mask, estimate_abs_encoder_fixed_diff
+
+# one piece of a session's encoder stream. Timestamps as DataAggregator records them, before rebasing
+EncoderChunk = namedtuple(
+    "EncoderChunk",
+
+    "timestamps "
+    "abs_encoder_1_ticks "
+    "abs_encoder_2_ticks "
+    "encoder_1_ticks "
+    "encoder_2_ticks "
+    "motor_encoder_ticks "
+)
+
+default_chunk_size = 2 ** 16
+
+smoothing_window_size = 501
+smoothing_order = 5
+
+
+class NearestIndex:
+    """np.abs(values - target).argmin() over values that arrive in pieces"""
+
+    def __init__(self, target):
+        self.target = target
+        self.index = 0
+        self.distance = None
+
+    def update(self, values, offset):
+        """Returns the index into values if it holds a new closest value, otherwise None"""
+        if len(values) == 0:
+            return None
+        distances = np.abs(values - self.target)
+        local_index = distances.argmin()
+        # strictly closer, so ties go to the first occurrence like argmin
+        if self.distance is None or distances[local_index] < self.distance:
+            self.distance = distances[local_index]
+            self.index = offset + local_index
+            return local_index
+        return None
+
+
+class StreamingSavitzkyGolay:
+    """savitzky_golay(y, window_size, order) for a y that arrives in pieces. Outputs trail inputs by half a window
+    and never more than window_size samples are held"""
+
+    def __init__(self, window_size, order):
+        self.window_size = window_size
+        self.order = order
+        self.kernel = savitzky_golay_coefficients(window_size, order)[::-1]
+        self.half_window = (window_size - 1) // 2
+
+        # raw samples held back until there are enough to pad the start of the signal
+        self.head = []
+        self.started = False
+        self.pending = np.empty(0)
+        self.tail = np.empty(0)
+
+    def push(self, y):
+        if not self.started:
+            self.head.append(y)
+            y = np.concatenate(self.head)
+            if len(y) < self.half_window + 1:
+                return np.empty(0)
+            self.head = []
+            self.started = True
+            firstvals = y[0] - np.abs(y[1:self.half_window + 1][::-1] - y[0])
+            padded = np.concatenate((firstvals, y))
+        else:
+            padded = y
+
+        self.tail = np.concatenate((self.tail, y))[-(self.half_window + 1):]
+        return self.convolve(padded)
+
+    def convolve(self, padded):
+        self.pending = np.concatenate((self.pending, padded))
+        if len(self.pending) < len(self.kernel):
+            return np.empty(0)
+        smoothed = np.convolve(self.kernel, self.pending, mode='valid')
+        self.pending = self.pending[len(smoothed):]
+        return smoothed
+
+    def finish(self):
+        if not self.started:
+            # too short to have been padded, the whole signal is still here
+            if len(self.head) == 0:
+                return np.empty(0)
+            return savitzky_golay(np.concatenate(self.head), self.window_size, self.order)
+
+        y = self.tail
+        lastvals = y[-1] + np.abs(y[-self.half_window - 1:-1][::-1] - y[-1])
+        return self.convolve(lastvals)
+
+
+class BrakeTimestampSampler:
+    """interpolate_to_timestamps for encoder values that arrive in pieces"""
+
+    def __init__(self, brake_timestamps):
+        self.brake_timestamps = brake_timestamps.tolist()
+        self.values = np.empty(len(brake_timestamps))
+        self.brake_index = 0
+        self.last_value = 0.0
+
+    def push(self, encoder_timestamps, encoder_delta):
+        if len(encoder_timestamps) == 0:
+            return
+        # plain lists index much faster than arrays in this loop
+        encoder_timestamps = encoder_timestamps.tolist()
+        encoder_delta = encoder_delta.tolist()
+        num_samples = len(encoder_timestamps)
+
+        position = 0
+        while self.brake_index < len(self.brake_timestamps):
+            brake_t = self.brake_timestamps[self.brake_index]
+            while position < num_samples and encoder_timestamps[position] < brake_t:
+                position += 1
+            if position >= num_samples:
+                # the sample for this brake timestamp is in a later chunk
+                break
+            self.values[self.brake_index] = encoder_delta[position]
+            self.brake_index += 1
+
+        self.last_value = encoder_delta[-1]
+
+    def finish(self):
+        # brake timestamps past the last encoder sample get its value
+        self.values[self.brake_index:] = self.last_value
+        return self.values
+
+
+def array_encoder_chunks(chunk_size, timestamps, abs_encoder_1_ticks, abs_encoder_2_ticks,
+                         encoder_1_ticks, encoder_2_ticks, motor_encoder_ticks):
+    """Chunk source for a session that's already in memory"""
+    columns = (timestamps, abs_encoder_1_ticks, abs_encoder_2_ticks, encoder_1_ticks, encoder_2_ticks,
+               motor_encoder_ticks)
+
+    def chunks():
+        for start in range(0, len(timestamps), chunk_size):
+            yield EncoderChunk(*[np.asarray(column[start: start + chunk_size]) for column in columns])
+
+    return chunks
+
+
+def log_encoder_chunks(path, chunk_size=default_chunk_size):
+    """Chunk source that parses an encoder log each time it's iterated. Only one chunk of packets is held at a time"""
+    from data_processing.log_parser import iter_packets
+
+    def chunks():
+        encoder_start_time = None
+        rows = []
+        for packet in iter_packets(path, "enc"):
+            if encoder_start_time is None:
+                # same as DataAggregator.encoders_callback
+                encoder_start_time = packet.receive_time - packet.timestamp
+            rows.append([packet.timestamp + encoder_start_time] + list(packet.data[2:7]))
+            if len(rows) == chunk_size:
+                yield EncoderChunk(*np.array(rows, dtype=float).T)
+                rows = []
+        if len(rows) > 0:
+            yield EncoderChunk(*np.array(rows, dtype=float).T)
+
+    return chunks
+
+
+def chunked_compute_k(torque_table, encoder_chunks, brake_timestamps, brake_current,
+                      experiment_start_time, experiment_stop_time, motor_direction_switch_time,
+                      use_abs_encoders, enable_smoothing, abs_encoder_fixed_diff):
+    """Same K and backlash as DataAggregator.teardown + compute_k without ever holding the encoder stream.
+
+    encoder_chunks is a function returning a fresh iterator of EncoderChunks, it's called twice. The first pass only
+    finds where the experiment starts and stops, the second unwraps, smooths and samples the encoder delta at the
+    brake timestamps. Everything at the brake's 10 Hz is kept whole, so memory goes with the brake stream and the
+    chunk size instead of the encoder stream. The returned ResultInfo has no encoder_timestamps or encoder_delta.
+    With abs_encoder_fixed_diff as None the first pass also keeps the unloaded samples and estimates it from those,
+    like analyze_session does.
+    """
+    brake_timestamps = np.asarray(brake_timestamps, dtype=float)
+    brake_current = np.asarray(brake_current, dtype=float)
+
+    # first pass: session epoch, experiment start and stop indices, and where to zero the absolute encoders
+    session_epoch = None
+    enc_start = enc_stop = exp_start = None
+    abs_zero_1 = abs_zero_2 = 0.0
+    estimate_fixed_diff = use_abs_encoders and abs_encoder_fixed_diff is None
+    unloaded_columns = []
+    unwrapper_1 = AbsTickUnwrapper(abs_ticks_per_rotation, 0.0)
+    # fixed_diff only shifts the unwrapped ticks, an estimated one comes off the zero once it's known
+    unwrapper_2 = AbsTickUnwrapper(abs_ticks_per_rotation, 0.0 if estimate_fixed_diff else abs_encoder_fixed_diff)
+    offset = 0
+    for chunk in encoder_chunks():
+        if session_epoch is None:
+            session_epoch = chunk.timestamps[0]
+            experiment_start_time -= session_epoch
+            experiment_stop_time -= session_epoch
+            motor_direction_switch_time -= session_epoch
+            brake_timestamps = brake_timestamps - session_epoch
+
+            exp_start = NearestIndex(experiment_start_time + basklash_time_compensation)
+            if use_abs_encoders:
+                experiment_start_time += basklash_time_compensation
+            enc_start = NearestIndex(experiment_start_time)
+            enc_stop = NearestIndex(experiment_stop_time)
+
+        timestamps = chunk.timestamps - session_epoch
+        enc_start.update(timestamps, offset)
+        enc_stop.update(timestamps, offset)
+        if estimate_fixed_diff:
+            mask = unloaded_mask(timestamps, brake_timestamps, brake_current)
+            unloaded_columns.append([column[mask] for column in chunk[1:5]])
+        if use_abs_encoders:
+            abs_encoder_1_ticks = unwrapper_1.unwrap(chunk.abs_encoder_1_ticks)
+            abs_encoder_2_ticks = unwrapper_2.unwrap(chunk.abs_encoder_2_ticks)
+            local_index = exp_start.update(timestamps, offset)
+            if local_index is not None:
+                abs_zero_1 = abs_encoder_1_ticks[local_index]
+                abs_zero_2 = abs_encoder_2_ticks[local_index]
+        offset += len(timestamps)
+
+    if session_epoch is None:
+        raise ValueError("Session has no encoder data")
+
+    if estimate_fixed_diff:
+        if len(unloaded_columns) > 0:
+            unloaded = [np.concatenate(column) for column in zip(*unloaded_columns)]
+        else:
+            unloaded = [np.empty(0)] * 4
+        # raises the calibration's ValueError when none of it was unloaded
+        abs_encoder_fixed_diff = estimate_abs_encoder_fixed_diff(*unloaded).fixed_diff
+        abs_zero_1, abs_zero_2 = shared_abs_zeros(abs_zero_1, abs_zero_2 - abs_encoder_fixed_diff)
+
+    if use_abs_encoders:
+        enc_ticks_to_rad = abs_enc_ticks_to_rad
+    else:
+        enc_ticks_to_rad = rel_enc_ticks_to_rad
+
+    # the brake side is small enough to handle the same way compute_k does
+    brake_start_index = (np.abs(brake_timestamps - experiment_start_time)).argmin()
+    brake_stop_index = (np.abs(brake_timestamps - experiment_stop_time)).argmin()
+    brake_timestamps = brake_timestamps[brake_start_index:brake_stop_index]
+    brake_current = brake_current[brake_start_index:brake_stop_index]
+
+    motor_direction_switch_brake_index = (np.abs(brake_timestamps - motor_direction_switch_time)).argmin()
+    brake_ramp_transition_indices = get_brake_ramp_transitions(brake_current)
+    assert motor_direction_switch_brake_index > brake_ramp_transition_indices[0], motor_direction_switch_brake_index
+    brake_torque_nm = brake_current_to_torque(torque_table, brake_current, brake_ramp_transition_indices,
+                                              motor_direction_switch_brake_index)
+
+    # second pass: stream the sliced encoder data
+    switch_index = NearestIndex(motor_direction_switch_time)
+    backlash_sum = 0.0
+    forward_backlash_sum = 0.0
+    num_samples = 0
+
+    smoother = StreamingSavitzkyGolay(smoothing_window_size, smoothing_order) if enable_smoothing else None
+    pending_timestamps = np.empty(0)
+    sampler = BrakeTimestampSampler(brake_timestamps)
+
+    unwrapper_1 = AbsTickUnwrapper(abs_ticks_per_rotation, 0.0)
+    unwrapper_2 = AbsTickUnwrapper(abs_ticks_per_rotation, abs_encoder_fixed_diff)
+    offset = 0
+    for chunk in encoder_chunks():
+        chunk_start = offset
+        offset += len(chunk.timestamps)
+
+        if use_abs_encoders:
+            # unwrapping has to see the whole session, not just the slice
+            encoder_1_ticks = np.array(unwrapper_1.unwrap(chunk.abs_encoder_1_ticks)) - abs_zero_1
+            encoder_2_ticks = np.array(unwrapper_2.unwrap(chunk.abs_encoder_2_ticks)) - abs_zero_2
+        else:
+            encoder_1_ticks = chunk.encoder_1_ticks
+            encoder_2_ticks = chunk.encoder_2_ticks
+
+        low = max(enc_start.index - chunk_start, 0)
+        high = min(enc_stop.index - chunk_start, len(chunk.timestamps))
+        if low >= high:
+            continue
+
+        timestamps = chunk.timestamps[low:high] - session_epoch
+        encoder_1_ticks = encoder_1_ticks[low:high]
+        encoder_2_ticks = encoder_2_ticks[low:high]
+
+        backlash_delta = encoder_1_ticks * enc_ticks_to_rad - chunk.motor_encoder_ticks[low:high] * motor_enc_ticks_to_rad
+        local_index = switch_index.update(timestamps, num_samples)
+        if local_index is not None:
+            forward_backlash_sum = backlash_sum + np.sum(backlash_delta[:local_index])
+        backlash_sum += np.sum(backlash_delta)
+        num_samples += len(timestamps)
+
+        encoder_delta = (encoder_1_ticks - encoder_2_ticks) * enc_ticks_to_rad
+        if smoother is None:
+            sampler.push(timestamps, encoder_delta)
+        else:
+            pending_timestamps = np.concatenate((pending_timestamps, timestamps))
+            smoothed = smoother.push(encoder_delta)
+            sampler.push(pending_timestamps[:len(smoothed)], smoothed)
+            pending_timestamps = pending_timestamps[len(smoothed):]
+
+    if smoother is not None:
+        sampler.push(pending_timestamps, smoother.finish())
+
+    encoder_interp_delta = sampler.finish()
+    encoder_lin_reg, polynomial = compute_linear_regression(encoder_interp_delta, brake_torque_nm)
+
+    num_forward = switch_index.index
+    num_backward = num_samples - num_forward
+    motor_forward_backlash = forward_backlash_sum / num_forward if num_forward > 0 else math.nan
+    motor_backward_backlash = (backlash_sum - forward_backlash_sum) / num_backward if num_backward > 0 else math.nan
+
+    return ResultInfo(None, None, encoder_interp_delta, encoder_lin_reg,
+                      brake_timestamps, brake_current, brake_ramp_transition_indices, brake_torque_nm, polynomial,
+                      motor_forward_backlash, motor_backward_backlash)
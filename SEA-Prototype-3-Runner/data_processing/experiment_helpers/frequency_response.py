@@ -0,0 +1,322 @@
+import math
+from collections import namedtuple
+
+import numpy as np
+
+from .encoder_constants import rel_enc_ticks_to_rad
+
+FrequencyResponse = namedtuple(
+    "FrequencyResponse",
+
+    "frequencies "  # Hz
+    "transfer "  # complex deflection / torque, rad/Nm
+    "magnitude "  # |transfer|
+    "phase "  # rad
+    "coherence "
+    "stiffness "  # Nm/rad, from the fit of torque / deflection = stiffness + i * 2 * pi * f * damping
+    "damping "  # Nm s/rad
+    "num_segments "
+    "fit_mask "  # frequencies the fit used
+)
+
+# the brake reports its current at 10Hz, there's nothing to resolve in the torque above that
+default_sample_rate = 10.0
+# 25.6s segments at 10Hz, 0.04Hz resolution
+default_segment_size = 256
+
+
+def segment_detrend(segments, detrend):
+    """Remove each row's mean (constant) or least squares line (linear) in one pass"""
+    if detrend is None:
+        return segments
+    segments = segments - np.mean(segments, axis=1, keepdims=True)
+    if detrend == "linear":
+        ramp = np.arange(segments.shape[1]) - (segments.shape[1] - 1) / 2.0
+        slopes = segments @ ramp / (ramp @ ramp)
+        segments = segments - slopes[:, np.newaxis] * ramp
+    elif detrend != "constant":
+        raise ValueError("Unknown detrend '%s'. Choose from None, 'constant' or 'linear'" % detrend)
+    return segments
+
+
+class WelchAccumulator:
+    """Running sums of Hann windowed input, output and cross spectra.
+
+    Records are fed through add() in any number of pieces. The last segment_size - step samples of one piece are
+    kept so segments line up the same as if the whole record came in at once. Segments are transformed
+    batch_size at a time as one (batch_size, segment_size) rfft, which keeps memory flat for long records.
+    Call end_record() between unrelated records (sessions) so no segment straddles them.
+    """
+
+    def __init__(self, sample_rate=default_sample_rate, segment_size=default_segment_size, overlap=0.5,
+                 detrend="linear", batch_size=512):
+        self.sample_rate = sample_rate
+        self.segment_size = segment_size
+        self.step = max(int(round(segment_size * (1.0 - overlap))), 1)
+        self.detrend = detrend
+        self.batch_size = batch_size
+
+        self.window = np.hanning(segment_size)
+        self.frequencies = np.fft.rfftfreq(segment_size, 1.0 / sample_rate)
+
+        self.sum_xx = np.zeros(len(self.frequencies))
+        self.sum_yy = np.zeros(len(self.frequencies))
+        self.sum_xy = np.zeros(len(self.frequencies), dtype=complex)
+        self.num_segments = 0
+
+        self.tail_x = np.zeros(0)
+        self.tail_y = np.zeros(0)
+
+    def add(self, x, y):
+        x = np.concatenate((self.tail_x, np.asarray(x, dtype=float)))
+        y = np.concatenate((self.tail_y, np.asarray(y, dtype=float)))
+        if len(x) != len(y):
+            raise ValueError("Input and output have different lengths: %s != %s" % (len(x), len(y)))
+
+        num_segments = 0
+        if len(x) >= self.segment_size:
+            num_segments = (len(x) - self.segment_size) // self.step + 1
+            x_segments = np.lib.stride_tricks.sliding_window_view(x, self.segment_size)[::self.step]
+            y_segments = np.lib.stride_tricks.sliding_window_view(y, self.segment_size)[::self.step]
+            for start in range(0, num_segments, self.batch_size):
+                self.add_segments(x_segments[start:start + self.batch_size], y_segments[start:start + self.batch_size])
+
+        # everything the next segment will need
+        keep_from = num_segments * self.step
+        self.tail_x = x[keep_from:]
+        self.tail_y = y[keep_from:]
+
+    def add_segments(self, x_segments, y_segments):
+        x_spectra = np.fft.rfft(segment_detrend(x_segments, self.detrend) * self.window, axis=1)
+        y_spectra = np.fft.rfft(segment_detrend(y_segments, self.detrend) * self.window, axis=1)
+        self.sum_xx += np.sum(x_spectra.real ** 2 + x_spectra.imag ** 2, axis=0)
+        self.sum_yy += np.sum(y_spectra.real ** 2 + y_spectra.imag ** 2, axis=0)
+        self.sum_xy += np.sum(np.conj(x_spectra) * y_spectra, axis=0)
+        self.num_segments += len(x_segments)
+
+    def end_record(self):
+        self.tail_x = np.zeros(0)
+        self.tail_y = np.zeros(0)
+
+    def merge(self, other):
+        """Pool another accumulator's segments into this one, as if they'd all been added here"""
+        if other.segment_size != self.segment_size or other.sample_rate != self.sample_rate:
+            raise ValueError("Can't merge spectra with different segment sizes or sample rates")
+        self.sum_xx += other.sum_xx
+        self.sum_yy += other.sum_yy
+        self.sum_xy += other.sum_xy
+        self.num_segments += other.num_segments
+
+    def response(self, min_coherence=0.6, min_frequency=None, max_frequency=None):
+        """H1 estimate (cross spectrum over input spectrum) and the spring damper fit to it"""
+        if self.num_segments == 0:
+            raise ValueError("Need at least %s samples (%0.1fs) for a segment" % (
+                self.segment_size, self.segment_size / self.sample_rate))
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            transfer = self.sum_xy / self.sum_xx
+            coherence = np.abs(self.sum_xy) ** 2 / (self.sum_xx * self.sum_yy)
+        transfer = np.nan_to_num(transfer)
+        coherence = np.nan_to_num(coherence)
+
+        # the first bin is whatever detrending left over
+        fit_mask = (self.frequencies > 0.0) & (coherence >= min_coherence) & (np.abs(transfer) > 0.0)
+        if min_frequency is not None:
+            fit_mask &= self.frequencies >= min_frequency
+        if max_frequency is not None:
+            fit_mask &= self.frequencies <= max_frequency
+        stiffness, damping = fit_spring_damper(self.frequencies[fit_mask], transfer[fit_mask], coherence[fit_mask])
+
+        return FrequencyResponse(
+            self.frequencies, transfer, np.abs(transfer), np.angle(transfer), coherence,
+            stiffness, damping, self.num_segments, fit_mask
+        )
+
+
+def fit_spring_damper(frequencies, transfer, coherence):
+    """Kelvin-Voigt fit: torque / deflection = stiffness + i * omega * damping.
+
+    The real part of the dynamic stiffness gives the spring, the imaginary part over omega the damper. Each
+    frequency is weighted by coherence / (1 - coherence), which goes like the inverse variance of an H1 estimate.
+    Returns (nan, nan) if no frequency is good enough to fit.
+    """
+    if len(frequencies) == 0:
+        return math.nan, math.nan
+    dynamic_stiffness = 1.0 / transfer
+    omega = 2.0 * np.pi * frequencies
+    weights = coherence / np.maximum(1.0 - coherence, 1E-6)
+
+    stiffness = np.sum(weights * dynamic_stiffness.real) / np.sum(weights)
+    damping = np.sum(weights * omega * dynamic_stiffness.imag) / np.sum(weights * omega ** 2)
+    return float(stiffness), float(damping)
+
+
+def bin_average(timestamps, values, start, sample_rate, num_samples):
+    """Mean of values falling in each 1 / sample_rate wide bin starting at start. Bins with nothing in them are
+    interpolated from their neighbors. Averaging instead of picking samples keeps the 100Hz encoder noise from
+    aliasing down onto the grid"""
+    indices = np.floor((timestamps - start) * sample_rate).astype(np.int64)
+    in_range = (indices >= 0) & (indices < num_samples)
+    indices = indices[in_range]
+    counts = np.bincount(indices, minlength=num_samples)
+    sums = np.bincount(indices, weights=values[in_range], minlength=num_samples)
+
+    filled = counts > 0
+    if not np.any(filled):
+        raise ValueError("No samples between %0.2f and %0.2f" % (start, start + num_samples / sample_rate))
+    centers = start + (np.arange(num_samples) + 0.5) / sample_rate
+    averages = np.zeros(num_samples)
+    averages[filled] = sums[filled] / counts[filled]
+    if not np.all(filled):
+        averages[~filled] = np.interp(centers[~filled], centers[filled], averages[filled])
+    return averages
+
+
+def forcing_from_current(brake_current, deadband_mA=5.0):
+    """True while the current is going up. Sensed current is noisy, so the direction only flips once the current
+    has come back more than deadband_mA from its peak (or valley). A loop, but only over 10Hz brake samples"""
+    is_forcing = np.empty(len(brake_current), dtype=bool)
+    forcing = True
+    extreme = brake_current[0] if len(brake_current) > 0 else 0.0
+    for index, current in enumerate(brake_current):
+        if forcing:
+            if current > extreme:
+                extreme = current
+            elif current < extreme - deadband_mA:
+                forcing = False
+                extreme = current
+        else:
+            if current < extreme:
+                extreme = current
+            elif current > extreme + deadband_mA:
+                forcing = True
+                extreme = current
+        is_forcing[index] = forcing
+    return is_forcing
+
+
+def signed_brake_torque(torque_table, brake_timestamps, brake_current, motor_direction_switch_time=0.0,
+                        is_forcing=None):
+    """Brake torque (Nm) on the forcing or unforcing curve, negative once the motor has switched direction
+    (brake_current_to_torque does the same per ramp)"""
+    brake_current = np.asarray(brake_current, dtype=float)
+    if is_forcing is None:
+        is_forcing = forcing_from_current(brake_current)
+    torque = np.where(is_forcing, torque_table.to_torque(True, brake_current),
+                      torque_table.to_torque(False, brake_current))
+    if motor_direction_switch_time > 0.0:
+        torque = np.where(np.asarray(brake_timestamps) >= motor_direction_switch_time, -torque, torque)
+    return torque
+
+
+def resample_session(encoder_timestamps, encoder_delta, brake_timestamps, brake_torque,
+                     sample_rate=default_sample_rate, start_time=None, stop_time=None):
+    """Torque and deflection on one uniform grid over the time both streams cover.
+    Returns (grid timestamps, torque, deflection)"""
+    start = max(encoder_timestamps[0], brake_timestamps[0])
+    stop = min(encoder_timestamps[-1], brake_timestamps[-1])
+    if start_time is not None:
+        start = max(start, start_time)
+    if stop_time is not None:
+        stop = min(stop, stop_time)
+    num_samples = int((stop - start) * sample_rate)
+    if num_samples <= 0:
+        raise ValueError("Encoder and brake streams don't overlap")
+
+    timestamps = start + np.arange(num_samples) / sample_rate
+    deflection = bin_average(np.asarray(encoder_timestamps, dtype=float), np.asarray(encoder_delta, dtype=float),
+                             start, sample_rate, num_samples)
+    # bin centers, where the averaged deflection is
+    torque = np.interp(timestamps + 0.5 / sample_rate, brake_timestamps, brake_torque)
+    return timestamps, torque, deflection
+
+
+def session_frequency_response(torque_table, encoder_timestamps, encoder_delta, brake_timestamps, brake_current,
+                               motor_direction_switch_time=0.0, start_time=None, stop_time=None,
+                               sample_rate=default_sample_rate, segment_size=default_segment_size,
+                               min_coherence=0.6, max_frequency=None, accumulator=None):
+    """Torque to deflection transfer function of one session.
+
+    encoder_delta is the deflection in rad ((encoder 1 - encoder 2) * rel_enc_ticks_to_rad), on the same clock as
+    brake_timestamps. With accumulator, the session's segments are also pooled into it.
+    """
+    torque = signed_brake_torque(torque_table, brake_timestamps, brake_current, motor_direction_switch_time)
+    _, torque, deflection = resample_session(encoder_timestamps, encoder_delta, brake_timestamps, torque,
+                                             sample_rate, start_time, stop_time)
+
+    session = WelchAccumulator(sample_rate, segment_size)
+    session.add(torque, deflection)
+    if accumulator is not None:
+        accumulator.merge(session)
+    return session.response(min_coherence, max_frequency=max_frequency)
+
+
+def batch_frequency_response(torque_table, sessions, sample_rate=default_sample_rate,
+                             segment_size=default_segment_size, min_coherence=0.6, max_frequency=None):
+    """sessions is an iterable of objects laid out like benchmarks.fixtures.BenchmarkSession. Returns the response
+    of each session (None for ones too short for a segment) and of all of them pooled"""
+    pooled = WelchAccumulator(sample_rate, segment_size)
+    responses = []
+    for session in sessions:
+        encoder_delta = (session.encoder_1_ticks - session.encoder_2_ticks) * rel_enc_ticks_to_rad
+        try:
+            responses.append(session_frequency_response(
+                torque_table, session.encoder_timestamps, encoder_delta,
+                session.brake_timestamps, session.brake_current, session.motor_direction_switch_time,
+                session.experiment_start_time, session.experiment_stop_time,
+                sample_rate, segment_size, min_coherence, max_frequency, accumulator=pooled
+            ))
+        except ValueError:
+            responses.append(None)
+    pooled_response = pooled.response(min_coherence, max_frequency=max_frequency) if pooled.num_segments else None
+    return responses, pooled_response
+
+
+def format_response(response):
+    used = response.fit_mask
+    if not np.any(used):
+        return "no frequency with coherence high enough to fit (%s segments)" % response.num_segments
+    return "stiffness %0.4fNm/rad, damping %0.5fNm s/rad from %s bins in %0.2f..%0.2fHz, " \
+           "mean coherence %0.2f over %s segments" % (
+               response.stiffness, response.damping, np.count_nonzero(used),
+               response.frequencies[used][0], response.frequencies[used][-1],
+               np.mean(response.coherence[used]), response.num_segments)
+
+
+if __name__ == '__main__':
+    def test():
+        random = np.random.RandomState(2)
+        stiffness = 5.0
+        damping = 0.3
+        sample_rate = 10.0
+
+        # periodic random torque through torque / deflection = k + i omega c, plus measurement noise
+        num_samples = 2 ** 15
+        torque = random.normal(0.0, 1.0, num_samples)
+        omega = 2.0 * np.pi * np.fft.rfftfreq(num_samples, 1.0 / sample_rate)
+        deflection = np.fft.irfft(np.fft.rfft(torque) / (stiffness + 1j * omega * damping), num_samples)
+        deflection += random.normal(0.0, 0.002, num_samples)
+
+        whole = WelchAccumulator(sample_rate, 256)
+        whole.add(torque, deflection)
+        response = whole.response()
+        print(format_response(response))
+        assert abs(response.stiffness - stiffness) < 0.05, response.stiffness
+        assert abs(response.damping - damping) < 0.01, response.damping
+        expected_phase = -np.arctan2(omega[::num_samples // 256] * damping, stiffness)
+        assert np.allclose(response.phase[1:50], expected_phase[1:50], atol=0.02)
+
+        # feeding the record in uneven pieces gives the same sums, batching doesn't change them either
+        pieces = WelchAccumulator(sample_rate, 256, batch_size=7)
+        for start, stop in ((0, 100), (100, 5000), (5000, 5001), (5001, num_samples)):
+            pieces.add(torque[start:stop], deflection[start:stop])
+        assert pieces.num_segments == whole.num_segments, (pieces.num_segments, whole.num_segments)
+        assert np.allclose(pieces.sum_xy, whole.sum_xy)
+        assert np.allclose(pieces.sum_xx, whole.sum_xx)
+
+        # bin averaging a 100Hz stream onto the 10Hz grid
+        timestamps = np.arange(0.0, 10.0, 0.01)
+        averages = bin_average(timestamps, timestamps, 0.0, 10.0, 100)
+        assert np.allclose(averages, np.arange(100) / 10.0 + 0.045), averages[:3]
+
+    test()
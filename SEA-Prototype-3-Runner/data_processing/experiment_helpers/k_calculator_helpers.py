@@ -1,8 +1,9 @@
 import math
-import peakutils
 import numpy as np
 from collections import namedtuple
 
+from .encoder_constants import *
+
 ResultInfo = namedtuple(
     "ResultInfo",
 
@@ -20,17 +21,10 @@ ResultInfo = namedtuple(
 )
 
 
-rel_enc_ticks_to_rad = 2 * math.pi / 2000.0
-motor_enc_ticks_to_rad = 2 * math.pi / (131.25 * 64)
-abs_gear_ratio = 48.0 / 32.0
-abs_ticks_per_rotation = 1024.0
-abs_enc_ticks_to_rad = 2 * math.pi / abs_ticks_per_rotation * abs_gear_ratio
-
-
-def savitzky_golay(y, window_size, order, deriv=0, rate=1):
+def savitzky_golay_coefficients(window_size, order, deriv=0, rate=1):
     try:
-        window_size = np.abs(np.int(window_size))
-        order = np.abs(np.int(order))
+        window_size = abs(int(window_size))
+        order = abs(int(order))
     except ValueError:
         raise ValueError("window_size and order have to be of type int")
 
@@ -43,8 +37,13 @@ def savitzky_golay(y, window_size, order, deriv=0, rate=1):
     order_range = range(order + 1)
     half_window = (window_size - 1) // 2
     # precompute coefficients
-    b = np.mat([[k ** i for i in order_range] for k in range(-half_window, half_window + 1)])
-    m = np.linalg.pinv(b).A[deriv] * rate ** deriv * math.factorial(deriv)
+    b = np.array([[k ** i for i in order_range] for k in range(-half_window, half_window + 1)], dtype=float)
+    return np.linalg.pinv(b)[deriv] * rate ** deriv * math.factorial(deriv)
+
+
+def savitzky_golay(y, window_size, order, deriv=0, rate=1):
+    m = savitzky_golay_coefficients(window_size, order, deriv, rate)
+    half_window = (len(m) - 1) // 2
     # pad the signal at the extremes with
     # values taken from the signal itself
     firstvals = y[0] - np.abs(y[1:half_window + 1][::-1] - y[0])
@@ -54,6 +53,8 @@ def savitzky_golay(y, window_size, order, deriv=0, rate=1):
 
 
 def get_brake_ramp_transitions(brake_current):
+    import peakutils  # pulls in scipy, only load it when an analysis actually needs it
+
     brake_ramp_transition_indices = peakutils.indexes(brake_current, thres=0.9, min_dist=500)
     assert len(brake_ramp_transition_indices) == 2, len(brake_ramp_transition_indices)
     return brake_ramp_transition_indices
@@ -68,9 +69,19 @@ def get_motor_dir_transistion(brake_timestamps, enc_timestamps, motor_direction_
 
 def interpolate_encoder_values(encoder_timestamps, encoder_1_ticks, encoder_2_ticks, ticks_to_rad,
                                brake_timestamps, enable_smoothing):
+    encoder_delta = get_encoder_delta(encoder_1_ticks, encoder_2_ticks, ticks_to_rad, enable_smoothing)
+    encoder_interp_delta = interpolate_to_timestamps(encoder_timestamps, encoder_delta, brake_timestamps)
+    return encoder_interp_delta, encoder_delta
+
+
+def get_encoder_delta(encoder_1_ticks, encoder_2_ticks, ticks_to_rad, enable_smoothing):
     encoder_delta = (encoder_1_ticks - encoder_2_ticks) * ticks_to_rad
     if enable_smoothing:
         encoder_delta = savitzky_golay(encoder_delta, 501, 5)
+    return encoder_delta
+
+
+def interpolate_to_timestamps(encoder_timestamps, encoder_delta, brake_timestamps):
     encoder_interp_delta = []
 
     interp_enc_index = 0
@@ -85,7 +96,7 @@ def interpolate_encoder_values(encoder_timestamps, encoder_1_ticks, encoder_2_ti
 
         encoder_interp_delta.append(encoder_delta[enc_index])
 
-    return encoder_interp_delta, encoder_delta
+    return encoder_interp_delta
 
 
 def get_motor_backlash(base_encoder_ticks, motor_ticks, rel_ticks_to_rad, motor_ticks_to_rad,
@@ -104,45 +115,61 @@ def compute_linear_regression(encoder_interp_delta, brake_torque_nm):
     return encoder_lin_reg, polynomial
 
 
-def format_abs_enc_ticks(abs_enc_ticks, ticks_per_rotation, fixed_diff):
-    formatted_abs_ticks = []
-    prev_tick = 0.0
-    rotations = 0
-    for tick in abs_enc_ticks:
-        if 300 < tick - prev_tick < 950 or 300 < prev_tick - tick < 950:
-            tick = prev_tick
+class AbsTickUnwrapper:
+    """Turns absolute encoder readings into continuous ticks. Keeps its state between calls so a
+    session can be fed through in pieces"""
 
-        if tick - prev_tick > 950:
-            rotations -= 1
-        if prev_tick - tick > 950:
-            rotations += 1
+    def __init__(self, ticks_per_rotation, fixed_diff):
+        self.ticks_per_rotation = ticks_per_rotation
+        self.fixed_diff = fixed_diff
+        self.prev_tick = 0.0
+        self.rotations = 0
 
-        total_ticks = rotations * ticks_per_rotation + tick
-        total_ticks -= fixed_diff
-        formatted_abs_ticks.append(total_ticks)
-        prev_tick = tick
+    def unwrap(self, abs_enc_ticks):
+        formatted_abs_ticks = []
+        prev_tick = self.prev_tick
+        rotations = self.rotations
+        for tick in abs_enc_ticks:
+            if 300 < tick - prev_tick < 950 or 300 < prev_tick - tick < 950:
+                tick = prev_tick
 
-    return formatted_abs_ticks
+            if tick - prev_tick > 950:
+                rotations -= 1
+            if prev_tick - tick > 950:
+                rotations += 1
 
+            total_ticks = rotations * self.ticks_per_rotation + tick
+            total_ticks -= self.fixed_diff
+            formatted_abs_ticks.append(total_ticks)
+            prev_tick = tick
 
-def compute_k(torque_table,
-              encoder_timestamps, encoder_1_ticks, encoder_2_ticks, motor_enc_ticks,
-              brake_timestamps, brake_current,
-              motor_direction_switch_time, enc_ticks_to_rad, motor_ticks_to_rad, enable_smoothing,
-              start_time, stop_time):
+        self.prev_tick = prev_tick
+        self.rotations = rotations
+        return formatted_abs_ticks
+
+
+def format_abs_enc_ticks(abs_enc_ticks, ticks_per_rotation, fixed_diff):
+    return AbsTickUnwrapper(ticks_per_rotation, fixed_diff).unwrap(abs_enc_ticks)
+
+
+def slice_session(encoder_timestamps, encoder_1_ticks, encoder_2_ticks, motor_enc_ticks,
+                  brake_timestamps, brake_current, start_time, stop_time):
     enc_start_index = (np.abs(encoder_timestamps - start_time)).argmin()
     enc_stop_index = (np.abs(encoder_timestamps - stop_time)).argmin()
     brake_start_index = (np.abs(brake_timestamps - start_time)).argmin()
     brake_stop_index = (np.abs(brake_timestamps - stop_time)).argmin()
 
-    encoder_timestamps = encoder_timestamps[enc_start_index:enc_stop_index]
-    encoder_1_ticks = encoder_1_ticks[enc_start_index:enc_stop_index]
-    encoder_2_ticks = encoder_2_ticks[enc_start_index:enc_stop_index]
-    motor_enc_ticks = motor_enc_ticks[enc_start_index:enc_stop_index]
+    return (
+        encoder_timestamps[enc_start_index:enc_stop_index],
+        encoder_1_ticks[enc_start_index:enc_stop_index],
+        encoder_2_ticks[enc_start_index:enc_stop_index],
+        motor_enc_ticks[enc_start_index:enc_stop_index],
+        brake_timestamps[brake_start_index:brake_stop_index],
+        brake_current[brake_start_index:brake_stop_index],
+    )
 
-    brake_timestamps = brake_timestamps[brake_start_index:brake_stop_index]
-    brake_current = brake_current[brake_start_index:brake_stop_index]
 
+def segment_brake_ramps(brake_timestamps, encoder_timestamps, brake_current, motor_direction_switch_time):
     motor_direction_switch_brake_index, motor_direction_switch_enc_index = \
         get_motor_dir_transistion(brake_timestamps, encoder_timestamps, motor_direction_switch_time)
 
@@ -155,6 +182,38 @@ def compute_k(torque_table,
 
     assert motor_direction_switch_brake_index > brake_ramp_transition_indices[0], motor_direction_switch_brake_index
 
+    return brake_ramp_transition_indices, motor_direction_switch_brake_index, motor_direction_switch_enc_index
+
+
+def brake_current_to_torque(torque_table, brake_current, brake_ramp_transition_indices,
+                            motor_direction_switch_brake_index):
+    # convert sensed current to torque (Nm)
+    brake_current_forcing_forward = brake_current[0:brake_ramp_transition_indices[0]]
+    brake_current_unforcing_forward = brake_current[
+                                      brake_ramp_transition_indices[0]:motor_direction_switch_brake_index]
+    brake_current_forcing_backward = brake_current[
+                                     motor_direction_switch_brake_index:brake_ramp_transition_indices[1]]
+    brake_current_unforcing_backward = brake_current[brake_ramp_transition_indices[1]:]
+
+    btff = torque_table.to_torque(True, brake_current_forcing_forward)
+    btuf = torque_table.to_torque(False, brake_current_unforcing_forward)
+    btfb = -torque_table.to_torque(True, brake_current_forcing_backward)
+    btub = -torque_table.to_torque(False, brake_current_unforcing_backward)
+    return np.concatenate((btff, btuf, btfb, btub))
+
+
+def compute_k(torque_table,
+              encoder_timestamps, encoder_1_ticks, encoder_2_ticks, motor_enc_ticks,
+              brake_timestamps, brake_current,
+              motor_direction_switch_time, enc_ticks_to_rad, motor_ticks_to_rad, enable_smoothing,
+              start_time, stop_time):
+    encoder_timestamps, encoder_1_ticks, encoder_2_ticks, motor_enc_ticks, brake_timestamps, brake_current = \
+        slice_session(encoder_timestamps, encoder_1_ticks, encoder_2_ticks, motor_enc_ticks,
+                      brake_timestamps, brake_current, start_time, stop_time)
+
+    brake_ramp_transition_indices, motor_direction_switch_brake_index, motor_direction_switch_enc_index = \
+        segment_brake_ramps(brake_timestamps, encoder_timestamps, brake_current, motor_direction_switch_time)
+
     motor_forward_backlash, motor_backward_backlash = \
         get_motor_backlash(encoder_1_ticks, motor_enc_ticks, enc_ticks_to_rad, motor_ticks_to_rad,
                            motor_direction_switch_enc_index)
@@ -164,20 +223,8 @@ def compute_k(torque_table,
     )
 
     if brake_ramp_transition_indices is not None:
-        # convert sensed current to torque (Nm)
-        brake_current_forcing_forward = brake_current[0:brake_ramp_transition_indices[0]]
-        brake_current_unforcing_forward = brake_current[
-                                          brake_ramp_transition_indices[0]:motor_direction_switch_brake_index]
-        brake_current_forcing_backward = brake_current[
-                                         motor_direction_switch_brake_index:brake_ramp_transition_indices[1]]
-        brake_current_unforcing_backward = brake_current[brake_ramp_transition_indices[1]:]
-
-        btff = torque_table.to_torque(True, brake_current_forcing_forward)
-        btuf = torque_table.to_torque(False, brake_current_unforcing_forward)
-        btfb = -torque_table.to_torque(True, brake_current_forcing_backward)
-        btub = -torque_table.to_torque(False, brake_current_unforcing_backward)
-        brake_torque_nm = np.concatenate((btff, btuf, btfb, btub))
-
+        brake_torque_nm = brake_current_to_torque(torque_table, brake_current, brake_ramp_transition_indices,
+                                                  motor_direction_switch_brake_index)
         encoder_lin_reg, polynomial = compute_linear_regression(encoder_interp_delta, brake_torque_nm)
     else:
         brake_torque_nm = None
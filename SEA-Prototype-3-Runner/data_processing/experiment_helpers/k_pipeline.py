@@ -0,0 +1,180 @@
+from collections import namedtuple
+
+import numpy as np
+
+from .k_calculator_helpers import *
+from .abs_encoder_calibration import session_abs_encoder_fixed_diff
+
+# seconds after the experiment start to zero the absolute encoders at. Gives the motor time to take up its backlash
+basklash_time_compensation = 2.0
+
+KAnalysis = namedtuple(
+    "KAnalysis",
+
+    "result "
+    "encoder_timestamps "
+    "brake_timestamps "
+    "abs_encoder_1_ticks "
+    "abs_encoder_2_ticks "
+    "experiment_start_time "
+    "experiment_stop_time "
+    "enc_type_dir_name "
+    "abs_encoder_offset "
+)
+
+
+# Each stage takes the values of its inputs as positional arguments and its parameters as keywords.
+# Everything here has to be a pure function of those for the stage cache to be valid
+
+
+def unwrap_stage(abs_encoder_ticks, fixed_diff):
+    return np.array(format_abs_enc_ticks(abs_encoder_ticks, abs_ticks_per_rotation, fixed_diff))
+
+
+def abs_offset_stage(encoder_timestamps, abs_encoder_1_ticks, abs_encoder_2_ticks, encoder_1_ticks, encoder_2_ticks,
+                     brake_timestamps, brake_current):
+    return session_abs_encoder_fixed_diff(encoder_timestamps, abs_encoder_1_ticks, abs_encoder_2_ticks,
+                                          encoder_1_ticks, encoder_2_ticks, brake_timestamps, brake_current)
+
+
+def rebase_stage(encoder_timestamps, brake_timestamps, experiment_start_time, experiment_stop_time,
+                 motor_direction_switch_time):
+    session_epoch = encoder_timestamps[0]
+    return (
+        encoder_timestamps - session_epoch,
+        brake_timestamps - session_epoch,
+        experiment_start_time - session_epoch,
+        experiment_stop_time - session_epoch,
+        motor_direction_switch_time - session_epoch,
+    )
+
+
+def shared_abs_zeros(abs_encoder_1_tick, abs_encoder_2_tick):
+    """Zeros for encoders that are already lined up by their fixed_diff. Only the whole rotations between them
+    come out so the deflection at the zeroing sample is kept"""
+    rotations = np.round((abs_encoder_1_tick - abs_encoder_2_tick) / abs_ticks_per_rotation)
+    return abs_encoder_1_tick, abs_encoder_1_tick - rotations * abs_ticks_per_rotation
+
+
+def zero_abs_encoders_stage(rebased, abs_encoder_1_ticks, abs_encoder_2_ticks, shared_zero=False):
+    encoder_timestamps, _, experiment_start_time = rebased[0:3]
+    exp_start_index = (np.abs(encoder_timestamps - (experiment_start_time + basklash_time_compensation))).argmin()
+    if shared_zero:
+        zero_1, zero_2 = shared_abs_zeros(abs_encoder_1_ticks[exp_start_index], abs_encoder_2_ticks[exp_start_index])
+    else:
+        zero_1 = abs_encoder_1_ticks[exp_start_index]
+        zero_2 = abs_encoder_2_ticks[exp_start_index]
+    return abs_encoder_1_ticks - zero_1, abs_encoder_2_ticks - zero_2
+
+
+def slice_stage(rebased, encoder_ticks, motor_encoder_ticks, brake_current, start_time):
+    encoder_timestamps, brake_timestamps, _, stop_time = rebased[0:4]
+    return slice_session(encoder_timestamps, encoder_ticks[0], encoder_ticks[1], motor_encoder_ticks,
+                         brake_timestamps, brake_current, start_time, stop_time)
+
+
+def segment_stage(sliced, motor_direction_switch_time):
+    encoder_timestamps, _, _, _, brake_timestamps, brake_current = sliced
+    return segment_brake_ramps(brake_timestamps, encoder_timestamps, brake_current, motor_direction_switch_time)
+
+
+def backlash_stage(sliced, segments, enc_ticks_to_rad):
+    _, encoder_1_ticks, _, motor_enc_ticks, _, _ = sliced
+    return get_motor_backlash(encoder_1_ticks, motor_enc_ticks, enc_ticks_to_rad, motor_enc_ticks_to_rad, segments[2])
+
+
+def smooth_stage(sliced, enc_ticks_to_rad, enable_smoothing):
+    _, encoder_1_ticks, encoder_2_ticks, _, _, _ = sliced
+    return get_encoder_delta(encoder_1_ticks, encoder_2_ticks, enc_ticks_to_rad, enable_smoothing)
+
+
+def interpolate_stage(sliced, encoder_delta):
+    encoder_timestamps, _, _, _, brake_timestamps, _ = sliced
+    return interpolate_to_timestamps(encoder_timestamps, encoder_delta, brake_timestamps)
+
+
+def torque_stage(torque_table, sliced, segments):
+    brake_ramp_transition_indices, motor_direction_switch_brake_index, _ = segments
+    if brake_ramp_transition_indices is None:
+        return None
+    return brake_current_to_torque(torque_table, sliced[5], brake_ramp_transition_indices,
+                                   motor_direction_switch_brake_index)
+
+
+def regression_stage(encoder_interp_delta, brake_torque_nm):
+    if brake_torque_nm is None:
+        return None, None
+    return compute_linear_regression(encoder_interp_delta, brake_torque_nm)
+
+
+def analyze_session(cache, torque_table,
+                    encoder_timestamps, abs_encoder_1_ticks, abs_encoder_2_ticks,
+                    diff_encoder_1_ticks, diff_encoder_2_ticks, motor_encoder_ticks,
+                    brake_timestamps, brake_current,
+                    experiment_start_time, experiment_stop_time, motor_direction_switch_time,
+                    use_abs_encoders, enable_smoothing, abs_encoder_fixed_diff):
+    """DataAggregator.teardown's analysis as a chain of cached stages. Same numbers as compute_k on the same data.
+
+    Raw inputs should be numpy arrays, hashing them is much faster than hashing lists.
+    With use_abs_encoders and abs_encoder_fixed_diff as None it's estimated from the session's unloaded samples
+    (abs_encoder_calibration) and the absolute encoders are zeroed together, so the absolute deflection starts from
+    the calibrated offset instead of from whatever it was at the zeroing sample. Without use_abs_encoders nothing is
+    estimated and a None fixed_diff is 0.0.
+    """
+    abs_encoder_offset = None
+    if use_abs_encoders and abs_encoder_fixed_diff is None:
+        abs_encoder_offset = cache.run("abs_offset", abs_offset_stage, [
+            encoder_timestamps, abs_encoder_1_ticks, abs_encoder_2_ticks, diff_encoder_1_ticks, diff_encoder_2_ticks,
+            brake_timestamps, brake_current
+        ]).value
+        fixed_diff = abs_encoder_offset.fixed_diff
+    elif abs_encoder_fixed_diff is None:
+        fixed_diff = 0.0
+    else:
+        fixed_diff = abs_encoder_fixed_diff
+
+    abs_encoder_1 = cache.run("unwrap", unwrap_stage, [abs_encoder_1_ticks], dict(fixed_diff=0.0))
+    abs_encoder_2 = cache.run("unwrap", unwrap_stage, [abs_encoder_2_ticks], dict(fixed_diff=fixed_diff))
+
+    rebased = cache.run("rebase", rebase_stage, [encoder_timestamps, brake_timestamps], dict(
+        experiment_start_time=experiment_start_time,
+        experiment_stop_time=experiment_stop_time,
+        motor_direction_switch_time=motor_direction_switch_time,
+    ))
+    encoder_timestamps, brake_timestamps, experiment_start_time, experiment_stop_time, motor_direction_switch_time = \
+        rebased.value
+
+    zeroed_abs_encoders = cache.run("zero_abs", zero_abs_encoders_stage, [rebased, abs_encoder_1, abs_encoder_2],
+                                    dict(shared_zero=abs_encoder_offset is not None))
+
+    if use_abs_encoders:
+        encoder_ticks = zeroed_abs_encoders
+        enc_ticks_to_rad = abs_enc_ticks_to_rad
+        experiment_start_time += basklash_time_compensation
+        enc_type_dir_name = "abs"
+    else:
+        encoder_ticks = (diff_encoder_1_ticks, diff_encoder_2_ticks)
+        enc_ticks_to_rad = rel_enc_ticks_to_rad
+        enc_type_dir_name = "rel"
+
+    sliced = cache.run("slice", slice_stage, [rebased, encoder_ticks, motor_encoder_ticks, brake_current],
+                       dict(start_time=experiment_start_time))
+    segments = cache.run("segment", segment_stage, [sliced],
+                         dict(motor_direction_switch_time=motor_direction_switch_time))
+    backlash = cache.run("backlash", backlash_stage, [sliced, segments], dict(enc_ticks_to_rad=enc_ticks_to_rad))
+    encoder_delta = cache.run("smooth", smooth_stage, [sliced], dict(
+        enc_ticks_to_rad=enc_ticks_to_rad, enable_smoothing=enable_smoothing))
+    encoder_interp_delta = cache.run("interpolate", interpolate_stage, [sliced, encoder_delta])
+    brake_torque_nm = cache.run("torque", torque_stage, [torque_table, sliced, segments])
+    regression = cache.run("regression", regression_stage, [encoder_interp_delta, brake_torque_nm])
+
+    sliced_encoder_timestamps, _, _, _, sliced_brake_timestamps, sliced_brake_current = sliced.value
+    encoder_lin_reg, polynomial = regression.value
+    motor_forward_backlash, motor_backward_backlash = backlash.value
+    result = ResultInfo(sliced_encoder_timestamps, encoder_delta.value, encoder_interp_delta.value, encoder_lin_reg,
+                        sliced_brake_timestamps, sliced_brake_current, segments.value[0], brake_torque_nm.value,
+                        polynomial, motor_forward_backlash, motor_backward_backlash)
+
+    abs_encoder_1_ticks, abs_encoder_2_ticks = zeroed_abs_encoders.value
+    return KAnalysis(result, encoder_timestamps, brake_timestamps, abs_encoder_1_ticks, abs_encoder_2_ticks,
+                     experiment_start_time, experiment_stop_time, enc_type_dir_name, abs_encoder_offset)
@@ -1,13 +1,19 @@
 import os
-import matplotlib.pyplot as plt
 
 current_fig_num = 0
 
 
+def get_pyplot():
+    """Import pyplot on first use so scripts that don't plot never pay for matplotlib"""
+    from matplotlib import pyplot
+    return pyplot
+
+
 def new_fig(fig_num=None):
     """Create a new figure"""
 
     global current_fig_num, current_fig
+    plt = get_pyplot()
     if fig_num is None:
         current_fig_num += 1
     else:
@@ -22,7 +28,7 @@ def new_fig(fig_num=None):
 def press(event):
     """matplotlib key press event. Close all figures when q is pressed"""
     if event.key == "q":
-        plt.close("all")
+        get_pyplot().close("all")
 
 
 def mkdir(path, is_file=True):
@@ -37,4 +43,4 @@ def save_fig(path):
     path = "figures/%s.png" % path
     mkdir(path)
     print("saving to '%s'" % path)
-    plt.savefig(path, dpi=200)
+    get_pyplot().savefig(path, dpi=200)
@@ -1,5 +1,5 @@
 import numpy as np
-from .k_calculator_helpers import rel_enc_ticks_to_rad
+from .encoder_constants import rel_enc_ticks_to_rad
 
 
 def single_weight_test(measurement_on_ruler_cm, actual_displacement, predicted_K, weight_used=True):
@@ -2,13 +2,43 @@ import asyncio
 from arduino_factory import packet
 from atlasbuggy.log.playback import PlaybackNode
 
+from .log_parser import iter_log_lines
+from .compressed_log import find_log, is_compressed_log, iter_compressed_lines
 
-class BrakePlayback(PlaybackNode):
+
+class LogPlayback(PlaybackNode):
+    """PlaybackNode that also reads compressed logs. When only the compressed log exists, it's decompressed
+    on a worker thread and its lines are handed to parse() the same way PlaybackNode hands them over."""
+
+    def __init__(self, path, enabled=True, update_rate=0.0):
+        found_path = find_log(path)
+        if found_path is not None and is_compressed_log(found_path):
+            self.compressed_path = found_path
+        else:
+            self.compressed_path = None
+        super(LogPlayback, self).__init__(path, enabled=enabled, update_rate=update_rate)
+        self.done = False
+
+    async def setup(self):
+        if self.compressed_path is None:
+            await super(LogPlayback, self).setup()
+
+    async def loop(self):
+        if self.compressed_path is None:
+            await super(LogPlayback, self).loop()
+            return
+
+        for line in iter_log_lines(None, iter_compressed_lines(self.compressed_path)):
+            await self.parse(line)
+            await asyncio.sleep(self.update_rate)
+        await self.completed()
+
+
+class BrakePlayback(LogPlayback):
     def __init__(self, filename, directory, enabled=True):
         super(BrakePlayback, self).__init__(
             "logs/%s/BrakeControllerBridge/%s" % (directory, filename),
             enabled=enabled, update_rate=0.0)
-        self.done = False
 
     async def parse(self, line):
         message = packet.parse(line.message)
@@ -20,12 +50,11 @@ class BrakePlayback(PlaybackNode):
         self.done = True
 
 
-class EncoderPlayback(PlaybackNode):
+class EncoderPlayback(LogPlayback):
     def __init__(self, filename, directory, enabled=True):
         super(EncoderPlayback, self).__init__(
             "logs/%s/EncoderReaderBridge/%s" % (directory, filename),
             enabled=enabled, update_rate=0.0)
-        self.done = False
 
     async def parse(self, line):
         message = packet.parse(line.message)
@@ -37,12 +66,11 @@ class EncoderPlayback(PlaybackNode):
         self.done = True
 
 
-class MotorPlayback(PlaybackNode):
+class MotorPlayback(LogPlayback):
     def __init__(self, filename, directory, enabled=True):
         super(MotorPlayback, self).__init__(
             "logs/%s/MotorControllerBridge/%s" % (directory, filename),
             enabled=enabled, update_rate=0.0)
-        self.done = False
         self.command_flag = "command: "
 
     async def parse(self, line):
@@ -54,6 +82,11 @@ class MotorPlayback(PlaybackNode):
             await self.broadcast(("command", command, line.timestamp))
         elif line.message == "Command queue backlog finished!":
             await self.broadcast(("stop", line.timestamp))
+        elif line.message.startswith("Packet("):
+            # speed, target speed, input voltage, temperature, error status read back from the SMC
+            message = packet.parse(line.message)
+            if message is not None and message.name == "motor":
+                await self.broadcast(("telemetry", message))
         else:
             await asyncio.sleep(0.0)
 
@@ -61,12 +94,11 @@ class MotorPlayback(PlaybackNode):
         self.done = True
 
 
-class ExperimentPlayback(PlaybackNode):
+class ExperimentPlayback(LogPlayback):
     def __init__(self, filename, directory, enabled=True):
         super(ExperimentPlayback, self).__init__(
             "logs/%s/ExperimentNode/%s" % (directory, filename),
             enabled=enabled, update_rate=0.0)
-        self.done = False
 
     async def parse(self, line):
         self.logger.info("recovered: %s" % line.message)
@@ -0,0 +1,197 @@
+import os
+import re
+import time
+from collections import namedtuple
+
+from .compressed_log import find_log, is_compressed_log, iter_compressed_lines
+
+LogLine = namedtuple("LogLine", "name level timestamp message")
+LogPacket = namedtuple("LogPacket", "timestamp data receive_time sequence_num global_sequence_num name")
+
+header_pattern = re.compile(
+    r"^\[(?P<name>[^\]@]+?) @ [^\]]*\]\[(?P<level>\w+)\] "
+    r"(?P<date>\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}),(?P<msec>\d{3}): (?P<message>.*)$"
+)
+buffer_entry_pattern = re.compile(r"^\[(?P<level>\w+), (?P<timestamp>[-\d.e]+)\]: (?P<message>.*)$")
+
+packet_timestamp_pattern = re.compile(r"\btimestamp=([-\d.e]+)")
+packet_data_pattern = re.compile(r"\bdata=\[([^\]]*)\]")
+packet_receive_time_pattern = re.compile(r"\breceive_time=([-\d.e]+)")
+packet_sequence_num_pattern = re.compile(r"(?<!global_)sequence_num=(-?\d+)")
+packet_global_sequence_num_pattern = re.compile(r"\bglobal_sequence_num=(-?\d+)")
+packet_name_pattern = re.compile(r"\bname=([^,)]+)")
+
+buffer_start_flag = "[log buffer start]"
+buffer_end_flag = "[log buffer end]"
+
+log_time_cache = {}
+
+stream_directories = {
+    "brake": "BrakeControllerBridge",
+    "encoders": "EncoderReaderBridge",
+    "motor": "MotorControllerBridge",
+    "experiment": "ExperimentNode",
+}
+
+
+def session_log_path(directory, filename, stream, log_root="logs"):
+    return os.path.join(log_root, directory, stream_directories[stream], filename)
+
+
+def parse_log_time(date, msec):
+    # many lines share the same second, only convert each second once
+    if date not in log_time_cache:
+        log_time_cache[date] = time.mktime(time.strptime(date, "%Y-%m-%d %H:%M:%S"))
+    return log_time_cache[date] + int(msec) / 1000.0
+
+
+def parse_data_value(value):
+    value = value.strip()
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return value
+
+
+def parse_packet(message):
+    """Parse the repr of an arduino_factory packet. Returns None if the message isn't a packet"""
+    if not message.startswith("Packet("):
+        return None
+
+    timestamp_match = packet_timestamp_pattern.search(message)
+    data_match = packet_data_pattern.search(message)
+    receive_time_match = packet_receive_time_pattern.search(message)
+    if timestamp_match is None or data_match is None or receive_time_match is None:
+        return None
+
+    sequence_num_match = packet_sequence_num_pattern.search(message)
+    global_sequence_num_match = packet_global_sequence_num_pattern.search(message)
+    name_match = packet_name_pattern.search(message)
+
+    data_string = data_match.group(1)
+    if len(data_string.strip()) == 0:
+        data = []
+    else:
+        data = [parse_data_value(value) for value in data_string.split(",")]
+
+    return LogPacket(
+        float(timestamp_match.group(1)),
+        data,
+        float(receive_time_match.group(1)),
+        int(sequence_num_match.group(1)) if sequence_num_match is not None else 0,
+        int(global_sequence_num_match.group(1)) if global_sequence_num_match is not None else -1,
+        name_match.group(1) if name_match is not None else None,
+    )
+
+
+def iter_raw_lines(path):
+    # falls back to the compressed log when the plain one isn't there
+    found_path = find_log(path)
+    if found_path is not None and is_compressed_log(found_path):
+        yield from iter_compressed_lines(found_path)
+        return
+
+    with open(path) as log_file:
+        for line in log_file:
+            yield line
+
+
+def iter_log_lines(path, raw_lines=None):
+    """Yield every record in an atlasbuggy log as a LogLine.
+    Entries inside a log buffer are yielded individually with their buffered timestamp."""
+    if raw_lines is None:
+        raw_lines = iter_raw_lines(path)
+
+    current = None
+    buffer_name = None
+    in_buffer = False
+    for raw_line in raw_lines:
+        raw_line = raw_line.rstrip("\n")
+
+        if in_buffer:
+            if raw_line == buffer_end_flag:
+                in_buffer = False
+                continue
+            match = buffer_entry_pattern.match(raw_line)
+            if match is not None:
+                yield LogLine(buffer_name, match.group("level"), float(match.group("timestamp")),
+                              match.group("message"))
+            continue
+
+        match = header_pattern.match(raw_line)
+        if match is None:
+            if current is not None:
+                # continuation of a multi-line message
+                current = current._replace(message=current.message + "\n" + raw_line)
+            continue
+
+        if current is not None:
+            yield current
+
+        message = match.group("message")
+        current = LogLine(match.group("name"), match.group("level"),
+                          parse_log_time(match.group("date"), match.group("msec")), message)
+
+        if message == buffer_start_flag:
+            in_buffer = True
+            buffer_name = current.name
+            current = None
+
+    if current is not None:
+        yield current
+
+
+def iter_packets(path, packet_name=None, raw_lines=None):
+    """Yield the packets recorded with log_to_buffer, optionally only those with the given name"""
+    for line in iter_log_lines(path, raw_lines):
+        if not line.message.startswith("Packet("):
+            continue
+        packet = parse_packet(line.message)
+        if packet is None:
+            continue
+        if packet_name is not None and packet.name != packet_name:
+            continue
+        yield packet
+
+
+def estimate_log_time_offset(path, num_samples=50, resolution=900.0):
+    """Log line times are written in the rig's local time zone. Compare them against the receive times
+    of packets logged on the same line to find the offset to add to line times (rounded to the nearest
+    quarter hour since the remaining difference is just logging latency)"""
+    packet_flag = "packet: '"
+    offsets = []
+    for line in iter_log_lines(path):
+        if not line.message.startswith(packet_flag):
+            continue
+        packet = parse_packet(line.message[len(packet_flag):].rstrip("'"))
+        if packet is None or packet.receive_time <= 0.0:
+            continue
+        offsets.append(packet.receive_time - line.timestamp)
+        if len(offsets) >= num_samples:
+            break
+
+    if len(offsets) == 0:
+        return 0.0
+    offsets.sort()
+    median_offset = offsets[len(offsets) // 2]
+    return round(median_offset / resolution) * resolution
+
+
+def iter_motor_events(path, raw_lines=None, time_offset=0.0):
+    """Yield the same tuples MotorPlayback broadcasts"""
+    command_flag = "command: "
+    for line in iter_log_lines(path, raw_lines):
+        timestamp = line.timestamp + time_offset
+        if line.message == "Executing motor command queue backlog":
+            yield ("start", timestamp)
+        elif line.message.startswith(command_flag):
+            yield ("command", int(line.message[len(command_flag):]), timestamp)
+        elif line.message == "Command queue backlog finished!":
+            yield ("stop", timestamp)
+        elif line.message.startswith("Packet("):
+            packet = parse_packet(line.message)
+            if packet is not None and packet.name == "motor":
+                yield ("telemetry", packet)
@@ -0,0 +1,112 @@
+import numpy as np
+
+# one record per decoded packet. Field order after the header matches packet.data
+packet_header_fields = [
+    ("timestamp", np.float64),
+    ("receive_time", np.float64),
+    ("sequence_num", np.int64),
+    ("global_sequence_num", np.int64),
+]
+
+brake_dtype = np.dtype(packet_header_fields + [
+    ("shunt_voltage", np.float64),
+    ("bus_voltage", np.float64),
+    ("current_mA", np.float64),
+    ("power_mW", np.float64),
+    ("load_voltage", np.float64),
+    ("pwm_pin", np.int64),
+    ("set_point", np.float64),
+])
+
+encoder_dtype = np.dtype(packet_header_fields + [
+    ("abs_enc1_angle", np.float64),
+    ("abs_enc2_angle", np.float64),
+    ("abs_enc1_analog", np.int64),
+    ("abs_enc2_analog", np.int64),
+    ("enc1_pos", np.float64),
+    ("enc2_pos", np.float64),
+    ("motor_pos", np.float64),
+])
+
+# packet name -> record layout
+stream_dtypes = {
+    "brake": brake_dtype,
+    "enc": encoder_dtype,
+}
+
+
+class LoggedPacket:
+    """Packet made on the host (telemetry read back from the motor controller, commanded waveform samples).
+    Prints the same way arduino_factory packets do so the log parsers and playback nodes pick them up"""
+
+    def __init__(self, name, timestamp, global_sequence_num, data, receive_time):
+        self.timestamp = timestamp
+        self.global_sequence_num = global_sequence_num
+        self.sequence_num = 0
+        self.data = data
+        self.receive_time = receive_time
+        self.name = name
+
+    def __str__(self):
+        return "Packet(timestamp=%s, global_sequence_num=%s, sequence_num=%s, data=%s, receive_time=%s, name=%s)" % (
+            self.timestamp, self.global_sequence_num, self.sequence_num, self.data, self.receive_time, self.name)
+
+    __repr__ = __str__
+
+
+def has_record_layout(packet, stream):
+    """Whether packet.data has a value for every field of its stream's records. A garbled serial line can still
+    parse into a packet with the right name and the wrong number of values"""
+    return len(packet.data) == len(stream_dtypes[stream].names) - len(packet_header_fields)
+
+
+def packet_to_record(packet):
+    """Packet -> tuple that can be assigned straight into a record of its stream's dtype.
+    Check has_record_layout first, the tuple won't fit otherwise"""
+    return (packet.timestamp, packet.receive_time, packet.sequence_num, packet.global_sequence_num) + \
+        tuple(packet.data)
+
+
+def packets_to_block(packets, stream):
+    """Pack a list of packets from one stream into a record array. Packets without the stream's layout are left out"""
+    packets = [packet for packet in packets if has_record_layout(packet, stream)]
+    block = np.empty(len(packets), dtype=stream_dtypes[stream])
+    for index, packet in enumerate(packets):
+        block[index] = packet_to_record(packet)
+    return block
+
+
+def is_block(message):
+    return isinstance(message, np.ndarray)
+
+
+def as_block(message, stream):
+    """Subscribers get single packets or blocks depending on the bridge's mode. Either way, as a block"""
+    if is_block(message):
+        return message
+    return packets_to_block([message], stream)
+
+
+# stream -> field name -> index into packet.data
+packet_data_indices = {
+    stream: {name: index for index, name in enumerate(dtype.names[len(packet_header_fields):])}
+    for stream, dtype in stream_dtypes.items()
+}
+
+
+def message_field(message, stream, field):
+    """One field of every record in a message: the block's column, or a one element list for a single packet.
+    Single packets are read as they are, building a block for every packet costs more than using it"""
+    if is_block(message):
+        return message[field]
+    if field in packet_data_indices[stream]:
+        return [message.data[packet_data_indices[stream][field]]]
+    return [getattr(message, field)]
+
+
+# encoder records with the filtered deflection between the two relative encoders added on the end (rad, rad/s)
+filtered_encoder_dtype = np.dtype(encoder_dtype.descr + [
+    ("deflection", np.float64),
+    ("smoothed_deflection", np.float64),
+    ("deflection_rate", np.float64),
+])
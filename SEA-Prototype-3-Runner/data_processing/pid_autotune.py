@@ -0,0 +1,630 @@
+import os
+import sys
+import glob
+import time
+import pickle
+import argparse
+from collections import namedtuple
+
+import numpy as np
+
+from .log_parser import iter_log_lines, parse_packet
+
+# what ParticleBrake::update() writes to the current control pin
+max_pwm = 255
+# ParticleBrake waits at least pidDelay (500us) between updates, reading the INA219 takes about as long again
+default_control_period = 0.001
+
+# gains the firmware starts with (BrakeController/src/main.cpp)
+firmware_default_gains = (30.0, 0.0, 0.0)
+start_packet_prefix = "start_packet: '"
+
+BrakePlant = namedtuple(
+    "BrakePlant",
+
+    "gain_mA "  # steady state current per PWM count
+    "offset_mA "  # current with the pin at 0
+    "rise_time_constant "  # seconds, coil charging
+    "fall_time_constant "  # seconds, coil discharging
+    "noise_std_mA "  # sensed current noise
+    "num_holds "
+    "num_steps "
+    "settled_error "  # median |simulated - logged settled current| of the logged steps, in settling bands
+    "first_fraction_error "  # rms of simulated - logged first packet after each step, in standard deviations
+)
+
+# the most a plant can be off on the logged steps (under the gains they were logged with) before gains tuned on it
+# aren't trusted. Settled currents have to land inside the band candidates are scored with (response_metrics), and
+# the first packets can't be off by more than twice what sensor noise and not knowing when in the 100ms between
+# packets the step went out explain
+default_max_settled_error = 1.0
+default_max_first_fraction_error = 2.0
+
+# gains only get saved or applied when every session's brake agrees with the others to within these ratios
+# (max / min). The firmware's responseForcedMsec and responseUnforcedMsec (14, 25ms) are well under the packet
+# interval, so a single session can't pin the time constants down by itself
+default_min_sessions = 2
+default_max_time_constant_ratio = 2.0
+default_max_gain_ratio = 2.0
+
+# the best gains of each session and whether they agree enough to use
+TuningAgreement = namedtuple(
+    "TuningAgreement",
+
+    "candidate "  # best gains of the pooled sessions, None if nothing settled
+    "plants "  # BrakePlant of each session
+    "candidates "  # best PIDCandidate of each session
+    "agreed "
+    "reasons "  # why they don't, empty if they do
+)
+
+# a set point change and the brake packets around it
+StepRecords = namedtuple(
+    "StepRecords",
+
+    "prev_current "  # last current before the step
+    "first_current "  # first current after the step
+    "settled_current "  # mean over the rest of the hold
+    "prev_set_point "
+    "set_point "
+    "interval "  # seconds between the two packets, the step went out somewhere in there
+    "kp ki kd "  # gains the brake was running
+)
+
+PIDCandidate = namedtuple(
+    "PIDCandidate",
+
+    "kp ki kd "
+    "rise_time "  # 10%..90%, seconds. Worst over the scenarios, like every metric here
+    "overshoot "  # fraction of the step
+    "settling_time "  # seconds until the current stays in the settling band
+    "steady_state_error "  # mA, mean over the last fifth of the response
+    "chatter "  # std of the PWM output over the last fifth, sensor noise times the gains
+    "cost "
+)
+
+# (from, to) steps every candidate is run through as fractions of the most current the brake can take.
+# Up, down and one of the small ramp steps
+default_scenarios = ((0.1, 0.4), (0.4, 0.1), (0.3, 0.34))
+
+# 20 x 20 x 25 = 10000 candidates
+default_kp_values = np.geomspace(0.5, 100.0, 20)
+default_ki_values = np.concatenate(([0.0], np.geomspace(1.0, 2000.0, 19)))
+default_kd_values = np.concatenate(([0.0], np.geomspace(1E-5, 0.05, 24)))
+
+# weights of the ranking, each metric is normalized first (times by the scenario duration, the rest by the step)
+default_cost_weights = dict(rise_time=1.0, overshoot=2.0, settling_time=2.0, steady_state_error=4.0, chatter=1.0)
+
+
+def read_logged_gains(path):
+    """kp, ki, kd the brake reported in its start packet"""
+    for line in iter_log_lines(path):
+        if line.message.startswith(start_packet_prefix):
+            packet = parse_packet(line.message[len(start_packet_prefix):].rstrip("'"))
+            if packet is not None and len(packet.data) >= 3:
+                return tuple(float(value) for value in packet.data[0:3])
+    return firmware_default_gains
+
+
+def read_brake_log(path):
+    """(device timestamps, current mA, pin value, set point mA) of every brake packet in a log"""
+    from .log_parser import iter_packets
+
+    rows = [[packet.timestamp, packet.data[2], packet.data[5], packet.data[6]]
+            for packet in iter_packets(path, "brake") if len(packet.data) >= 7]
+    rows = np.array(rows, dtype=np.float64).reshape(-1, 4)
+    return rows[:, 0], rows[:, 1], rows[:, 2], rows[:, 3]
+
+
+def hold_ids(set_points):
+    """Number of the set point hold every packet belongs to"""
+    return np.concatenate(([0], np.cumsum(np.diff(set_points) != 0.0)))
+
+
+def collect_holds(timestamps, current, pin, set_points, min_packets=5, max_clipped=0.2):
+    """Mean pin value and current over every hold with the brake on, leaving out the first packet of each
+    (it's still moving). Also the spread of the current around its hold mean and the current with the brake
+    off (nan if it never was). Returns (mean pins, mean currents, residuals, off current)
+
+    The pin value is mostly sensor noise times kp, clamped to 0..255. Holds where it's clamped more than
+    max_clipped of the time are left out, their mean pin value is pulled toward the clamp"""
+    holds = hold_ids(set_points)
+    steady = np.concatenate(([False], np.diff(holds) == 0)) & (set_points > 0.0)
+    holds = holds[steady]
+    counts = np.bincount(holds)
+    safe_counts = np.maximum(counts, 1)
+    clipped = np.bincount(holds, weights=(pin[steady] <= 0.0) | (pin[steady] >= max_pwm)) / safe_counts
+    used = (counts >= min_packets) & (clipped <= max_clipped)
+    mean_pin = np.bincount(holds, weights=pin[steady]) / safe_counts
+    mean_current = np.bincount(holds, weights=current[steady]) / safe_counts
+
+    in_used_hold = used[holds]
+    residuals = current[steady][in_used_hold] - mean_current[holds[in_used_hold]]
+
+    off = (set_points == 0.0) & (pin == 0.0)
+    off_current = float(np.median(current[off])) if np.any(off) else np.nan
+    return mean_pin[used], mean_current[used], residuals, off_current
+
+
+def max_current(plant):
+    return plant.offset_mA + plant.gain_mA * max_pwm
+
+
+def fit_coil_gain(mean_pins, mean_currents, offsets):
+    """Current per PWM count through the hold means, each less its log's brake off current. The noise is in the
+    pin values, so it's the pin regressed on the current (pin = (current - offset) / gain) and not the other way"""
+    above_offset = mean_currents - offsets
+    denominator = np.sum(mean_pins * above_offset)
+    if denominator <= 0.0:
+        raise ValueError("Current doesn't go up with the pin value")
+    return float(np.sum(above_offset ** 2) / denominator)
+
+
+def collect_steps(timestamps, current, set_points, gains, min_step_mA=8.0, max_interval=0.2):
+    """StepRecords of every set point change followed by a hold of at least two more packets"""
+    holds = hold_ids(set_points)
+    counts = np.bincount(holds)
+    settled_sums = np.bincount(holds, weights=current)
+    starts = np.nonzero(np.diff(holds))[0] + 1  # first packet of each new hold
+    starts = starts[counts[holds[starts]] >= 3]
+
+    # settled current is the hold's mean without its first packet
+    settled = (settled_sums[holds[starts]] - current[starts]) / (counts[holds[starts]] - 1)
+    interval = timestamps[starts] - timestamps[starts - 1]
+    keep = (np.abs(settled - current[starts - 1]) >= min_step_mA) & (interval > 0.0) & (interval <= max_interval)
+    starts = starts[keep]
+
+    kp, ki, kd = gains
+    ones = np.ones(len(starts))
+    return StepRecords(
+        current[starts - 1], current[starts], settled[keep], set_points[starts - 1], set_points[starts],
+        interval[keep], kp * ones, ki * ones, kd * ones
+    )
+
+
+def concatenate_steps(step_records):
+    return StepRecords(*[np.concatenate(column) for column in zip(*step_records)])
+
+
+def simulate_pid(plant, kp, ki, kd, start_mA, set_point_mA, duration, control_period=default_control_period,
+                 noise=None, record_every=1):
+    """Step response of ParticleBrake::update() driving a first order coil, for a batch of gains and steps at once.
+
+    Every argument but plant, duration and control_period broadcasts to one row per simulation. The loop is over
+    control updates (duration / control_period of them), each one a handful of numpy operations on the whole
+    batch. Follows the firmware: the integral term is the sum of past errors times this update's dt, the
+    derivative is on the error, the output is truncated to an int and clamped to the pin's range with no
+    anti-windup. The sensed current is one update old (INA219 conversion).
+
+    noise is an (updates,) array added to the sensed current, the same for every row so candidates are compared
+    on the same disturbance. Returns (times, currents, pwm) with currents and pwm shaped (rows, records), one
+    record every record_every updates.
+    """
+    kp, ki, kd, start_mA, set_point_mA = [np.asarray(value, dtype=np.float64) for value in
+                                          np.broadcast_arrays(kp, ki, kd, start_mA, set_point_mA)]
+    shape = kp.shape
+    num_updates = int(round(duration / control_period))
+    rise_decay = np.exp(-control_period / plant.rise_time_constant)
+    fall_decay = np.exp(-control_period / plant.fall_time_constant)
+
+    # before the step the loop is holding start_mA. With an integral term that's where the PWM comes from
+    hold_pwm = np.clip((start_mA - plant.offset_mA) / plant.gain_mA, 0.0, max_pwm)
+    sum_error = np.divide(hold_pwm, ki * control_period, out=np.zeros(shape), where=ki > 0.0)
+    prev_error = np.zeros(shape)
+    current = start_mA.copy()
+    sensed = start_mA.copy()
+
+    num_records = num_updates // record_every
+    currents = np.empty(shape + (num_records,))
+    pwms = np.empty(shape + (num_records,))
+    for index in range(num_updates):
+        error = set_point_mA - sensed
+        if noise is not None:
+            error = error - noise[index]
+        output = kp * error + ki * (sum_error * control_period) + kd * ((error - prev_error) / control_period)
+        pwm = np.trunc(np.clip(output, 0.0, max_pwm))
+        prev_error = error
+        sum_error = sum_error + error
+
+        sensed = current
+        target = plant.offset_mA + plant.gain_mA * pwm
+        current = target + (current - target) * np.where(target > current, rise_decay, fall_decay)
+        if (index + 1) % record_every == 0:
+            currents[..., index // record_every] = current
+            pwms[..., index // record_every] = pwm
+
+    times = (np.arange(num_records) + 1) * record_every * control_period
+    return times, currents, pwms
+
+
+def first_crossing(condition, times):
+    """Time of the first True along the last axis, inf where there isn't one"""
+    index = np.argmax(condition, axis=-1)
+    return np.where(np.any(condition, axis=-1), times[index], np.inf)
+
+
+def response_metrics(times, currents, pwms, start_mA, set_point_mA, settle_band=0.02, min_settle_band_mA=2.0):
+    """rise time, overshoot, settling time, steady state error and chatter of each row"""
+    start_mA = np.asarray(start_mA, dtype=np.float64)[..., np.newaxis]
+    set_point_mA = np.asarray(set_point_mA, dtype=np.float64)[..., np.newaxis]
+    span = set_point_mA - start_mA
+    fraction = (currents - start_mA) / span
+
+    rise_start = first_crossing(fraction >= 0.1, times)
+    rise_stop = first_crossing(fraction >= 0.9, times)
+    rise_time = np.where(np.isfinite(rise_stop), rise_stop - np.where(np.isfinite(rise_start), rise_start, 0.0),
+                         np.inf)
+    overshoot = np.maximum(np.max(fraction, axis=-1) - 1.0, 0.0)
+
+    band = np.maximum(settle_band * np.abs(span), min_settle_band_mA)
+    outside = np.abs(currents - set_point_mA) > band
+    # the last update outside the band. Rows that end outside it never settled
+    last_outside = outside.shape[-1] - 1 - np.argmax(outside[..., ::-1], axis=-1)
+    settling_time = np.where(np.any(outside, axis=-1), times[np.minimum(last_outside + 1, len(times) - 1)], 0.0)
+    settling_time = np.where(outside[..., -1], np.inf, settling_time)
+
+    tail = max(currents.shape[-1] // 5, 1)
+    steady_state_error = np.abs(np.mean(currents[..., -tail:], axis=-1) - set_point_mA[..., 0])
+    chatter = np.std(pwms[..., -tail:], axis=-1)
+    return rise_time, overshoot, settling_time, steady_state_error, chatter
+
+
+def first_fraction_spread(plant, steps, control_period=default_control_period):
+    """Mean and variance of how far along its step the first packet after each step should be. The step went out at
+    a uniformly random time between the two packets, so those are over the simulated response in the interval"""
+    duration = float(np.max(steps.interval))
+    times, currents, _ = simulate_pid(plant, steps.kp, steps.ki, steps.kd, steps.prev_current, steps.set_point,
+                                      duration, control_period)
+    fraction = (currents - steps.prev_current[..., np.newaxis]) / \
+               (steps.settled_current - steps.prev_current)[..., np.newaxis]
+    in_interval = times <= steps.interval[..., np.newaxis]
+    counts = np.maximum(np.sum(in_interval, axis=-1), 1)
+    mean = np.sum(fraction * in_interval, axis=-1) / counts
+    variance = np.sum((fraction - mean[..., np.newaxis]) ** 2 * in_interval, axis=-1) / counts
+    return mean, variance
+
+
+def expected_first_fraction(plant, steps, control_period=default_control_period):
+    """How far along its step the first packet after each step should be on average"""
+    return first_fraction_spread(plant, steps, control_period)[0]
+
+
+def fit_time_constant(plant, steps, field, time_constants, control_period=default_control_period):
+    """Grid search for the plant time constant named field that best explains the first packets after the steps.
+    All candidates and steps are simulated as one batch"""
+    measured = (steps.first_current - steps.prev_current) / (steps.settled_current - steps.prev_current)
+    errors = np.empty(len(time_constants))
+    for index, time_constant in enumerate(time_constants):
+        candidate = plant._replace(**{field: time_constant})
+        errors[index] = np.sum((expected_first_fraction(candidate, steps, control_period) - measured) ** 2)
+    return float(time_constants[np.argmin(errors)])
+
+
+def simulated_settled_current(plant, steps, control_period=default_control_period):
+    """Where each logged step ends up under the gains it was logged with, the mean over the last fifth"""
+    duration = max(0.3, 5.0 * max(plant.rise_time_constant, plant.fall_time_constant))
+    _, currents, _ = simulate_pid(plant, steps.kp, steps.ki, steps.kd, steps.prev_current, steps.set_point, duration,
+                                  control_period)
+    tail = max(currents.shape[-1] // 5, 1)
+    return np.mean(currents[..., -tail:], axis=-1)
+
+
+def validate_brake_plant(plant, steps, control_period=default_control_period):
+    """(settled_error, first_fraction_error) of the plant replaying the logged steps with their logged gains.
+
+    Settled errors are in settling bands, the same band response_metrics scores candidates with. First packet
+    errors are in standard deviations of what the packet could read if the plant were right: where in the
+    transient it landed plus the noise on it and on the packet before the step.
+    """
+    step_sizes = steps.settled_current - steps.prev_current
+    settle_bands = np.maximum(0.02 * np.abs(step_sizes), 2.0)
+    settled_error = np.abs(simulated_settled_current(plant, steps, control_period) - steps.settled_current)
+    measured = (steps.first_current - steps.prev_current) / step_sizes
+    expected, variance = first_fraction_spread(plant, steps, control_period)
+    deviations = (expected - measured) / np.sqrt(variance + 2.0 * (plant.noise_std_mA / step_sizes) ** 2)
+    return float(np.median(settled_error / settle_bands)), float(np.sqrt(np.mean(deviations ** 2)))
+
+
+def check_plant(plant, max_settled_error=default_max_settled_error,
+                max_first_fraction_error=default_max_first_fraction_error):
+    """Raise if the plant doesn't reproduce the logged steps well enough to tune gains on"""
+    if plant.settled_error > max_settled_error or plant.first_fraction_error > max_first_fraction_error:
+        raise ValueError(
+            "The brake model doesn't match its logged step responses (settled current off by %0.2f settling bands, "
+            "max %0.2f, first packet off by %0.2f standard deviations, max %0.2f). Not tuning gains on it" % (
+                plant.settled_error, max_settled_error, plant.first_fraction_error, max_first_fraction_error))
+
+
+def spread_ratio(values):
+    """max / min of some positive values, 1 if they're all 0 and infinite if only some are"""
+    values = np.asarray(values, dtype=float)
+    if np.all(values == 0.0):
+        return 1.0
+    if np.any(values <= 0.0):
+        return np.inf
+    return float(np.max(values) / np.min(values))
+
+
+def check_agreement(plants, candidates, min_sessions=default_min_sessions,
+                    max_time_constant_ratio=default_max_time_constant_ratio, max_gain_ratio=default_max_gain_ratio):
+    """Reasons the sessions' plants and best gains disagree, empty if they agree"""
+    reasons = []
+    if len(plants) < min_sessions:
+        reasons.append("%s sessions, at least %s are needed" % (len(plants), min_sessions))
+        return reasons
+    for field, name in (("rise_time_constant", "rising"), ("fall_time_constant", "falling")):
+        values = [getattr(plant, field) for plant in plants]
+        if spread_ratio(values) > max_time_constant_ratio:
+            reasons.append("%s time constants range %0.1f..%0.1fms, more than %sx apart" % (
+                name, min(values) * 1000.0, max(values) * 1000.0, max_time_constant_ratio))
+    if any(candidate is None for candidate in candidates):
+        reasons.append("no gains settle on some sessions")
+        return reasons
+    # kd is left out, the best candidates of a session are within a fraction of a percent of each other across it
+    for field in ("kp", "ki"):
+        values = [getattr(candidate, field) for candidate in candidates]
+        if spread_ratio(values) > max_gain_ratio:
+            reasons.append("best %s ranges %0.4g..%0.4g, more than %sx apart" % (
+                field, min(values), max(values), max_gain_ratio))
+    return reasons
+
+
+def fit_brake_plant(paths, time_constants=np.geomspace(0.001, 2.0, 50), control_period=default_control_period,
+                    min_steps=10):
+    """Coil model from the step responses in brake logs.
+
+    The offset is the current with the brake off. The gain comes from the mean pin value and current of every
+    hold (the PWM chatters, the current it averages to doesn't). The time constants come from the first packet
+    after each set point change: packets are 100ms apart and the coil settles in tens of ms, so that packet usually
+    catches the end of the transient, and where in the transient depends on the time constant. Each direction
+    needs min_steps steps for that.
+
+    The fitted plant then replays the logged steps under the gains they were logged with, how far it's off is kept
+    in settled_error and first_fraction_error for check_plant.
+    """
+    hold_pins = []
+    hold_currents = []
+    hold_offsets = []
+    residuals = []
+    steps = []
+    for path in paths:
+        timestamps, current, pin, set_points = read_brake_log(path)
+        if len(timestamps) < 3:
+            continue
+        mean_pin, mean_current, hold_residuals, off_current = collect_holds(timestamps, current, pin, set_points)
+        if len(mean_pin) < 2:
+            continue
+        if np.isnan(off_current):
+            # never switched off, take it from a line through the holds instead
+            off_current = np.polyfit(mean_current, mean_pin, 1)
+            off_current = -off_current[1] / off_current[0]
+        hold_pins.append(mean_pin)
+        hold_currents.append(mean_current)
+        hold_offsets.append(np.full(len(mean_pin), off_current))
+        residuals.append(hold_residuals)
+        steps.append(collect_steps(timestamps, current, set_points, read_logged_gains(path)))
+
+    if len(hold_pins) == 0:
+        raise ValueError("Not enough set point holds in %s to fit the brake" % paths)
+    hold_offsets = np.concatenate(hold_offsets)
+    gain = fit_coil_gain(np.concatenate(hold_pins), np.concatenate(hold_currents), hold_offsets)
+    offset = float(np.mean(hold_offsets))
+
+    steps = concatenate_steps(steps)
+    up = steps.settled_current > steps.prev_current
+    num_up = int(np.count_nonzero(up))
+    num_down = len(up) - num_up
+    if num_up < min_steps or num_down < min_steps:
+        raise ValueError("Only %s rising and %s falling set point steps in %s, the coil's time constants need at "
+                         "least %s of each" % (num_up, num_down, paths, min_steps))
+
+    default_time_constant = float(np.median(time_constants))
+    plant = BrakePlant(gain, offset, default_time_constant, default_time_constant,
+                       float(np.std(np.concatenate(residuals))), len(hold_offsets), len(steps.interval), np.nan, np.nan)
+
+    rise = fit_time_constant(plant._replace(fall_time_constant=np.inf), take_steps(steps, up),
+                             "rise_time_constant", time_constants, control_period)
+    plant = plant._replace(rise_time_constant=rise, fall_time_constant=rise)
+    fall = fit_time_constant(plant, take_steps(steps, ~up), "fall_time_constant", time_constants, control_period)
+    plant = plant._replace(fall_time_constant=fall)
+
+    settled_error, first_fraction_error = validate_brake_plant(plant, steps, control_period)
+    return plant._replace(settled_error=settled_error, first_fraction_error=first_fraction_error)
+
+
+def take_steps(steps, mask):
+    return StepRecords(*[column[mask] for column in steps])
+
+
+def gain_grid(kp_values=default_kp_values, ki_values=default_ki_values, kd_values=default_kd_values):
+    """Every combination, flattened to three equal length arrays"""
+    kp, ki, kd = np.meshgrid(kp_values, ki_values, kd_values, indexing="ij")
+    return kp.ravel(), ki.ravel(), kd.ravel()
+
+
+def score_gains(plant, kp, ki, kd, scenarios=default_scenarios, duration=None,
+                control_period=default_control_period, cost_weights=None, seed=0, num_records=300):
+    """Simulate every (kp[i], ki[i], kd[i]) through every scenario (fractions of max_current) in one batch.
+
+    Returns the worst rise time, overshoot, settling time, steady state error and chatter of each over the
+    scenarios, and a cost: a weighted sum of them, inf for gains that don't settle in some scenario.
+    Scenarios run for duration, 5 of the plant's slowest time constants if it's None. Only num_records samples of
+    each response are kept so memory doesn't grow with the duration.
+    """
+    if cost_weights is None:
+        cost_weights = default_cost_weights
+    if duration is None:
+        duration = max(0.3, 5.0 * max(plant.rise_time_constant, plant.fall_time_constant))
+    num_updates = int(round(duration / control_period))
+    kp, ki, kd = [np.asarray(value, dtype=np.float64) for value in (kp, ki, kd)]
+    scenarios = np.asarray(scenarios, dtype=np.float64) * max_current(plant)
+    start_mA = scenarios[:, 0:1]
+    set_point_mA = scenarios[:, 1:2]
+
+    noise = None
+    if plant.noise_std_mA > 0.0:
+        random = np.random.RandomState(seed)
+        noise = random.normal(0.0, plant.noise_std_mA, num_updates)
+
+    # rows are scenarios, columns gains
+    times, currents, pwms = simulate_pid(plant, kp, ki, kd, start_mA, set_point_mA, duration, control_period, noise,
+                                         record_every=max(num_updates // num_records, 1))
+    shape = currents.shape[0:2]
+    metrics = response_metrics(times, currents, pwms, np.broadcast_to(start_mA, shape),
+                               np.broadcast_to(set_point_mA, shape))
+    rise_time, overshoot, settling_time, steady_state_error, chatter = [np.max(metric, axis=0) for metric in metrics]
+
+    step_sizes = np.abs(scenarios[:, 1] - scenarios[:, 0])
+    cost = (cost_weights["rise_time"] * rise_time / duration +
+            cost_weights["overshoot"] * overshoot +
+            cost_weights["settling_time"] * settling_time / duration +
+            cost_weights["steady_state_error"] * steady_state_error / np.min(step_sizes) +
+            cost_weights["chatter"] * chatter / max_pwm)
+    cost = np.where(np.isfinite(settling_time) & np.isfinite(rise_time), cost, np.inf)
+    return rise_time, overshoot, settling_time, steady_state_error, chatter, cost
+
+
+def make_candidate(kp, ki, kd, scores, index):
+    return PIDCandidate(float(kp[index]), float(ki[index]), float(kd[index]),
+                        *[float(score[index]) for score in scores])
+
+
+def autotune(plant, kp_values=default_kp_values, ki_values=default_ki_values, kd_values=default_kd_values,
+             num_results=10, **kwargs):
+    """Score every combination of the gain values and rank them. Candidates that don't settle in some scenario
+    are dropped. Returns the best num_results PIDCandidates, best first. Raises if the plant fails check_plant"""
+    check_plant(plant)
+    kp, ki, kd = gain_grid(kp_values, ki_values, kd_values)
+    scores = score_gains(plant, kp, ki, kd, **kwargs)
+    cost = scores[-1]
+    order = np.argsort(cost, kind="stable")[:num_results]
+    return [make_candidate(kp, ki, kd, scores, index) for index in order if np.isfinite(cost[index])]
+
+
+def evaluate_gains(plant, kp, ki, kd, **kwargs):
+    """Scores of one set of gains, to compare against what the brake is running now. Infinite times mean it
+    doesn't get there"""
+    return make_candidate([kp], [ki], [kd], score_gains(plant, [kp], [ki], [kd], **kwargs), 0)
+
+
+def check_agreed(agreement):
+    if not agreement.agreed:
+        raise ValueError("The sessions don't agree on the brake or its gains (%s). The gains are advisory only" %
+                         "; ".join(agreement.reasons))
+
+
+def apply_gains(brake_controller_bridge, agreement):
+    """Push the gains of a TuningAgreement to a running brake through its setters, if the sessions agreed"""
+    check_agreed(agreement)
+    brake_controller_bridge.set_kp(agreement.candidate.kp)
+    brake_controller_bridge.set_ki(agreement.candidate.ki)
+    brake_controller_bridge.set_kd(agreement.candidate.kd)
+
+
+def save_gains(pickle_file_path, agreement):
+    """Same format TkinterGUI.save_constants writes, so the GUI loads them next start. Only if the sessions of the
+    TuningAgreement agreed"""
+    check_agreed(agreement)
+    candidate = agreement.candidate
+    with open(pickle_file_path, "wb") as pickle_file:
+        pickle.dump((candidate.kp, candidate.ki, candidate.kd), pickle_file)
+
+
+def format_plant(plant):
+    return "%0.3fmA per PWM count + %0.1fmA, time constant %0.1fms rising, %0.1fms falling, " \
+           "noise %0.2fmA (%s holds, %s steps). Replaying the logged steps: settled current off by %0.2f " \
+           "settling bands, first packet by %0.2f standard deviations" % (
+               plant.gain_mA, plant.offset_mA, plant.rise_time_constant * 1000.0, plant.fall_time_constant * 1000.0,
+               plant.noise_std_mA, plant.num_holds, plant.num_steps, plant.settled_error,
+               plant.first_fraction_error)
+
+
+def format_candidate(candidate):
+    return "kp=%-9.4g ki=%-9.4g kd=%-9.4g rise %5.1fms, overshoot %5.1f%%, settle %5.1fms, error %5.2fmA, " \
+           "chatter %5.1f, cost %0.3f" % (
+               candidate.kp, candidate.ki, candidate.kd, candidate.rise_time * 1000.0, candidate.overshoot * 100.0,
+               candidate.settling_time * 1000.0, candidate.steady_state_error, candidate.chatter, candidate.cost)
+
+
+def tune_logs(paths, top):
+    """Fit, print and tune the brake of some logs. Returns the plant and its best top candidates. Raises if the
+    plant fails check_plant"""
+    t0 = time.time()
+    plant = fit_brake_plant(paths)
+    print("brake: %s (%0.2fs)" % (format_plant(plant), time.time() - t0))
+
+    logged_gains = read_logged_gains(paths[0])
+    print("    logged gains: %s" % format_candidate(evaluate_gains(plant, *logged_gains)))
+    check_plant(plant)
+
+    t0 = time.time()
+    candidates = autotune(plant, num_results=top)
+    print("    %s candidates in %0.2fs" % (len(gain_grid()[0]), time.time() - t0))
+    for candidate in candidates:
+        print("    " + format_candidate(candidate))
+    return plant, candidates
+
+
+def tune_sessions(sessions, top=10):
+    """Tune each session (a list of brake logs) on its own, then the ones that fit pooled together. The pooled best
+    gains are only marked agreed if those sessions agree with each other, see check_agreement. Sessions that can't
+    be fit are printed and left out"""
+    plants = []
+    candidates = []
+    fitted_paths = []
+    for paths in sessions:
+        print(", ".join(paths))
+        try:
+            plant, session_candidates = tune_logs(paths, top)
+        except ValueError as error:
+            print("    %s" % error)
+            continue
+        plants.append(plant)
+        candidates.append(session_candidates[0] if session_candidates else None)
+        fitted_paths.extend(paths)
+
+    reasons = check_agreement(plants, candidates)
+    pooled = []
+    if len(plants) > 1:
+        print("pooled")
+        try:
+            pooled = tune_logs(fitted_paths, top)[1]
+        except ValueError as error:
+            print("    %s" % error)
+        if not pooled:
+            reasons.append("no gains settle on the pooled sessions")
+    return TuningAgreement(pooled[0] if pooled else None, plants, candidates, len(reasons) == 0, reasons)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fit the brake's coil from logged step responses and rank PID gains")
+    parser.add_argument("logs", nargs="*", help="brake logs, every one under --log-root if left out")
+    parser.add_argument("--log-root", default="logs")
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--save", default=None, help="write the best gains here (pickled/pid_constants.pkl) if the "
+                                                     "sessions agree on them")
+    args = parser.parse_args()
+
+    paths = args.logs
+    if len(paths) == 0:
+        paths = sorted(glob.glob(os.path.join(args.log_root, "*", "BrakeControllerBridge", "*.log*")))
+    if len(paths) == 0:
+        parser.error("no brake logs found")
+
+    # each log is its own session, the gains are only trusted if the sessions come up with the same ones
+    agreement = tune_sessions([[path] for path in paths], args.top)
+    if not agreement.agreed:
+        print("The sessions don't agree (%s). The gains above are advisory only" % "; ".join(agreement.reasons))
+        if args.save is not None:
+            sys.exit(1)
+        return
+
+    candidate = agreement.candidate
+    print("the sessions agree on kp=%s, ki=%s, kd=%s" % (candidate.kp, candidate.ki, candidate.kd))
+    if args.save is not None:
+        save_gains(args.save, agreement)
+        print("saved them to %s" % args.save)
+
+
+if __name__ == '__main__':
+    main()
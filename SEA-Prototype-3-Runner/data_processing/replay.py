@@ -0,0 +1,202 @@
+import time
+import heapq
+import asyncio
+from atlasbuggy import Node
+
+from .log_parser import session_log_path, iter_packets, iter_motor_events, estimate_log_time_offset
+from .compressed_log import find_log
+
+
+class VirtualClock:
+    """Stands in for the time module. Replayed time only moves when the replay engine advances it.
+    A speed of None (or 0) replays as fast as possible."""
+
+    def __init__(self, speed=1.0):
+        self.speed = speed
+        self.virtual_time = 0.0
+        self.virtual_start_time = None
+        self.real_start_time = None
+
+    def time(self):
+        return self.virtual_time
+
+    def start(self, virtual_start_time):
+        self.virtual_start_time = virtual_start_time
+        self.virtual_time = virtual_start_time
+        self.real_start_time = time.time()
+
+    def real_time_of(self, virtual_time):
+        return self.real_start_time + (virtual_time - self.virtual_start_time) / self.speed
+
+    async def advance_to(self, virtual_time):
+        if self.virtual_start_time is None:
+            self.start(virtual_time)
+
+        if self.speed:
+            delay = self.real_time_of(virtual_time) - time.time()
+            if delay > 0.0:
+                await asyncio.sleep(delay)
+
+        self.virtual_time = max(self.virtual_time, virtual_time)
+
+
+class ReplayArduino:
+    """Records the writes ExperimentNode makes through brake_controller_bridge_arduino"""
+
+    def __init__(self):
+        self.writes = []
+
+    def write(self, command):
+        self.writes.append(command)
+
+    def write_pause(self, timestamp, relative_time=True):
+        self.writes.append(float(timestamp))
+
+    def clear_write_queue(self):
+        self.writes.append(None)
+
+
+class BrakeReplay(Node):
+    def __init__(self, engine, enabled=True):
+        super(BrakeReplay, self).__init__(enabled)
+        self.engine = engine
+        self.brake_controller_bridge_arduino = ReplayArduino()
+        self.commands = []
+        self.kp = 0.0
+        self.ki = 0.0
+        self.kd = 0.0
+
+    async def loop(self):
+        await self.engine.exit_event.wait()
+
+    def command_brake(self, command):
+        self.commands.append((self.engine.clock.time(), float(command)))
+
+    def set_kp(self, kp):
+        self.kp = kp
+
+    def set_ki(self, ki):
+        self.ki = ki
+
+    def set_kd(self, kd):
+        self.kd = kd
+
+
+class EncoderReplay(Node):
+    def __init__(self, engine, enabled=True):
+        super(EncoderReplay, self).__init__(enabled)
+        self.engine = engine
+
+    async def loop(self):
+        await self.engine.exit_event.wait()
+
+
+class MotorReplay(Node):
+    def __init__(self, engine, enabled=True):
+        super(MotorReplay, self).__init__(enabled)
+        self.engine = engine
+        self.commands = []
+
+    async def loop(self):
+        await self.engine.exit_event.wait()
+
+    def set_speed(self, command):
+        self.commands.append((self.engine.clock.time(), int(command)))
+
+    def queue_speed(self, command):
+        self.commands.append((self.engine.clock.time(), int(command)))
+
+    def log_experiment_start(self):
+        pass
+
+    def log_experiment_stop(self):
+        pass
+
+    def write_pause(self, timestamp):
+        pass
+
+    def run_queue(self):
+        pass
+
+    def clear_write_queue(self):
+        pass
+
+
+class ReplayEngine(Node):
+    """Replays a recorded session into the live consumers (ExperimentNode, DataPlotter, ...).
+    Brake, encoder and motor records are merged in host receive time order and released on a virtual
+    clock so consumers see the recorded inter-packet timing at any speed. Subscribe consumers to
+    engine.brake, engine.encoders and engine.motor in place of the hardware bridges and give them
+    engine.clock in place of the time module."""
+
+    def __init__(self, filename, directory, speed=1.0, log_root="logs", enabled=True):
+        super(ReplayEngine, self).__init__(enabled)
+
+        self.clock = VirtualClock(speed)
+        self.exit_event = asyncio.Event()
+        self.done = False
+
+        self.brake_path = session_log_path(directory, filename, "brake", log_root)
+        self.encoders_path = session_log_path(directory, filename, "encoders", log_root)
+        self.motor_path = session_log_path(directory, filename, "motor", log_root)
+
+        self.brake = BrakeReplay(self)
+        self.encoders = EncoderReplay(self)
+        self.motor = MotorReplay(self)
+
+        # yield to the consumers at least this often when replaying as fast as possible
+        self.max_speed_yield_interval = 10
+        self.num_replayed = {"brake": 0, "encoders": 0, "motor": 0}
+
+    def stream_events(self):
+        streams = []
+        if find_log(self.brake_path) is not None:
+            streams.append(
+                (packet.receive_time, "brake", packet) for packet in iter_packets(self.brake_path, "brake"))
+        else:
+            self.logger.warning("No brake log found: %s" % self.brake_path)
+
+        if find_log(self.encoders_path) is not None:
+            streams.append(
+                (packet.receive_time, "encoders", packet) for packet in iter_packets(self.encoders_path, "enc"))
+        else:
+            self.logger.warning("No encoder log found: %s" % self.encoders_path)
+
+        if find_log(self.motor_path) is not None:
+            time_offset = 0.0
+            if find_log(self.brake_path) is not None:
+                time_offset = estimate_log_time_offset(self.brake_path)
+            streams.append(
+                (event[-1], "motor", event) for event in iter_motor_events(self.motor_path, time_offset=time_offset))
+        else:
+            self.logger.warning("No motor log found: %s" % self.motor_path)
+
+        return heapq.merge(*streams, key=lambda event: event[0])
+
+    async def loop(self):
+        producers = {"brake": self.brake, "encoders": self.encoders, "motor": self.motor}
+        start_time = time.time()
+        count = 0
+        for timestamp, stream, message in self.stream_events():
+            await self.clock.advance_to(timestamp)
+            await producers[stream].broadcast(message)
+            self.num_replayed[stream] += 1
+
+            count += 1
+            if not self.clock.speed and count % self.max_speed_yield_interval == 0:
+                await asyncio.sleep(0.0)
+
+        real_duration = time.time() - start_time
+        if self.clock.virtual_start_time is not None:
+            virtual_duration = self.clock.virtual_time - self.clock.virtual_start_time
+        else:
+            virtual_duration = 0.0
+        self.logger.info(
+            "Replayed %s (%0.1fs of recorded time in %0.1fs, %0.1fx)" % (
+                self.num_replayed, virtual_duration, real_duration,
+                virtual_duration / real_duration if real_duration > 0.0 else 0.0
+            )
+        )
+
+        self.done = True
+        self.exit_event.set()
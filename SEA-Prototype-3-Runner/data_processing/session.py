@@ -0,0 +1,315 @@
+import numpy as np
+
+from .log_parser import session_log_path, iter_packets, iter_log_lines, iter_motor_events, estimate_log_time_offset
+from .compressed_log import find_log
+from .packet_blocks import packets_to_block, stream_dtypes
+from .torque_table import TorqueTable
+from .stage_cache import StageCache
+from .clock_alignment import align_streams
+from .experiment_helpers.k_calculator_helpers import *
+from .experiment_helpers.k_pipeline import analyze_session, unwrap_stage, rebase_stage, zero_abs_encoders_stage, \
+    slice_stage, segment_stage, torque_stage, basklash_time_compensation
+from .experiment_helpers.abs_encoder_calibration import session_abs_encoder_fixed_diff
+
+
+class Session:
+    """A recorded session's logs as arrays, without playback nodes or an event loop.
+
+    Nothing is read until it's asked for: session.brake parses only the brake log, session.deflection only the
+    encoder log, and so on. Every stream and everything derived from one is computed once and kept. Times are host
+    times, the same ones DataAggregator records before the analysis rebases them.
+
+        session = Session("2019_Mar_01", "22_08_46.log", "brake_torque_data/B15 Torque Table.csv")
+        session.brake["current_mA"], session.deflection, session.analysis.result.polynomial
+    """
+
+    def __init__(self, directory, filename, torque_table_path=None, log_root="logs", align_clocks=False,
+                 use_abs_encoders=False, enable_smoothing=False, abs_encoder_fixed_diff=None, stage_cache=None):
+        self.directory = directory
+        self.filename = filename
+        self.torque_table_path = torque_table_path
+        self.log_root = log_root
+        self.align_clocks = align_clocks
+        self.use_abs_encoders = use_abs_encoders
+        self.enable_smoothing = enable_smoothing
+        # None estimates it from the unloaded samples like analyze_session does
+        self.abs_encoder_fixed_diff = abs_encoder_fixed_diff
+        self.stage_cache = stage_cache
+
+        # property name -> value, filled on first access
+        self.memo = {}
+
+    def __str__(self):
+        return "%s/%s" % (self.directory, self.filename)
+
+    def memoize(self, name, function):
+        if name not in self.memo:
+            self.memo[name] = function()
+        return self.memo[name]
+
+    def forget(self, *names):
+        """Drop memoized values so they're recomputed. Nothing named drops everything"""
+        if len(names) == 0:
+            self.memo.clear()
+        for name in names:
+            self.memo.pop(name, None)
+
+    def log_path(self, stream):
+        return session_log_path(self.directory, self.filename, stream, self.log_root)
+
+    def has_stream(self, stream):
+        return find_log(self.log_path(stream)) is not None
+
+    def read_block(self, stream, packet_name):
+        """A stream's packets as a record array (packet_blocks.stream_dtypes). Empty when the log is missing"""
+        if not self.has_stream(stream):
+            return np.empty(0, dtype=stream_dtypes[packet_name])
+        return packets_to_block(list(iter_packets(self.log_path(stream), packet_name)), packet_name)
+
+    # raw streams
+
+    @property
+    def torque_table(self):
+        if self.torque_table_path is None:
+            raise ValueError("%s was opened without a torque table" % self)
+        return self.memoize("torque_table", lambda: TorqueTable(self.torque_table_path))
+
+    @property
+    def brake(self):
+        """Brake packets, a record array with packet_blocks.brake_dtype"""
+        return self.memoize("brake", lambda: self.read_block("brake", "brake"))
+
+    @property
+    def encoder(self):
+        """Encoder packets, a record array with packet_blocks.encoder_dtype"""
+        return self.memoize("encoder", lambda: self.read_block("encoders", "enc"))
+
+    @property
+    def motor(self):
+        """The tuples MotorPlayback broadcasts, with log line times moved to the packets' clock"""
+        def load():
+            if not self.has_stream("motor"):
+                return []
+            time_offset = estimate_log_time_offset(self.log_path("brake")) if self.has_stream("brake") else 0.0
+            return list(iter_motor_events(self.log_path("motor"), time_offset=time_offset))
+        return self.memoize("motor", load)
+
+    @property
+    def experiment(self):
+        """ExperimentNode's log as LogLines"""
+        def load():
+            if not self.has_stream("experiment"):
+                return []
+            return list(iter_log_lines(self.log_path("experiment")))
+        return self.memoize("experiment", load)
+
+    # timing, the same way DataAggregator's callbacks put it together
+
+    @property
+    def timestamps(self):
+        """(encoder timestamps, brake timestamps)"""
+        return self.memoize("timestamps", self.load_timestamps)
+
+    def load_timestamps(self):
+        brake, encoder = self.brake, self.encoder
+        if len(brake) == 0 or len(encoder) == 0:
+            raise ValueError("%s needs both a brake and an encoder log" % self)
+
+        if self.align_clocks:
+            encoder_timestamps, brake_timestamps, _ = align_streams(
+                encoder["timestamp"], encoder["receive_time"],
+                (encoder["enc1_pos"] - encoder["enc2_pos"]) * rel_enc_ticks_to_rad,
+                brake["timestamp"], brake["receive_time"], brake["current_mA"]
+            )
+            return encoder_timestamps, brake_timestamps
+
+        # teensy clock does not reset when a new USB connection is made
+        encoder_start_time = encoder["receive_time"][0] - encoder["timestamp"][0]
+        brake_start_time = brake["receive_time"][0]
+        return encoder["timestamp"] + encoder_start_time, brake["timestamp"] + brake_start_time
+
+    @property
+    def encoder_timestamps(self):
+        return self.timestamps[0]
+
+    @property
+    def brake_timestamps(self):
+        return self.timestamps[1]
+
+    @property
+    def brake_current(self):
+        return self.brake["current_mA"]
+
+    @property
+    def experiment_times(self):
+        """(experiment start, experiment stop, motor direction switch). The switch is 0.0 when the motor never
+        reversed, a missing start or stop is an error"""
+        def load():
+            start_time = stop_time = None
+            switch_time = 0.0
+            for event in self.motor:
+                if event[0] == "start":
+                    start_time = event[1]
+                elif event[0] == "stop":
+                    stop_time = event[1]
+                elif event[0] == "command" and event[1] > 0 and switch_time == 0.0:
+                    switch_time = event[2]
+            missing = [name for name, value in (("start", start_time), ("stop", stop_time)) if value is None]
+            if len(missing) > 0:
+                raise ValueError("%s's motor log has no experiment %s event" % (self, " or ".join(missing)))
+            return start_time, stop_time, switch_time
+        return self.memoize("experiment_times", load)
+
+    @property
+    def motor_telemetry(self):
+        """(receive times, rows in the order of hardware/smc_telemetry.py's telemetry variables)"""
+        def load():
+            packets = [event[1] for event in self.motor if event[0] == "telemetry"]
+            return (np.array([packet.receive_time for packet in packets]),
+                    np.array([packet.data for packet in packets], dtype=float))
+        return self.memoize("motor_telemetry", load)
+
+    # derived streams
+
+    @property
+    def abs_encoder_offset(self):
+        """AbsOffsetEstimate when abs_encoder_fixed_diff is None, otherwise None"""
+        def load():
+            if self.abs_encoder_fixed_diff is not None:
+                return None
+            encoder = self.encoder
+            return session_abs_encoder_fixed_diff(
+                self.encoder_timestamps, encoder["abs_enc1_analog"], encoder["abs_enc2_analog"],
+                encoder["enc1_pos"], encoder["enc2_pos"], self.brake_timestamps, self.brake_current
+            )
+        return self.memoize("abs_encoder_offset", load)
+
+    @property
+    def fixed_diff(self):
+        if self.abs_encoder_fixed_diff is not None:
+            return self.abs_encoder_fixed_diff
+        return self.abs_encoder_offset.fixed_diff
+
+    @property
+    def unwrapped_abs_ticks(self):
+        """(abs encoder 1, abs encoder 2) as continuous ticks, encoder 2 shifted by fixed_diff"""
+        def load():
+            encoder = self.encoder
+            return (unwrap_stage(encoder["abs_enc1_analog"], 0.0),
+                    unwrap_stage(encoder["abs_enc2_analog"], self.fixed_diff))
+        return self.memoize("unwrapped_abs_ticks", load)
+
+    @property
+    def rebased(self):
+        """rebase_stage's output: times relative to the first encoder packet"""
+        return self.memoize("rebased", lambda: rebase_stage(
+            self.encoder_timestamps, self.brake_timestamps, *self.experiment_times))
+
+    @property
+    def zeroed_abs_ticks(self):
+        return self.memoize("zeroed_abs_ticks", lambda: zero_abs_encoders_stage(
+            self.rebased, *self.unwrapped_abs_ticks, shared_zero=self.abs_encoder_fixed_diff is None))
+
+    @property
+    def deflection(self):
+        """Incremental encoder 1 - encoder 2 in radians, at every encoder packet"""
+        return self.memoize("deflection", lambda: (self.encoder["enc1_pos"] - self.encoder["enc2_pos"]) *
+                            rel_enc_ticks_to_rad)
+
+    @property
+    def abs_deflection(self):
+        """Absolute encoder 1 - encoder 2 in radians, at every encoder packet"""
+        def load():
+            abs_encoder_1_ticks, abs_encoder_2_ticks = self.zeroed_abs_ticks
+            return (abs_encoder_1_ticks - abs_encoder_2_ticks) * abs_enc_ticks_to_rad
+        return self.memoize("abs_deflection", load)
+
+    @property
+    def sliced(self):
+        """slice_stage's output for the encoders use_abs_encoders picks, cut down to the experiment"""
+        def load():
+            start_time = self.rebased[2]
+            if self.use_abs_encoders:
+                encoder_ticks = self.zeroed_abs_ticks
+                start_time += basklash_time_compensation
+            else:
+                encoder_ticks = (self.encoder["enc1_pos"], self.encoder["enc2_pos"])
+            return slice_stage(self.rebased, encoder_ticks, self.encoder["motor_pos"], self.brake_current,
+                               start_time=start_time)
+        return self.memoize("sliced", load)
+
+    @property
+    def segments(self):
+        """(brake ramp transition indices, direction switch brake index, direction switch encoder index)"""
+        return self.memoize("segments", lambda: segment_stage(
+            self.sliced, motor_direction_switch_time=self.rebased[4]))
+
+    @property
+    def torque(self):
+        """Brake torque (Nm) at each brake packet in the experiment, signed by the motor direction"""
+        return self.memoize("torque", lambda: torque_stage(self.torque_table, self.sliced, self.segments))
+
+    @property
+    def analysis(self):
+        """analyze_session's KAnalysis, the same numbers DataAggregator.teardown prints"""
+        def load():
+            if self.stage_cache is None:
+                self.stage_cache = StageCache(enable_disk=False)
+            encoder = self.encoder
+            return analyze_session(
+                self.stage_cache, self.torque_table,
+                self.encoder_timestamps, encoder["abs_enc1_analog"], encoder["abs_enc2_analog"],
+                encoder["enc1_pos"], encoder["enc2_pos"], encoder["motor_pos"],
+                self.brake_timestamps, self.brake_current,
+                *self.experiment_times,
+                self.use_abs_encoders, self.enable_smoothing, self.abs_encoder_fixed_diff
+            )
+        return self.memoize("analysis", load)
+
+    @property
+    def k(self):
+        """Stiffness (Nm/rad), the slope of the torque vs. deflection fit"""
+        return self.analysis.result.polynomial[0]
+
+
+if __name__ == '__main__':
+    import tempfile
+
+    def test(log_root):
+        import time
+        from .synthetic_session import generate_session, load_truth, default_synthetic_config
+
+        generate_session("synthetic", "session.log", default_synthetic_config, log_root)
+        truth = load_truth("synthetic", "session.log", log_root)
+
+        session = Session("synthetic", "session.log", default_synthetic_config.torque_table_path, log_root)
+        t0 = time.time()
+        print("brake current: %0.1f..%0.1fmA (%0.3fs)" % (
+            np.min(session.brake_current), np.max(session.brake_current), time.time() - t0))
+        assert "encoder" not in session.memo
+
+        t0 = time.time()
+        print("K = %0.4f, truth %0.4f (%0.3fs)" % (session.k, truth.k, time.time() - t0))
+        assert abs(session.k - truth.k) / truth.k < 0.05, (session.k, truth.k)
+        print("abs encoder offset:", session.abs_encoder_offset)
+        assert abs(session.fixed_diff - truth.abs_encoder_fixed_diff) < 0.5, session.abs_encoder_offset
+
+        # derived streams line up with what the analysis used
+        assert np.array_equal(session.torque, session.analysis.result.brake_torque_nm)
+        assert np.array_equal(session.segments[0], session.analysis.result.brake_ramp_transitions)
+        assert len(session.deflection) == len(session.encoder)
+
+        t0 = time.time()
+        session.k, session.torque, session.deflection
+        assert time.time() - t0 < 0.01
+
+        # a session without a motor log can't be windowed
+        try:
+            Session("synthetic", "missing.log", log_root=log_root).experiment_times
+        except ValueError as error:
+            print(error)
+        else:
+            assert False, "expected a ValueError for the missing start and stop events"
+
+    with tempfile.TemporaryDirectory() as log_root:
+        test(log_root)
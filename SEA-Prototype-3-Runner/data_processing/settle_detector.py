@@ -0,0 +1,81 @@
+import math
+from collections import deque
+
+
+class SettleDetector:
+    """Decides when a signal has stopped moving from a sliding window of its most recent samples.
+
+    The window is settled when the least squares slope through it and the spread of the samples around that
+    line are both under their thresholds. Sums are kept incrementally so each sample costs the same no matter
+    how long the window is.
+    """
+
+    def __init__(self, window_duration=0.3, slope_threshold=0.002, std_threshold=0.0005):
+        self.window_duration = window_duration
+        self.slope_threshold = slope_threshold  # units per second
+        self.std_threshold = std_threshold  # units
+
+        self.samples = deque()
+        self.t0 = None
+        self.sum_t = 0.0
+        self.sum_tt = 0.0
+        self.sum_y = 0.0
+        self.sum_yy = 0.0
+        self.sum_ty = 0.0
+
+        self.slope = 0.0
+        self.std = 0.0
+
+    def reset(self):
+        self.samples.clear()
+        self.t0 = None
+        self.sum_t = 0.0
+        self.sum_tt = 0.0
+        self.sum_y = 0.0
+        self.sum_yy = 0.0
+        self.sum_ty = 0.0
+
+    def append(self, timestamp, value):
+        if self.t0 is None:
+            # sums are taken relative to the first sample to keep them well conditioned
+            self.t0 = timestamp
+        t = timestamp - self.t0
+        self.samples.append((t, value))
+        self.add(t, value, 1.0)
+
+        while t - self.samples[0][0] > self.window_duration:
+            old_t, old_value = self.samples.popleft()
+            self.add(old_t, old_value, -1.0)
+
+    def extend(self, timestamps, values):
+        for timestamp, value in zip(timestamps, values):
+            self.append(float(timestamp), float(value))
+
+    def add(self, t, value, sign):
+        self.sum_t += sign * t
+        self.sum_tt += sign * t * t
+        self.sum_y += sign * value
+        self.sum_yy += sign * value * value
+        self.sum_ty += sign * t * value
+
+    def is_full(self):
+        """True once the samples span the whole window"""
+        return len(self.samples) > 2 and self.samples[-1][0] - self.samples[0][0] >= self.window_duration * 0.9
+
+    def is_settled(self):
+        if not self.is_full():
+            return False
+
+        n = len(self.samples)
+        t_variance = self.sum_tt - self.sum_t * self.sum_t / n
+        ty_covariance = self.sum_ty - self.sum_t * self.sum_y / n
+        y_variance = self.sum_yy - self.sum_y * self.sum_y / n
+        if t_variance <= 0.0:
+            return False
+
+        self.slope = ty_covariance / t_variance
+        # what's left over after taking out the line
+        residual = max(0.0, y_variance - self.slope * ty_covariance)
+        self.std = math.sqrt(residual / n)
+
+        return abs(self.slope) < self.slope_threshold and self.std < self.std_threshold
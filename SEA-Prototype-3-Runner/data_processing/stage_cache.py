@@ -0,0 +1,197 @@
+import os
+import pickle
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+# bump when something a stage calls changes in a way that changes its output so old cache entries stop matching.
+# Changes to the stage functions themselves are picked up by hash_function
+cache_version = 1
+
+# what load returns when there's nothing on disk, stages are allowed to return None
+missing = object()
+
+
+def hash_value(value, digest=None):
+    """Feed a value into a hash. Arrays hash by dtype, shape and contents, containers by their items"""
+    if digest is None:
+        digest = hashlib.sha1()
+
+    if isinstance(value, StageOutput):
+        # stage outputs are identified by the key of the stage that made them. No need to hash the arrays again
+        digest.update(b"stage")
+        digest.update(value.key.encode())
+    elif isinstance(value, np.ndarray):
+        digest.update(b"array")
+        digest.update(str(value.dtype).encode())
+        digest.update(repr(value.shape).encode())
+        digest.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, (list, tuple)):
+        digest.update(("%s%s" % (type(value).__name__, len(value))).encode())
+        for item in value:
+            hash_value(item, digest)
+    elif isinstance(value, dict):
+        digest.update(("dict%s" % len(value)).encode())
+        for name in sorted(value.keys()):
+            digest.update(repr(name).encode())
+            hash_value(value[name], digest)
+    elif value is None or isinstance(value, (bool, int, float, str, bytes, np.generic)):
+        digest.update(repr(value).encode())
+    elif hasattr(value, "__dict__"):
+        # objects like TorqueTable hash by their attributes
+        digest.update(type(value).__name__.encode())
+        hash_value(vars(value), digest)
+    else:
+        raise TypeError("Can't hash %s for the stage cache" % type(value))
+
+    return digest
+
+
+def hash_function(function, digest):
+    """Feed a stage function's bytecode and constants into a hash so editing the stage invalidates its entries"""
+    code = getattr(function, "__code__", None)
+    if code is None:
+        # builtins and other callables without bytecode go by name
+        digest.update(getattr(function, "__qualname__", type(function).__name__).encode())
+        return digest
+    hash_code(code, digest)
+    return digest
+
+
+def hash_code(code, digest):
+    digest.update(code.co_code)
+    digest.update(repr(code.co_names).encode())
+    for constant in code.co_consts:
+        if hasattr(constant, "co_code"):
+            # nested functions and comprehensions
+            hash_code(constant, digest)
+        else:
+            digest.update(repr(constant).encode())
+
+
+class StageOutput:
+    """A stage's result along with the key it was cached under"""
+
+    def __init__(self, key, value):
+        self.key = key
+        self.value = value
+
+
+class StageCache:
+    """Memoizes pipeline stage results in memory and on disk.
+
+    Keys are content hashes of the stage name, the stage function's code, its inputs and its parameters. Inputs that came from another stage
+    contribute that stage's key, so changing a late parameter only re-runs the stages after it.
+    Both levels evict the least recently used entries once they go over their limits.
+    """
+
+    def __init__(self, directory="pickled/stages", max_memory_entries=32, max_disk_bytes=512 * 2 ** 20,
+                 enable_disk=True):
+        self.directory = directory
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.enable_disk = enable_disk
+
+        self.memory = OrderedDict()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if self.enable_disk and not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def key(self, stage_name, function, inputs, params):
+        digest = hashlib.sha1(("%s:%s" % (cache_version, stage_name)).encode())
+        hash_function(function, digest)
+        hash_value(list(inputs), digest)
+        hash_value(params, digest)
+        return "%s-%s" % (stage_name, digest.hexdigest())
+
+    def run(self, stage_name, function, inputs=(), params=None):
+        """Call function(*input values, **params) unless a result for the same inputs and params is cached"""
+        if params is None:
+            params = {}
+        key = self.key(stage_name, function, inputs, params)
+
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return StageOutput(key, self.memory[key])
+
+        value = self.load(key)
+        if value is not missing:
+            self.disk_hits += 1
+        else:
+            self.misses += 1
+            values = [item.value if isinstance(item, StageOutput) else item for item in inputs]
+            value = function(*values, **params)
+            self.save(key, value)
+
+        self.remember(key, value)
+        return StageOutput(key, value)
+
+    def remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".pkl")
+
+    def load(self, key):
+        if not self.enable_disk:
+            return missing
+        path = self.path(key)
+        if not os.path.isfile(path):
+            return missing
+        try:
+            with open(path, "rb") as file:
+                value = pickle.load(file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            # half written by a run that was killed. Compute it again
+            return missing
+        # mtime doubles as the last access time for eviction
+        os.utime(path)
+        return value
+
+    def save(self, key, value):
+        if not self.enable_disk:
+            return
+        path = self.path(key)
+        temp_path = path + ".tmp"
+        with open(temp_path, "wb") as file:
+            pickle.dump(value, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total_size = 0
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(".pkl"):
+                continue
+            path = os.path.join(self.directory, filename)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total_size += stat.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total_size <= self.max_disk_bytes:
+                break
+            os.remove(path)
+            total_size -= size
+
+    def clear(self):
+        self.memory.clear()
+        if not self.enable_disk:
+            return
+        for filename in os.listdir(self.directory):
+            if filename.endswith(".pkl"):
+                os.remove(os.path.join(self.directory, filename))
+
+    def report(self):
+        return "%s memory hits, %s disk hits, %s computed" % (self.hits, self.disk_hits, self.misses)
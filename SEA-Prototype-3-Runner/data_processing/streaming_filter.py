@@ -0,0 +1,84 @@
+import math
+
+
+class AlphaBetaFilter:
+    """Causal smoother and rate estimator that keeps two numbers of state and does constant work per sample.
+
+    A critically damped alpha-beta tracker. The gains come from time_constant and each sample's own interval, so
+    dropped or bunched up packets don't change how much smoothing is applied. Lags a ramp by nothing once settled
+    and a step by roughly time_constant.
+    """
+
+    def __init__(self, time_constant=0.1, max_interval=0.5):
+        self.time_constant = time_constant  # seconds
+        # a gap longer than this restarts the filter instead of extrapolating across it
+        self.max_interval = max_interval
+
+        self.value = None
+        self.rate = 0.0
+        self.prev_timestamp = None
+
+    def reset(self):
+        self.value = None
+        self.rate = 0.0
+        self.prev_timestamp = None
+
+    def gains(self, interval):
+        alpha = 1.0 - math.exp(-interval / self.time_constant)
+        # critically damped tracker (Kalata): beta = 2(2 - alpha) - 4 sqrt(1 - alpha)
+        beta = 2.0 * (2.0 - alpha) - 4.0 * math.sqrt(1.0 - alpha)
+        return alpha, beta
+
+    def update(self, timestamp, measurement):
+        """Returns (smoothed value, rate per second)"""
+        if self.value is None or timestamp - self.prev_timestamp > self.max_interval:
+            self.value = measurement
+            self.rate = 0.0
+            self.prev_timestamp = timestamp
+            return self.value, self.rate
+
+        interval = timestamp - self.prev_timestamp
+        if interval <= 0.0:
+            # repeated timestamp, nothing to predict across
+            return self.value, self.rate
+        self.prev_timestamp = timestamp
+
+        alpha, beta = self.gains(interval)
+        predicted = self.value + self.rate * interval
+        residual = measurement - predicted
+        self.value = predicted + alpha * residual
+        self.rate += beta * residual / interval
+        return self.value, self.rate
+
+
+if __name__ == '__main__':
+    def test():
+        import numpy as np
+
+        random = np.random.RandomState(0)
+        timestamps = np.cumsum(random.uniform(0.008, 0.012, 3000))
+        # ramp at 0.5 rad/s then hold, with encoder tick sized noise
+        truth = np.where(timestamps < 15.0, 0.5 * timestamps, 7.5)
+        measurements = truth + random.normal(0.0, 0.003, len(timestamps))
+
+        smoother = AlphaBetaFilter(time_constant=0.1)
+        values = []
+        rates = []
+        for timestamp, measurement in zip(timestamps, measurements):
+            value, rate = smoother.update(timestamp, measurement)
+            values.append(value)
+            rates.append(rate)
+        values = np.array(values)
+        rates = np.array(rates)
+
+        ramp = (timestamps > 2.0) & (timestamps < 15.0)
+        hold = timestamps > 17.0
+        raw_noise = np.std(measurements[hold] - truth[hold])
+        smoothed_noise = np.std(values[hold] - truth[hold])
+        assert smoothed_noise < raw_noise / 2.0, (smoothed_noise, raw_noise)
+        assert abs(np.mean(values[ramp] - truth[ramp])) < 0.005, np.mean(values[ramp] - truth[ramp])
+        assert abs(np.mean(rates[ramp]) - 0.5) < 0.05, np.mean(rates[ramp])
+        assert abs(np.mean(rates[hold])) < 0.05, np.mean(rates[hold])
+        print("noise %0.5f -> %0.5f rad, ramp rate %0.3f rad/s" % (raw_noise, smoothed_noise, np.mean(rates[ramp])))
+
+    test()
@@ -0,0 +1,499 @@
+import os
+import json
+import time
+import argparse
+from collections import namedtuple
+
+import numpy as np
+
+from .torque_table import TorqueTable
+from .brake_profile import build_ramp_profile
+from .waveforms import build_waveform
+from .log_parser import session_log_path, stream_directories
+from .compressed_log import CompressedLogWriter, compressed_log_path
+from .experiment_helpers.encoder_constants import *
+
+SyntheticSessionConfig = namedtuple(
+    "SyntheticSessionConfig",
+
+    "k "  # Nm/rad
+    "forward_backlash_rad "
+    "backward_backlash_rad "
+    "encoder_noise_ticks "
+    "abs_encoder_noise_ticks "
+    "current_noise_mA "
+    "encoder_rate "  # packets per second
+    "brake_rate "
+    "dropout_rate "  # fraction of packets lost
+    "dropout_burst_length "  # mean packets per dropout
+    "wrap_glitch_rate "  # fraction of absolute encoder readings that jump by 300..950 ticks for one sample
+    "abs_encoder_fixed_diff "
+    "step_duration "
+    "num_steps "
+    "min_current_mA "
+    "torque_table_path "
+    "motor_speed_rad "  # rad/s of the motor while the experiment runs
+    "start_time "  # unix time the session starts logging at
+    "clock_drift_ppm "  # how fast both arduino clocks run against the host's
+    "first_packet_latency "  # extra seconds the first packet of each stream spends in the USB stack
+    "experiment_kind "  # which of ExperimentNode's experiments to mimic, one of experiment_kinds
+    "seed "
+)
+
+# queued staircase, staircase with adaptive step dwell, or a streamed waveform with the motor going one way
+experiment_kinds = ("staircase", "adaptive", "waveform")
+
+# about the size of the recorded sessions. Scale step_duration to get longer ones
+default_synthetic_config = SyntheticSessionConfig(
+    k=5.0,
+    forward_backlash_rad=0.02,
+    backward_backlash_rad=-0.02,
+    encoder_noise_ticks=0.5,
+    abs_encoder_noise_ticks=0.5,
+    current_noise_mA=0.1,
+    encoder_rate=100.0,
+    brake_rate=10.0,
+    dropout_rate=0.0,
+    dropout_burst_length=1.0,
+    wrap_glitch_rate=0.0,
+    abs_encoder_fixed_diff=259.0,
+    step_duration=2.0,
+    num_steps=50,
+    min_current_mA=15.0,
+    torque_table_path="brake_torque_data/B15 Torque Table.csv",
+    motor_speed_rad=0.5,
+    start_time=1551496126.0,
+    clock_drift_ppm=0.0,
+    first_packet_latency=0.0,
+    experiment_kind="staircase",
+    seed=0,
+)
+
+# what the analysis should find. Times are unix times like the ones DataAggregator gets
+SyntheticTruth = namedtuple(
+    "SyntheticTruth",
+
+    "k "
+    "forward_backlash_rad "
+    "backward_backlash_rad "
+    "experiment_start_time "
+    "motor_direction_switch_time "
+    "experiment_stop_time "
+    "num_encoder_packets "
+    "num_brake_packets "
+    "abs_encoder_fixed_diff "
+)
+
+# seconds from the logs opening to the arduinos connecting, the connection to the experiment starting,
+# and the experiment ending to the nodes shutting down
+connect_delay = 5.5
+lead_time = 10.0
+tail_time = 1.0
+
+teensy_clock_offset = 1000.0
+motor_command = 3200
+
+# ExperimentNode's default. Adaptive steps dwell anywhere from this to step_duration
+adaptive_min_dwell = 0.5
+
+waveform_rate = 20.0
+
+# atlasbuggy writes its message buffer out about every 16KB
+log_buffer_size = 2 ** 14
+
+generate_chunk_size = 2 ** 17
+
+encoder_packet_format = "[DEBUG, %0.7f]: Packet(timestamp=%0.6f, global_sequence_num=%d, sequence_num=0, " \
+                        "data=[%0.2f, %0.2f, %d, %d, %d, %d, %d], receive_time=%0.7f, name=enc)\n"
+brake_packet_format = "Packet(timestamp=%0.6f, global_sequence_num=%d, sequence_num=0, " \
+                      "data=[%0.2f, %0.2f, %0.2f, %0.1f, %0.2f, %d, %0.2f], receive_time=%0.7f, name=brake)"
+
+
+def log_date(timestamp):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp)) + ",%03d" % (int(timestamp * 1000) % 1000)
+
+
+def log_header(name, source, level, timestamp):
+    return "[%s @ %s][%s] %s: " % (name, source, level, log_date(timestamp))
+
+
+class SessionTimeline:
+    """Ground truth of everything the rig does, as vectorized functions of seconds since the logs opened"""
+
+    def __init__(self, config):
+        if config.experiment_kind not in experiment_kinds:
+            raise ValueError("Unknown experiment kind '%s'. Choose from %s" % (config.experiment_kind, experiment_kinds))
+        self.config = config
+        torque_table = TorqueTable(config.torque_table_path)
+        self.connect_time = connect_delay
+        self.start_time = self.connect_time + lead_time
+
+        if config.experiment_kind == "waveform":
+            self.waveform = build_waveform(torque_table, synthetic_waveform_spec(config),
+                                           torque_table.to_torque(True, config.min_current_mA),
+                                           torque_table.max_torque, motor_command)
+            # the motor never reverses, the switch is the end of the experiment
+            self.switch_time = self.start_time + self.waveform.duration
+            self.stop_time = self.switch_time
+        else:
+            self.waveform = None
+            profile = build_ramp_profile(torque_table, config.step_duration, config.num_steps,
+                                         config.min_current_mA)
+            self.step_currents = np.array(profile.currents_mA)
+            # ramp up on the forcing curve, back down on the unforcing curve
+            self.step_torques = np.concatenate((
+                torque_table.to_torque(True, self.step_currents[:config.num_steps]),
+                torque_table.to_torque(False, self.step_currents[config.num_steps:]),
+            ))
+
+            # seconds from the start of each direction's ramp to each step, one row per direction
+            num_steps = len(self.step_currents)
+            if config.experiment_kind == "adaptive":
+                dwell_random = np.random.RandomState(config.seed + 1)
+                step_durations = dwell_random.uniform(adaptive_min_dwell, config.step_duration, (2, num_steps))
+            else:
+                step_durations = np.full((2, num_steps), config.step_duration)
+            self.step_starts = np.cumsum(step_durations, axis=1) - step_durations
+
+            self.switch_time = self.start_time + np.sum(step_durations[0])
+            self.stop_time = self.switch_time + np.sum(step_durations[1])
+        self.end_time = self.stop_time + tail_time
+
+    @property
+    def has_switch(self):
+        return self.waveform is None
+
+    def step_index(self, t):
+        """Index into the ramp for each time and the direction sign. Index is -1 outside the experiment"""
+        forward = (t >= self.start_time) & (t < self.switch_time)
+        backward = (t >= self.switch_time) & (t < self.stop_time)
+        index = np.where(
+            backward,
+            np.searchsorted(self.step_starts[1], t - self.switch_time, side="right"),
+            np.searchsorted(self.step_starts[0], t - self.start_time, side="right"),
+        ) - 1
+        index = np.clip(index, 0, len(self.step_currents) - 1)
+        index = np.where(forward | backward, index, -1)
+        sign = np.where(backward, -1.0, 1.0)
+        return index, sign
+
+    def waveform_index(self, t):
+        """Index of the waveform sample that's out at each time. -1 outside the experiment"""
+        index = np.floor((t - self.start_time) * self.waveform.rate).astype(np.int64)
+        return np.where((t >= self.start_time) & (t < self.stop_time),
+                        np.clip(index, 0, len(self.waveform) - 1), -1)
+
+    def set_point_mA(self, t):
+        if self.waveform is not None:
+            index = self.waveform_index(t)
+            return np.where(index >= 0, self.waveform.current_mA[index], 0.0)
+        index, _ = self.step_index(t)
+        return np.where(index >= 0, self.step_currents[index], 0.0)
+
+    def torque_nm(self, t):
+        if self.waveform is not None:
+            index = self.waveform_index(t)
+            return np.where(index >= 0, self.waveform.torque_nm[index], 0.0)
+        index, sign = self.step_index(t)
+        return np.where(index >= 0, sign * self.step_torques[index], 0.0)
+
+    def motor_rad(self, t):
+        speed = self.config.motor_speed_rad
+        forward = np.clip(t - self.start_time, 0.0, self.switch_time - self.start_time) * speed
+        backward = np.clip(t - self.switch_time, 0.0, self.stop_time - self.switch_time) * speed
+        return forward - backward
+
+    def backlash_rad(self, t):
+        return np.where(t < self.switch_time, self.config.forward_backlash_rad, self.config.backward_backlash_rad)
+
+
+def synthetic_waveform_spec(config):
+    """The waveform a synthetic "waveform" session streams, as long as the staircase would take"""
+    return {"kind": "multisine", "duration": 4 * config.num_steps * config.step_duration, "rate": waveform_rate}
+
+
+def packet_times(random, start, stop, rate):
+    """Evenly spaced packet times with a little jitter"""
+    times = start + np.arange(int((stop - start) * rate)) / rate
+    return times + random.uniform(0.0, 0.2 / rate, len(times))
+
+
+def dropout_mask(random, num_packets, rate, burst_length):
+    """True for packets that made it. Bursts of lost packets with a mean length of burst_length"""
+    if rate <= 0.0 or num_packets == 0:
+        return np.ones(num_packets, dtype=bool)
+    starts = np.flatnonzero(random.uniform(size=num_packets) < rate / burst_length)
+    lengths = random.geometric(1.0 / burst_length, len(starts))
+    counts = np.zeros(num_packets + 1, dtype=np.int64)
+    np.add.at(counts, starts, 1)
+    np.add.at(counts, np.minimum(starts + lengths, num_packets), -1)
+    kept = np.cumsum(counts[:-1]) == 0
+    # DataAggregator takes the clock offset from the first packet, always keep it
+    kept[0] = True
+    return kept
+
+
+class LogWriter:
+    """Writes atlasbuggy formatted log lines, plain or compressed"""
+
+    def __init__(self, path, name, compress):
+        directory = os.path.split(path)[0]
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.name = name
+        if compress:
+            self.path = compressed_log_path(path)
+            self.file = CompressedLogWriter(self.path)
+        else:
+            self.path = path
+            self.file = open(path, "w", buffering=2 ** 20)
+
+    def line(self, source, level, timestamp, message):
+        self.file.write(log_header(self.name, source, level, timestamp) + message + "\n")
+
+    def buffer(self, entries, flush_time):
+        """One message buffer. entries are already formatted '[LEVEL, time]: message' lines"""
+        self.line("node.py:82", "DEBUG", flush_time, "[log buffer start]")
+        self.file.write("".join(entries))
+        self.file.write("[log buffer end]\n")
+        self.line("node.py:84", "DEBUG", flush_time, "logging message buffer (len=%s)" % sum(map(len, entries)))
+
+    def buffered_entries(self, entries, flush_times):
+        """Split entries into buffers of about log_buffer_size characters like atlasbuggy does"""
+        start = 0
+        size = 0
+        for index, entry in enumerate(entries):
+            size += len(entry)
+            if size >= log_buffer_size:
+                self.buffer(entries[start: index + 1], flush_times[index])
+                start = index + 1
+                size = 0
+        # whatever's left goes into the next chunk's first buffer
+        return entries[start:], flush_times[start:]
+
+    def close(self):
+        self.file.close()
+
+
+def write_encoder_log(writer, timeline, config, random, session_start):
+    writer.line("factory.py:85", "DEBUG", session_start, "Logging to: %s" % writer.path)
+
+    num_packets = 0
+    global_sequence_num = 0
+    leftover_entries = []
+    leftover_times = []
+    chunk_duration = generate_chunk_size / config.encoder_rate
+    chunk_start = timeline.connect_time
+    while chunk_start < timeline.end_time:
+        chunk_stop = min(chunk_start + chunk_duration, timeline.end_time)
+        t = packet_times(random, chunk_start, chunk_stop, config.encoder_rate)
+        chunk_start = chunk_stop
+        if len(t) == 0:
+            break
+
+        kept = dropout_mask(random, len(t), config.dropout_rate, config.dropout_burst_length)
+        if num_packets > 0:
+            kept[0] = random.uniform() >= config.dropout_rate
+        sequence_nums = global_sequence_num + np.arange(len(t))
+        global_sequence_num += len(t)
+
+        encoder_1_rad = timeline.motor_rad(t) + timeline.backlash_rad(t)
+        encoder_2_rad = encoder_1_rad - timeline.torque_nm(t) / config.k
+        motor_ticks = np.round(timeline.motor_rad(t) / motor_enc_ticks_to_rad)
+        encoder_1_ticks = np.round(encoder_1_rad / rel_enc_ticks_to_rad +
+                                   random.normal(0.0, config.encoder_noise_ticks, len(t)))
+        encoder_2_ticks = np.round(encoder_2_rad / rel_enc_ticks_to_rad +
+                                   random.normal(0.0, config.encoder_noise_ticks, len(t)))
+
+        abs_ticks = []
+        for encoder_rad, fixed_diff in ((encoder_1_rad, 0.0), (encoder_2_rad, config.abs_encoder_fixed_diff)):
+            ticks = np.round(encoder_rad / abs_enc_ticks_to_rad + fixed_diff +
+                             random.normal(0.0, config.abs_encoder_noise_ticks, len(t)))
+            glitches = random.uniform(size=len(t)) < config.wrap_glitch_rate
+            # jumps format_abs_enc_ticks should throw out, whichever way they wrap
+            ticks[glitches] += random.uniform(310.0, 714.0, np.count_nonzero(glitches)).round()
+            abs_ticks.append(np.mod(ticks, abs_ticks_per_rotation))
+
+        receive_times = session_start + t + random.uniform(0.0005, 0.002, len(t))
+        if num_packets == 0:
+            receive_times[0] += config.first_packet_latency
+        device_times = teensy_clock_offset + t * (1.0 + config.clock_drift_ppm * 1E-6)
+        columns = [
+            receive_times, device_times, sequence_nums,
+            abs_ticks[0] * 360.0 / abs_ticks_per_rotation, abs_ticks[1] * 360.0 / abs_ticks_per_rotation,
+            abs_ticks[0], abs_ticks[1], encoder_1_ticks, encoder_2_ticks, motor_ticks, receive_times,
+        ]
+        rows = zip(*[column[kept].tolist() for column in columns])
+        entries = leftover_entries + [encoder_packet_format % row for row in rows]
+        flush_times = leftover_times + receive_times[kept].tolist()
+        num_packets += int(np.count_nonzero(kept))
+        leftover_entries, leftover_times = writer.buffered_entries(entries, flush_times)
+
+    if len(leftover_entries) > 0:
+        writer.buffer(leftover_entries, leftover_times[-1])
+    writer.line("node.py:106", "INFO", session_start + timeline.end_time,
+                "Node took %ss to run" % (timeline.end_time - timeline.connect_time))
+    return num_packets
+
+
+def write_brake_log(writer, timeline, config, random, session_start):
+    writer.line("factory.py:85", "DEBUG", session_start, "Logging to: %s" % writer.path)
+
+    t = packet_times(random, timeline.connect_time, timeline.end_time, config.brake_rate)
+    kept = dropout_mask(random, len(t), config.dropout_rate, config.dropout_burst_length)
+    set_points = timeline.set_point_mA(t)
+    # a few mA flow with the brake off, the same as the recorded sessions
+    current = np.round(set_points + 3.0 + random.normal(0.0, config.current_noise_mA, len(t)), 2)
+    bus_voltage = np.round(12.03 + random.normal(0.0, 0.005, len(t)), 2)
+    shunt_voltage = current * 0.1
+    power = current * bus_voltage
+    receive_times = session_start + t + random.uniform(0.0005, 0.002, len(t))
+    receive_times[0] += config.first_packet_latency
+    # the Uno resets when the serial port opens, its clock starts with the first packet
+    device_times = (t - t[0]) * (1.0 + config.clock_drift_ppm * 1E-6)
+
+    start_packet = "Packet(timestamp=0, global_sequence_num=-1, sequence_num=0, data=[30.0, 0.0, 0.0], " \
+                   "receive_time=%0.7f, name=first_packet)" % (receive_times[0] - 0.1)
+    writer.line("brake_controller_bridge.py:31", "DEBUG", receive_times[0] - 0.1, "start_packet: '%s'" % start_packet)
+
+    columns = [device_times, np.arange(len(t)), shunt_voltage, bus_voltage, current, power, bus_voltage,
+               np.zeros(len(t)), set_points, receive_times]
+    entries = []
+    size = 0
+    for receive_time, row in zip(receive_times[kept].tolist(), zip(*[column[kept].tolist() for column in columns])):
+        packet = brake_packet_format % row
+        # the bridge logs every packet as it arrives as well as buffering it
+        writer.line("brake_controller_bridge.py:36", "DEBUG", receive_time, "packet: '%s'" % packet)
+        entries.append("[DEBUG, %0.7f]: %s\n" % (receive_time, packet))
+        size += len(entries[-1])
+        if size >= log_buffer_size:
+            writer.buffer(entries, receive_time)
+            entries = []
+            size = 0
+    if len(entries) > 0:
+        writer.buffer(entries, receive_time)
+
+    writer.line("node.py:106", "INFO", session_start + timeline.end_time,
+                "Node took %ss to run" % (timeline.end_time - timeline.connect_time))
+    return int(np.count_nonzero(kept))
+
+
+def write_motor_log(writer, timeline, session_start):
+    writer.line("factory.py:85", "DEBUG", session_start, "Logging to: %s" % writer.path)
+    writer.line("motor_controller_bridge.py:24", "DEBUG", session_start + timeline.connect_time, "Initializing...")
+    writer.line("motor_controller_bridge.py:27", "DEBUG", session_start + timeline.connect_time, "done!")
+    writer.line("motor_controller_bridge.py:50", "INFO", session_start + timeline.start_time,
+                "Executing motor command queue backlog")
+    writer.line("motor_controller_bridge.py:31", "DEBUG", session_start + timeline.start_time,
+                "command: %s" % -motor_command)
+    if timeline.has_switch:
+        writer.line("motor_controller_bridge.py:31", "DEBUG", session_start + timeline.switch_time,
+                    "command: %s" % motor_command)
+    writer.line("motor_controller_bridge.py:31", "DEBUG", session_start + timeline.stop_time, "command: 0")
+    writer.line("motor_controller_bridge.py:72", "INFO", session_start + timeline.stop_time,
+                "Command queue backlog finished!")
+    writer.line("node.py:106", "INFO", session_start + timeline.end_time,
+                "Node took %ss to run" % (timeline.end_time - timeline.connect_time))
+    writer.line("motor_controller_bridge.py:77", "DEBUG", session_start + timeline.end_time, "Tearing down")
+
+
+def write_experiment_log(writer, timeline, config, session_start):
+    writer.line("factory.py:85", "DEBUG", session_start, "Logging to: %s" % writer.path)
+    writer.line("experiment_node.py:68", "INFO", session_start, (
+        "Experiment:\n"
+        "\tStep duration: %f\n"
+        "\tNumber of steps: %s\n"
+        "\tApprox. experiment duration: %f\n"
+        "\tTorque table path: %s\n"
+        "\tSynthetic: k=%s, backlash=%s/%s"
+    ) % (config.step_duration, config.num_steps, timeline.stop_time - timeline.start_time, config.torque_table_path,
+         config.k, config.forward_backlash_rad, config.backward_backlash_rad))
+    if timeline.waveform is not None:
+        writer.line("experiment_node.py:205", "INFO", session_start + timeline.start_time,
+                    "Streaming waveform %s" % timeline.waveform)
+    writer.line("node.py:92", "INFO", session_start + timeline.connect_time, "setup")
+    writer.line("node.py:106", "INFO", session_start + timeline.end_time,
+                "Node took %ss to run" % (timeline.end_time - timeline.connect_time))
+    writer.line("node.py:101", "INFO", session_start + timeline.end_time, "teardown")
+
+
+def truth_path(directory, filename, log_root="logs"):
+    return os.path.join(log_root, directory, os.path.splitext(filename)[0] + ".truth.json")
+
+
+def generate_session(directory, filename, config=default_synthetic_config, log_root="logs", compress=False):
+    """Write brake, encoder, motor and experiment logs for a session with known K and backlash.
+    Returns the SyntheticTruth, which is also saved next to the logs"""
+    random = np.random.RandomState(config.seed)
+    timeline = SessionTimeline(config)
+    session_start = config.start_time
+
+    def open_writer(stream):
+        return LogWriter(session_log_path(directory, filename, stream, log_root), stream_directories[stream],
+                         compress)
+
+    writer = open_writer("encoders")
+    num_encoder_packets = write_encoder_log(writer, timeline, config, random, session_start)
+    writer.close()
+
+    writer = open_writer("brake")
+    num_brake_packets = write_brake_log(writer, timeline, config, random, session_start)
+    writer.close()
+
+    writer = open_writer("motor")
+    write_motor_log(writer, timeline, session_start)
+    writer.close()
+
+    writer = open_writer("experiment")
+    write_experiment_log(writer, timeline, config, session_start)
+    writer.close()
+
+    # no switch is 0.0, the same as the analysis has it
+    switch_time = session_start + timeline.switch_time if timeline.has_switch else 0.0
+    truth = SyntheticTruth(
+        config.k, config.forward_backlash_rad, config.backward_backlash_rad,
+        session_start + timeline.start_time, switch_time, session_start + timeline.stop_time,
+        num_encoder_packets, num_brake_packets, config.abs_encoder_fixed_diff,
+    )
+    with open(truth_path(directory, filename, log_root), "w") as file:
+        json.dump(dict(truth._asdict(), config=config._asdict()), file, indent=4)
+    return truth
+
+
+def load_truth(directory, filename, log_root="logs"):
+    path = truth_path(directory, filename, log_root)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as file:
+        contents = json.load(file)
+    return SyntheticTruth(*[contents[field] for field in SyntheticTruth._fields])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic session with known K and backlash")
+    parser.add_argument("directory", help="session directory under the log root, like the recorded date folders")
+    parser.add_argument("filename", nargs="?", default="00_00_00.log")
+    parser.add_argument("--log-root", default="logs")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplies the session length")
+    parser.add_argument("--compress", action="store_true", help="write .zb logs")
+    for field in SyntheticSessionConfig._fields:
+        default = getattr(default_synthetic_config, field)
+        parser.add_argument("--" + field.replace("_", "-"), type=type(default), default=default)
+    args = parser.parse_args()
+
+    config = SyntheticSessionConfig(*[getattr(args, field) for field in SyntheticSessionConfig._fields])
+    config = config._replace(step_duration=config.step_duration * args.scale)
+
+    t0 = time.time()
+    truth = generate_session(args.directory, args.filename, config, args.log_root, args.compress)
+    size = 0
+    for stream in stream_directories:
+        path = session_log_path(args.directory, args.filename, stream, args.log_root)
+        path = compressed_log_path(path) if args.compress else path
+        size += os.path.getsize(path)
+    print("%s encoder and %s brake packets, %0.1fMB in %0.1fs" % (
+        truth.num_encoder_packets, truth.num_brake_packets, size / 1E6, time.time() - t0))
+
+
+if __name__ == '__main__':
+    main()
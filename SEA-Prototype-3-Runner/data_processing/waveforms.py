@@ -0,0 +1,208 @@
+import numpy as np
+
+from .packet_blocks import LoggedPacket
+from .log_parser import iter_packets
+
+# commands per second each controller is streamed at most. The brake parses commands in its loop between
+# current readings, the SMC takes them as fast as the serial port delivers
+brake_max_command_rate = 50.0
+motor_max_command_rate = 100.0
+
+waveform_packet_name = "waveform"
+
+# taps of maximal length linear feedback shift registers, by order
+prbs_taps = {
+    5: (5, 3),
+    6: (6, 5),
+    7: (7, 6),
+    8: (8, 6, 5, 4),
+    9: (9, 5),
+    10: (10, 7),
+    11: (11, 9),
+}
+
+
+def multisine_signal(times, duration, min_frequency=0.05, max_frequency=2.0, num_frequencies=20):
+    """Log spaced tones with Schroeder phases (low crest factor). Every tone fits a whole number of periods into
+    duration so the record is periodic and there's no leakage when it's analyzed"""
+    resolution = 1.0 / duration
+    harmonics = np.unique(np.round(np.geomspace(min_frequency, max_frequency, num_frequencies) / resolution))
+    harmonics = harmonics[harmonics >= 1]
+    num_tones = len(harmonics)
+    phases = -np.pi * np.arange(num_tones) * (np.arange(num_tones) - 1) / num_tones
+
+    signal = np.zeros(len(times))
+    for harmonic, phase in zip(harmonics, phases):
+        signal += np.cos(2.0 * np.pi * harmonic * resolution * times + phase)
+    return normalize_signal(signal)
+
+
+def chirp_signal(times, duration, start_frequency=0.05, stop_frequency=2.0, logarithmic=True):
+    """Frequency sweep from start to stop over duration. Starts and ends at 0"""
+    if logarithmic:
+        sweep_rate = np.log(stop_frequency / start_frequency) / duration
+        phase = 2.0 * np.pi * start_frequency * (np.exp(sweep_rate * times) - 1.0) / sweep_rate
+    else:
+        phase = 2.0 * np.pi * (start_frequency * times +
+                               (stop_frequency - start_frequency) * times ** 2 / (2.0 * duration))
+    return 0.5 - 0.5 * np.cos(phase)
+
+
+def prbs_signal(times, duration, bit_duration=0.5, order=7, seed=1):
+    """Maximal length pseudo random binary sequence, 0 or 1 for bit_duration at a time"""
+    taps = prbs_taps[order]
+    num_bits = 2 ** order - 1
+    state = seed & num_bits or 1
+    bits = np.empty(num_bits)
+    for index in range(num_bits):
+        bits[index] = state & 1
+        feedback = 0
+        for tap in taps:
+            feedback ^= (state >> (order - tap)) & 1
+        state = (state >> 1) | (feedback << (order - 1))
+    return bits[(times // bit_duration).astype(np.int64) % num_bits]
+
+
+def staircase_signal(times, duration, num_steps=50):
+    """Equal steps up then back down, like ExperimentNode.ramp_up_brake and ramp_down_brake"""
+    step_duration = duration / (2 * num_steps)
+    step_index = np.minimum((times // step_duration).astype(np.int64), 2 * num_steps - 1)
+    return np.where(step_index < num_steps, step_index + 1, 2 * num_steps - step_index) / num_steps
+
+
+def normalize_signal(signal):
+    """Scale to 0..1"""
+    span = np.max(signal) - np.min(signal)
+    if span == 0.0:
+        return np.zeros(len(signal))
+    return (signal - np.min(signal)) / span
+
+
+signal_generators = {
+    "multisine": multisine_signal,
+    "chirp": chirp_signal,
+    "prbs": prbs_signal,
+    "staircase": staircase_signal,
+}
+
+
+def make_signal(times, duration, spec):
+    """spec is a dict with the generator's name under "kind" and its keyword arguments"""
+    params = dict(spec)
+    kind = params.pop("kind")
+    if kind not in signal_generators:
+        raise ValueError("Unknown waveform '%s'. Choose from %s" % (kind, sorted(signal_generators)))
+    return signal_generators[kind](times, duration, **params)
+
+
+def forcing_mask(torque):
+    """True while the torque is going up. Holds keep the direction of the last change"""
+    changes = np.diff(torque, prepend=torque[0])
+    last_change = np.maximum.accumulate(np.where(changes != 0.0, np.arange(len(torque)), 0))
+    return changes[last_change] >= 0.0
+
+
+def torque_to_current_mA(torque_table, torque):
+    """Rising torque follows the forcing curve, falling torque the unforcing curve"""
+    forcing = forcing_mask(torque)
+    return np.where(forcing, torque_table.to_current_mA(True, torque), torque_table.to_current_mA(False, torque))
+
+
+class Waveform:
+    """Brake and motor commands sampled at rate, ready to be streamed"""
+
+    def __init__(self, name, rate, torque_nm, current_mA, motor_speed):
+        self.name = name
+        self.rate = rate
+        self.torque_nm = torque_nm
+        self.current_mA = current_mA
+        self.motor_speed = motor_speed
+        # seconds from the start of the waveform each sample is due
+        self.times = np.arange(len(torque_nm)) / rate
+
+    def __len__(self):
+        return len(self.times)
+
+    @property
+    def duration(self):
+        return len(self.times) / self.rate
+
+    def __str__(self):
+        return "%s: %0.1fs at %0.0fHz, %0.2f..%0.2fmA, motor %d..%d" % (
+            self.name, self.duration, self.rate, np.min(self.current_mA), np.max(self.current_mA),
+            np.min(self.motor_speed), np.max(self.motor_speed))
+
+
+def build_waveform(torque_table, spec, min_torque, max_torque, motor_speed=3200):
+    """Precompute a waveform from a spec like
+        {"kind": "chirp", "duration": 120.0, "rate": 20.0, "start_frequency": 0.05, "stop_frequency": 2.0}
+    The brake signal is scaled from min_torque to max_torque. The motor runs at motor_speed unless the spec has a
+    "motor" entry, another signal spec which is scaled from -motor_speed to motor_speed.
+    """
+    params = dict(spec)
+    duration = float(params.pop("duration"))
+    rate = float(params.pop("rate"))
+    motor_spec = params.pop("motor", None)
+    if rate > brake_max_command_rate or (motor_spec is not None and rate > motor_max_command_rate):
+        raise ValueError("Waveform rate %sHz is faster than the controllers take commands (brake %sHz, motor %sHz)" % (
+            rate, brake_max_command_rate, motor_max_command_rate))
+
+    times = np.arange(int(round(duration * rate))) / rate
+    torque = min_torque + make_signal(times, duration, params) * (max_torque - min_torque)
+    current_mA = torque_to_current_mA(torque_table, torque)
+
+    if motor_spec is None:
+        speed = np.full(len(times), int(motor_speed))
+    else:
+        speed = np.round((2.0 * make_signal(times, duration, motor_spec) - 1.0) * motor_speed).astype(np.int64)
+
+    return Waveform(params["kind"], rate, torque, current_mA, speed)
+
+
+class WaveformPacket(LoggedPacket):
+    """One streamed sample: timestamp is when it was due, receive_time when it went out"""
+
+    def __init__(self, deadline, index, current_mA, motor_speed, torque_nm, sent_time):
+        super(WaveformPacket, self).__init__(
+            waveform_packet_name, deadline, index, [round(float(current_mA), 2), int(motor_speed),
+                                                    round(float(torque_nm), 5)], sent_time)
+
+
+def load_waveform_log(path):
+    """Commanded samples from an ExperimentNode log: (deadlines, sent times, current mA, motor speed, torque)"""
+    rows = [[packet.timestamp, packet.receive_time] + packet.data for packet in iter_packets(path, waveform_packet_name)]
+    rows = np.array(rows, dtype=np.float64).reshape(-1, 5)
+    return rows[:, 0], rows[:, 1], rows[:, 2], rows[:, 3], rows[:, 4]
+
+
+if __name__ == '__main__':
+    def test():
+        from .torque_table import TorqueTable
+
+        table = TorqueTable("brake_torque_data/B15 Torque Table.csv")
+        min_torque = table.to_torque(True, 15.0)
+        for spec in ({"kind": "multisine", "duration": 100.0, "rate": 20.0},
+                     {"kind": "chirp", "duration": 100.0, "rate": 20.0,
+                      "motor": {"kind": "chirp", "start_frequency": 0.01, "stop_frequency": 0.1}},
+                     {"kind": "prbs", "duration": 100.0, "rate": 20.0, "order": 7, "bit_duration": 0.5},
+                     {"kind": "staircase", "duration": 200.0, "rate": 10.0, "num_steps": 50}):
+            waveform = build_waveform(table, spec, min_torque, table.max_torque)
+            assert len(waveform) == int(spec["duration"] * spec["rate"])
+            assert np.all(waveform.torque_nm >= min_torque - 1E-9), spec
+            assert np.all(waveform.torque_nm <= table.max_torque + 1E-9), spec
+            print(waveform)
+
+        # a maximal length sequence is balanced, one more 1 than 0s
+        bits = prbs_signal(np.arange(127.0), 127.0, bit_duration=1.0, order=7)
+        assert np.sum(bits) == 64, np.sum(bits)
+
+        # the staircase ramps up through the same currents as ExperimentNode. On the way down it keeps the
+        # forcing curve's torque range instead of the unforcing curve's
+        from .brake_profile import build_ramp_profile
+        waveform = build_waveform(table, {"kind": "staircase", "duration": 200.0, "rate": 1.0, "num_steps": 50},
+                                  min_torque, table.max_torque)
+        profile = build_ramp_profile(table, 2.0, 50, 15.0)
+        assert np.allclose(waveform.current_mA[:100:2], profile.currents_mA[:50]), \
+            np.max(np.abs(waveform.current_mA[:100:2] - profile.currents_mA[:50]))
+
+    test()
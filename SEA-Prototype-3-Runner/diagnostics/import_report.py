@@ -0,0 +1,56 @@
+import sys
+import time
+import subprocess
+from collections import namedtuple
+
+ImportCost = namedtuple("ImportCost", "module self_sec cumulative_sec depth")
+
+
+def measure_imports(module_name):
+    """Import a module in a fresh interpreter with -X importtime and return what every import cost,
+    most expensive first. A fresh interpreter is needed, anything already imported here would be free."""
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import %s" % module_name],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True
+    )
+    if process.returncode != 0:
+        raise ImportError("Importing %s failed:\n%s" % (module_name, process.stderr.strip().splitlines()[-1]))
+
+    costs = []
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        costs.append(ImportCost(name.strip(), int(self_us) / 1E6, int(cumulative_us) / 1E6, depth))
+
+    costs.sort(key=lambda cost: -cost.cumulative_sec)
+    return costs
+
+
+def time_import(module_name):
+    """Wall time for a fresh interpreter to import a module, interpreter startup included"""
+    t0 = time.perf_counter()
+    process = subprocess.run([sys.executable, "-c", "import %s" % module_name],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    duration = time.perf_counter() - t0
+    if process.returncode != 0:
+        raise ImportError("Importing %s failed" % module_name)
+    return duration
+
+
+def print_import_report(module_name, num_shown=25):
+    costs = measure_imports(module_name)
+    total = costs[0].cumulative_sec if len(costs) > 0 else 0.0
+    print("Importing %s: %0.3fs" % (module_name, total))
+    for cost in costs[:num_shown]:
+        print("\t%-50s %8.3fs cumulative %8.3fs self" % (cost.module, cost.cumulative_sec, cost.self_sec))
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or ["main", "analyzer"]:
+        try:
+            print_import_report(name)
+        except ImportError as error:
+            print(error)
+        print()
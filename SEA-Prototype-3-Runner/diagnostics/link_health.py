@@ -0,0 +1,283 @@
+import os
+import argparse
+from collections import namedtuple
+
+import numpy as np
+
+from data_processing.log_parser import session_log_path, iter_packets
+from data_processing.compressed_log import find_log, compressed_log_extension
+
+LinkHealthReport = namedtuple(
+    "LinkHealthReport",
+
+    "name "
+    "num_packets "
+    "duration_sec "
+    "missing_sequence "  # packets the host numbered but never handed over (global_sequence_num gaps)
+    "duplicates "
+    "out_of_order "
+    "device_sequence_gaps "  # only counts if the firmware numbers its packets, sequence_num is 0 otherwise
+    "timestamp_reversals "
+    "timestamp_gaps "  # device timestamp intervals longer than gap_factor * nominal_interval
+    "estimated_lost "  # packets that fit in those gaps
+    "loss_fraction "
+    "mean_jitter "  # mean |receive interval - device interval|, seconds
+    "max_jitter "
+    "max_receive_gap "  # longest the host went without a packet
+    "drift_ppm "  # host seconds per device second, less one. Negative when the device clock runs fast
+)
+
+# seconds between packets each firmware sends
+nominal_intervals = {
+    "enc": 0.01,
+    "brake": 0.1,
+}
+
+# log stream -> name of the packets it's checked on
+stream_packet_names = {
+    "brake": "brake",
+    "encoders": "enc",
+}
+
+
+class LinkHealth:
+    """Sequence, loss, jitter and clock drift bookkeeping for one device's packets.
+
+    update() only appends to a list so it's cheap enough to call from a bridge's read loop. Pending packets are
+    folded in with a vectorized pass every flush_size packets or when a report is asked for. The same pass runs
+    over whole arrays for logs (update_arrays), so the live and offline numbers are the same.
+
+    Every packet counts toward the global_sequence_num checks since the arduino numbers all of its packets
+    together. Timing is only checked on packets named packet_name.
+    """
+
+    def __init__(self, packet_name, nominal_interval=None, gap_factor=1.5, flush_size=256):
+        self.packet_name = packet_name
+        if nominal_interval is None:
+            nominal_interval = nominal_intervals[packet_name]
+        self.nominal_interval = nominal_interval
+        self.gap_factor = gap_factor
+        self.flush_size = flush_size
+
+        self.pending_global_sequence = []
+        self.pending_timing = []
+
+        self.prev_global_sequence_num = None
+        self.missing_sequence = 0
+        self.duplicates = 0
+        self.out_of_order = 0
+
+        self.num_packets = 0
+        self.first_timestamp = None
+        self.first_receive_time = None
+        self.prev_timestamp = None
+        self.prev_receive_time = None
+        self.prev_sequence_num = None
+        self.device_sequence_gaps = 0
+        self.timestamp_reversals = 0
+        self.timestamp_gaps = 0
+        self.estimated_lost = 0
+        self.jitter_sum = 0.0
+        self.max_jitter = 0.0
+        self.max_receive_gap = 0.0
+
+        # least squares sums for receive time against device time, relative to the first packet
+        self.sum_x = 0.0
+        self.sum_y = 0.0
+        self.sum_xx = 0.0
+        self.sum_xy = 0.0
+
+    def update(self, packet):
+        if packet.global_sequence_num >= 0:  # the start packet is numbered -1
+            self.pending_global_sequence.append(packet.global_sequence_num)
+        if packet.name == self.packet_name:
+            self.pending_timing.append((packet.timestamp, packet.receive_time, packet.sequence_num))
+        if len(self.pending_global_sequence) >= self.flush_size or len(self.pending_timing) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending_global_sequence) > 0:
+            self.update_sequence(np.array(self.pending_global_sequence))
+            self.pending_global_sequence = []
+        if len(self.pending_timing) > 0:
+            timing = np.array(self.pending_timing, dtype=np.float64)
+            self.update_timing(timing[:, 0], timing[:, 1], timing[:, 2])
+            self.pending_timing = []
+
+    def update_arrays(self, global_sequence_nums, timestamps, receive_times, sequence_nums):
+        """global_sequence_nums for every packet from the device, the rest for packets named packet_name"""
+        self.flush()
+        global_sequence_nums = np.asarray(global_sequence_nums)
+        self.update_sequence(global_sequence_nums[global_sequence_nums >= 0])
+        self.update_timing(np.asarray(timestamps, dtype=np.float64), np.asarray(receive_times, dtype=np.float64),
+                           np.asarray(sequence_nums, dtype=np.float64))
+
+    def update_sequence(self, global_sequence_nums):
+        if len(global_sequence_nums) == 0:
+            return
+        if self.prev_global_sequence_num is not None:
+            global_sequence_nums = np.concatenate(([self.prev_global_sequence_num], global_sequence_nums))
+        self.prev_global_sequence_num = int(global_sequence_nums[-1])
+
+        steps = np.diff(global_sequence_nums)
+        self.duplicates += int(np.count_nonzero(steps == 0))
+        self.out_of_order += int(np.count_nonzero(steps < 0))
+        self.missing_sequence += int(np.sum(steps[steps > 1] - 1))
+
+    def update_timing(self, timestamps, receive_times, sequence_nums):
+        if len(timestamps) == 0:
+            return
+        if self.first_timestamp is None:
+            self.first_timestamp = timestamps[0]
+            self.first_receive_time = receive_times[0]
+        self.num_packets += len(timestamps)
+
+        x = timestamps - self.first_timestamp
+        y = receive_times - self.first_receive_time
+        self.sum_x += float(np.sum(x))
+        self.sum_y += float(np.sum(y))
+        self.sum_xx += float(np.sum(x * x))
+        self.sum_xy += float(np.sum(x * y))
+
+        if self.prev_timestamp is not None:
+            timestamps = np.concatenate(([self.prev_timestamp], timestamps))
+            receive_times = np.concatenate(([self.prev_receive_time], receive_times))
+            sequence_nums = np.concatenate(([self.prev_sequence_num], sequence_nums))
+        self.prev_timestamp = timestamps[-1]
+        self.prev_receive_time = receive_times[-1]
+        self.prev_sequence_num = sequence_nums[-1]
+        if len(timestamps) < 2:
+            return
+
+        device_intervals = np.diff(timestamps)
+        receive_intervals = np.diff(receive_times)
+        sequence_steps = np.diff(sequence_nums)
+
+        self.device_sequence_gaps += int(np.count_nonzero((sequence_steps != 0) & (sequence_steps != 1)))
+        self.timestamp_reversals += int(np.count_nonzero(device_intervals < 0.0))
+        gaps = device_intervals > self.gap_factor * self.nominal_interval
+        self.timestamp_gaps += int(np.count_nonzero(gaps))
+        self.estimated_lost += int(np.sum(np.round(device_intervals[gaps] / self.nominal_interval) - 1))
+
+        jitter = np.abs(receive_intervals - device_intervals)
+        self.jitter_sum += float(np.sum(jitter))
+        self.max_jitter = max(self.max_jitter, float(np.max(jitter)))
+        self.max_receive_gap = max(self.max_receive_gap, float(np.max(receive_intervals)))
+
+    def drift_ppm(self):
+        n = self.num_packets
+        denominator = n * self.sum_xx - self.sum_x ** 2
+        if n < 2 or denominator <= 0.0:
+            return 0.0
+        rate = (n * self.sum_xy - self.sum_x * self.sum_y) / denominator
+        return (rate - 1.0) * 1E6
+
+    def report(self, name=None):
+        self.flush()
+        duration = 0.0
+        if self.prev_receive_time is not None:
+            duration = self.prev_receive_time - self.first_receive_time
+        num_intervals = max(self.num_packets - 1, 1)
+        expected = self.num_packets + self.estimated_lost
+        return LinkHealthReport(
+            self.packet_name if name is None else name, self.num_packets, float(duration),
+            self.missing_sequence, self.duplicates, self.out_of_order, self.device_sequence_gaps,
+            self.timestamp_reversals, self.timestamp_gaps, self.estimated_lost,
+            self.estimated_lost / expected if expected > 0 else 0.0,
+            self.jitter_sum / num_intervals, self.max_jitter, self.max_receive_gap, self.drift_ppm()
+        )
+
+
+def link_problems(report, max_loss_fraction=0.01, max_receive_gap=1.0, max_drift_ppm=2000.0):
+    """Reasons the link is suspect, empty if it looks fine"""
+    problems = []
+    if report.num_packets == 0:
+        problems.append("no packets")
+        return problems
+    if report.loss_fraction > max_loss_fraction:
+        problems.append("lost %0.1f%% of packets" % (report.loss_fraction * 100.0))
+    if report.missing_sequence > 0:
+        problems.append("%s packets numbered but not logged" % report.missing_sequence)
+    if report.duplicates > 0 or report.out_of_order > 0 or report.timestamp_reversals > 0:
+        problems.append("%s duplicate, %s out of order, %s timestamp reversals" % (
+            report.duplicates, report.out_of_order, report.timestamp_reversals))
+    if report.max_receive_gap > max_receive_gap:
+        problems.append("went %0.2fs without a packet" % report.max_receive_gap)
+    if abs(report.drift_ppm) > max_drift_ppm:
+        problems.append("clock drift of %0.0fppm" % report.drift_ppm)
+    return problems
+
+
+def format_report(report):
+    problems = link_problems(report)
+    return "%-8s %7d packets over %7.1fs, lost %5d (%5.2f%%) in %4d gaps, seq missing/dup/ooo %d/%d/%d, " \
+           "jitter mean/max %5.2f/%7.2fms, max silence %6.3fs, drift %+6.0fppm: %s" % (
+               report.name, report.num_packets, report.duration_sec, report.estimated_lost,
+               report.loss_fraction * 100.0, report.timestamp_gaps, report.missing_sequence, report.duplicates,
+               report.out_of_order, report.mean_jitter * 1000.0, report.max_jitter * 1000.0,
+               report.max_receive_gap, report.drift_ppm, "; ".join(problems) if problems else "ok"
+           )
+
+
+def audit_log(path, packet_name, nominal_interval=None):
+    """One vectorized pass over a log file's packets"""
+    global_sequence_nums = []
+    timing = []
+    for packet in iter_packets(path):
+        global_sequence_nums.append(packet.global_sequence_num)
+        if packet.name == packet_name:
+            timing.append((packet.timestamp, packet.receive_time, packet.sequence_num))
+    timing = np.array(timing, dtype=np.float64).reshape(-1, 3)
+
+    health = LinkHealth(packet_name, nominal_interval)
+    health.update_arrays(global_sequence_nums, timing[:, 0], timing[:, 1], timing[:, 2])
+    return health.report()
+
+
+def audit_session(directory, filename, log_root="logs"):
+    """Health report of every packet stream a session logged, keyed by stream"""
+    reports = {}
+    for stream, packet_name in stream_packet_names.items():
+        path = session_log_path(directory, filename, stream, log_root)
+        if find_log(path) is None:
+            continue
+        reports[stream] = audit_log(path, packet_name)._replace(name=stream)
+    return reports
+
+
+def iter_sessions(log_root="logs"):
+    """(directory, filename) of every session with a brake log. A session with both a plain and a compressed log
+    comes up once, find_log reads the plain one"""
+    for directory in sorted(os.listdir(log_root)):
+        brake_directory = os.path.join(log_root, directory, "BrakeControllerBridge")
+        if not os.path.isdir(brake_directory):
+            continue
+        filenames = set()
+        for filename in os.listdir(brake_directory):
+            if filename.endswith(compressed_log_extension):
+                filename = filename[:-len(compressed_log_extension)]
+            if filename.endswith(".log"):
+                filenames.add(filename)
+        for filename in sorted(filenames):
+            yield directory, filename
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check a session's logged packets for loss, jitter and drift")
+    parser.add_argument("directory", nargs="?", default=None, help="session directory, all sessions if left out")
+    parser.add_argument("filename", nargs="?", default=None, help="session log, every one in directory if left out")
+    parser.add_argument("--log-root", default="logs")
+    args = parser.parse_args()
+
+    for directory, filename in iter_sessions(args.log_root):
+        if args.directory is not None and directory != args.directory:
+            continue
+        if args.filename is not None and filename != args.filename:
+            continue
+        print("%s/%s" % (directory, filename))
+        for report in audit_session(directory, filename, args.log_root).values():
+            print("    " + format_report(report))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,267 @@
+import io
+import os
+import sys
+import time
+import pstats
+import signal
+import asyncio
+import cProfile
+import threading
+import traceback
+import tracemalloc
+from weakref import WeakKeyDictionary
+from collections import deque
+
+from atlasbuggy import Node
+
+
+class NodeLoopStats:
+    def __init__(self, name, history_length=1000):
+        self.name = name
+        self.num_steps = 0
+        self.total_step_time = 0.0
+        self.max_step_time = 0.0
+        self.num_stalls = 0
+        self.prev_step_start = None
+
+        # time spent running between yields and time from one resume to the next
+        self.step_durations = deque(maxlen=history_length)
+        self.iteration_durations = deque(maxlen=history_length)
+
+    def record(self, start_time, duration):
+        self.num_steps += 1
+        self.total_step_time += duration
+        if duration > self.max_step_time:
+            self.max_step_time = duration
+        self.step_durations.append(duration)
+
+        if self.prev_step_start is not None:
+            self.iteration_durations.append(start_time - self.prev_step_start)
+        self.prev_step_start = start_time
+
+    @staticmethod
+    def percentile(values, fraction):
+        if len(values) == 0:
+            return 0.0
+        values = sorted(values)
+        return values[min(len(values) - 1, int(fraction * len(values)))]
+
+    def summary(self):
+        return "%-24s steps: %7d, busy: %8.3fs, step p50/p99/max: %7.2f/%7.2f/%7.2fms, " \
+               "resume interval p50: %7.2fms, stalls: %d" % (
+                   self.name, self.num_steps, self.total_step_time,
+                   self.percentile(self.step_durations, 0.5) * 1000.0,
+                   self.percentile(self.step_durations, 0.99) * 1000.0,
+                   self.max_step_time * 1000.0,
+                   self.percentile(self.iteration_durations, 0.5) * 1000.0,
+                   self.num_stalls
+               )
+
+
+class LoopMonitor(Node):
+    """Opt-in instrumentation for the shared event loop.
+
+    Every callback the loop runs (each task step between two awaits, subscription callbacks, timers) is
+    timed and attributed to the node whose coroutine it belongs to. A watchdog thread flags callbacks that
+    hold the loop longer than stall_threshold and logs the offending node's stack while it's still stuck.
+    Call install() as early as possible (in the orchestrator's __init__) to catch slow setups too.
+
+    start_capture() records a cProfile and tracemalloc window. It's triggered by SIGUSR1 or from the GUI.
+    """
+
+    def __init__(self, stall_threshold=0.05, report_interval=10.0, capture_duration=10.0,
+                 capture_directory="profiles", enabled=True):
+        self.set_logger(write=True)
+        super(LoopMonitor, self).__init__(enabled)
+
+        self.stall_threshold = stall_threshold
+        self.report_interval = report_interval
+        self.capture_duration = capture_duration
+        self.capture_directory = capture_directory
+
+        self.stats = {}
+        self.task_names = WeakKeyDictionary()
+
+        self.loop_thread_id = None
+        self.current_callback_name = None
+        self.current_callback_start = None
+        self.reported_stall_start = None
+
+        self.original_handle_run = None
+        self.watchdog_thread = None
+        self.watchdog_stop_event = threading.Event()
+
+        self.profiler = None
+        self.capture_timer = None
+
+        # event loop lag as seen by a coroutine that only sleeps
+        self.heartbeat_interval = 0.1
+        self.max_loop_lag = 0.0
+
+    def install(self):
+        if not self.enabled or self.original_handle_run is not None:
+            return
+
+        monitor = self
+        original_handle_run = asyncio.Handle._run
+        self.original_handle_run = original_handle_run
+
+        def _run(handle):
+            name = monitor.callback_name(handle._callback)
+            start_time = time.perf_counter()
+            monitor.loop_thread_id = threading.get_ident()
+            monitor.current_callback_name = name
+            monitor.current_callback_start = start_time
+            try:
+                original_handle_run(handle)
+            finally:
+                duration = time.perf_counter() - start_time
+                monitor.current_callback_start = None
+                monitor.record(name, start_time, duration)
+
+        asyncio.Handle._run = _run
+
+        self.watchdog_thread = threading.Thread(target=self.watchdog, name="loop-monitor-watchdog", daemon=True)
+        self.watchdog_thread.start()
+
+    def uninstall(self):
+        if self.original_handle_run is not None:
+            asyncio.Handle._run = self.original_handle_run
+            self.original_handle_run = None
+        self.watchdog_stop_event.set()
+
+    def callback_name(self, callback):
+        task = getattr(callback, "__self__", None)
+        if not isinstance(task, asyncio.Task):
+            callback_self = getattr(callback, "__self__", None)
+            if isinstance(callback_self, Node):
+                return callback_self.__class__.__name__
+            return getattr(callback, "__qualname__", "callbacks")
+
+        if task in self.task_names:
+            return self.task_names[task]
+
+        # find the node that owns this task by walking its coroutine chain
+        name = task.get_name()
+        coroutine = task.get_coro()
+        while coroutine is not None:
+            frame = getattr(coroutine, "cr_frame", None)
+            if frame is not None and isinstance(frame.f_locals.get("self"), Node):
+                name = frame.f_locals["self"].__class__.__name__
+                break
+            coroutine = getattr(coroutine, "cr_await", None)
+        self.task_names[task] = name
+        return name
+
+    def record(self, name, start_time, duration):
+        if name not in self.stats:
+            self.stats[name] = NodeLoopStats(name)
+        stats = self.stats[name]
+        stats.record(start_time, duration)
+
+        if duration > self.stall_threshold:
+            stats.num_stalls += 1
+            if self.reported_stall_start != start_time:
+                # the watchdog didn't catch it in the act (it was shorter than the watchdog's period)
+                self.logger.warning("%s held the event loop for %0.1fms" % (name, duration * 1000.0))
+            self.reported_stall_start = None
+
+    def watchdog(self):
+        while not self.watchdog_stop_event.wait(self.stall_threshold / 2):
+            start_time = self.current_callback_start
+            if start_time is None or start_time == self.reported_stall_start:
+                continue
+            if time.perf_counter() - start_time < self.stall_threshold:
+                continue
+
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                continue
+            self.reported_stall_start = start_time
+            self.logger.warning(
+                "%s has held the event loop for more than %0.1fms. Stack:\n%s" % (
+                    self.current_callback_name, self.stall_threshold * 1000.0, self.format_callback_stack(frame)
+                )
+            )
+
+    @staticmethod
+    def format_callback_stack(frame):
+        # drop the event loop's own frames, only the callback's frames are interesting
+        stack = traceback.extract_stack(frame)
+        for index in range(len(stack) - 1, -1, -1):
+            if stack[index].filename.endswith(os.path.join("asyncio", "events.py")):
+                stack = stack[index + 1:]
+                break
+        return "".join(traceback.format_list(stack))
+
+    async def setup(self):
+        self.install()
+        try:
+            asyncio.get_event_loop().add_signal_handler(signal.SIGUSR1, self.start_capture)
+        except (NotImplementedError, AttributeError, RuntimeError):
+            self.logger.info("Signal triggered captures aren't available on this platform")
+
+    async def loop(self):
+        prev_report_time = time.time()
+        while True:
+            t0 = time.perf_counter()
+            await asyncio.sleep(self.heartbeat_interval)
+            lag = time.perf_counter() - t0 - self.heartbeat_interval
+            if lag > self.max_loop_lag:
+                self.max_loop_lag = lag
+
+            if time.time() - prev_report_time > self.report_interval:
+                self.report()
+                prev_report_time = time.time()
+
+    def report(self):
+        lines = [stats.summary() for stats in sorted(self.stats.values(), key=lambda s: -s.total_step_time)]
+        self.logger.info(
+            "Event loop report (max lag: %0.1fms):\n\t%s" % (self.max_loop_lag * 1000.0, "\n\t".join(lines))
+        )
+
+    def start_capture(self, duration=None):
+        if self.profiler is not None:
+            self.logger.info("A capture is already running")
+            return
+        if duration is None:
+            duration = self.capture_duration
+
+        self.logger.info("Capturing profile and allocations for %0.1fs" % duration)
+        tracemalloc.start()
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+        self.capture_timer = asyncio.get_event_loop().call_later(duration, self.stop_capture)
+
+    def stop_capture(self):
+        if self.profiler is None:
+            return
+        self.profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+        if not os.path.isdir(self.capture_directory):
+            os.makedirs(self.capture_directory)
+        path = os.path.join(self.capture_directory, time.strftime("%Y_%b_%d-%H_%M_%S.prof"))
+        self.profiler.dump_stats(path)
+
+        # the stats go through the logger with everything else instead of to stdout
+        stats_output = io.StringIO()
+        stats = pstats.Stats(self.profiler, stream=stats_output)
+        stats.sort_stats("cumulative")
+        stats.print_stats(20)
+        top_allocations = snapshot.statistics("lineno")[:10]
+        self.logger.info(
+            "Profile saved to %s. Top allocations:\n\t%s" % (path, "\n\t".join(str(stat) for stat in top_allocations))
+        )
+        self.logger.info("Top functions by cumulative time:\n%s" % stats_output.getvalue())
+
+        self.profiler = None
+        self.capture_timer = None
+
+    async def teardown(self):
+        if self.capture_timer is not None:
+            self.capture_timer.cancel()
+            self.stop_capture()
+        self.report()
+        self.uninstall()
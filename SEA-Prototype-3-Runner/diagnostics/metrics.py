@@ -0,0 +1,252 @@
+import time
+import math
+import asyncio
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from atlasbuggy import Node
+
+default_metrics_port = 9107
+
+# seconds, for anything that's a latency
+default_time_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (key, str(value).replace('"', '\\"')) for key, value in sorted(labels.items()))
+
+
+def format_value(value):
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class Counter:
+    """Only ever goes up. Written from one thread (the event loop), read by the server thread. A float attribute
+    update is atomic under the GIL, so neither side takes a lock."""
+
+    metric_type = "counter"
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.value = 0.0
+
+    def inc(self, amount=1.0):
+        self.value += amount
+
+    def samples(self):
+        yield self.name, self.labels, self.value
+
+
+class Gauge:
+    """Last value set. With function, the value is read at scrape time instead"""
+
+    metric_type = "gauge"
+
+    def __init__(self, name, labels, function=None):
+        self.name = name
+        self.labels = labels
+        self.function = function
+        self.value = 0.0
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        if self.function is None:
+            yield self.name, self.labels, self.value
+            return
+        try:
+            value = self.function()
+        except Exception:
+            # whatever the function reads isn't there yet (a queue before take()), skip it this scrape
+            return
+        if value is not None:
+            yield self.name, self.labels, value
+
+
+class Histogram:
+    """Counts per bucket. observe() is a bisect and two additions"""
+
+    metric_type = "histogram"
+
+    def __init__(self, name, labels, buckets=default_time_buckets):
+        self.name = name
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self):
+        counts = list(self.counts)
+        cumulative = 0
+        for upper_bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            yield self.name + "_bucket", dict(self.labels, le=format_value(upper_bound)), cumulative
+        yield self.name + "_sum", self.labels, self.sum
+        yield self.name + "_count", self.labels, cumulative
+
+
+class MetricsRegistry:
+    """Every metric the process exposes. Asking for a metric that already exists returns it"""
+
+    def __init__(self, prefix="sea_"):
+        self.prefix = prefix
+        self.metrics = {}  # (name, sorted labels) -> metric
+        self.descriptions = {}  # name -> (type, help)
+        self.creation_lock = threading.Lock()
+
+    def get_metric(self, cls, name, description, labels, **kwargs):
+        name = self.prefix + name
+        labels = dict(labels or {})
+        key = (name, tuple(sorted(labels.items())))
+        metric = self.metrics.get(key)
+        if metric is not None:
+            return metric
+
+        # registering happens rarely, only scrapes and updates need to stay lock free
+        with self.creation_lock:
+            if key in self.metrics:
+                return self.metrics[key]
+            if name in self.descriptions and self.descriptions[name][0] != cls.metric_type:
+                raise ValueError("%s is already registered as a %s" % (name, self.descriptions[name][0]))
+            self.descriptions[name] = (cls.metric_type, description)
+            metric = cls(name, labels, **kwargs)
+            # replace the dict instead of adding to it so a scrape iterating the old one isn't disturbed
+            metrics = dict(self.metrics)
+            metrics[key] = metric
+            self.metrics = metrics
+        return metric
+
+    def counter(self, name, description, labels=None):
+        return self.get_metric(Counter, name, description, labels)
+
+    def gauge(self, name, description, labels=None, function=None):
+        return self.get_metric(Gauge, name, description, labels, function=function)
+
+    def histogram(self, name, description, labels=None, buckets=default_time_buckets):
+        return self.get_metric(Histogram, name, description, labels, buckets=buckets)
+
+    def render(self):
+        """Prometheus text exposition format"""
+        by_name = {}
+        for (name, _), metric in self.metrics.items():
+            by_name.setdefault(name, []).append(metric)
+
+        lines = []
+        for name in sorted(by_name):
+            metric_type, description = self.descriptions[name]
+            lines.append("# HELP %s %s" % (name, description))
+            lines.append("# TYPE %s %s" % (name, metric_type))
+            for metric in by_name[name]:
+                for sample_name, labels, value in metric.samples():
+                    lines.append("%s%s %s" % (sample_name, format_labels(labels), format_value(value)))
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """Serves a registry on localhost from a daemon thread. Scrapes never touch the event loop"""
+
+    def __init__(self, registry, port=default_metrics_port, host="127.0.0.1"):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        registry = self.registry
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((self.host, self.port), MetricsHandler)
+        self.server.daemon_threads = True
+        # port 0 picks a free one
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, name="metrics-server", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+class MetricsNode(Node):
+    """Runs the metrics server, measures event loop lag and exposes the depth of every node's queues.
+
+    Lag is how late a coroutine that only sleeps wakes up, the same thing every other node's loop waits behind.
+    """
+
+    def __init__(self, registry, port=default_metrics_port, lag_interval=0.05, enabled=True):
+        self.set_logger(write=True)
+        super(MetricsNode, self).__init__(enabled)
+
+        self.registry = registry
+        self.server = MetricsServer(registry, port)
+        self.lag_interval = lag_interval
+
+        self.loop_lag = registry.histogram("event_loop_lag_seconds", "How late a sleeping coroutine wakes up")
+        self.max_loop_lag = registry.gauge("event_loop_max_lag_seconds", "Worst event loop lag since startup")
+        self.uptime = registry.gauge("uptime_seconds", "Seconds since the metrics node started")
+
+    def watch_queues(self, *nodes):
+        """Gauge for every attribute of the nodes named *_queue, read when scraped"""
+        for node in nodes:
+            for attribute in sorted(vars(node)):
+                if attribute.endswith("_queue"):
+                    self.registry.gauge(
+                        "queue_depth", "Messages waiting in a node's queue",
+                        labels=dict(node=node.__class__.__name__, queue=attribute),
+                        function=self.queue_size_function(node, attribute)
+                    )
+
+    @staticmethod
+    def queue_size_function(node, attribute):
+        def queue_size():
+            queue = getattr(node, attribute)
+            return None if queue is None else queue.qsize()
+        return queue_size
+
+    async def setup(self):
+        self.server.start()
+        self.logger.info("serving metrics on http://%s:%s/metrics" % (self.server.host, self.server.port))
+
+    async def loop(self):
+        start_time = time.monotonic()
+        max_lag = 0.0
+        while True:
+            t0 = time.monotonic()
+            await asyncio.sleep(self.lag_interval)
+            lag = max(time.monotonic() - t0 - self.lag_interval, 0.0)
+            self.loop_lag.observe(lag)
+            if lag > max_lag:
+                max_lag = lag
+                self.max_loop_lag.set(lag)
+            self.uptime.set(time.monotonic() - start_time)
+
+    async def teardown(self):
+        self.server.stop()
@@ -0,0 +1,346 @@
+import os
+import sys
+import json
+import time
+import math
+import shutil
+import argparse
+import tempfile
+import traceback
+import multiprocessing
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, wait
+
+from hardware.experiment_profiles import load_experiment_profiles
+from data_processing.log_parser import stream_directories
+from data_processing.compressed_log import compressed_log_extension
+from data_processing.experiment_helpers.encoder_constants import abs_ticks_per_rotation
+
+RunResult = namedtuple(
+    "RunResult",
+
+    "run_index "
+    "cycle "
+    "profile_name "
+    "directory "
+    "filename "
+    "k "  # Nm/rad. Static fit for staircases, dynamic stiffness for waveforms
+    "k_source "
+    "forward_backlash_deg "
+    "backward_backlash_deg "
+    "abs_encoder_fixed_diff "
+    "run_duration "
+    "analysis_duration "
+    "error "
+)
+
+
+def run_profile(profile):
+    """Run process entry point. One profile per interpreter so every run gets its own session logs"""
+    from atlasbuggy import run
+    from headless_runner import HeadlessOrchestrator
+
+    HeadlessOrchestrator.queued_profiles = [profile]
+    try:
+        run(HeadlessOrchestrator)
+    except BaseException:
+        traceback.print_exc()
+        raise
+
+
+def lower_priority():
+    """Analysis worker initializer. Analysis can wait, the run going on next to it can't"""
+    if hasattr(os, "nice"):
+        os.nice(10)
+
+
+def session_start_time(directory, filename):
+    """Seconds since the epoch a session's logs were opened, from their names (2019_Mar_01/22_08_46.log)"""
+    name = filename.split(".")[0]
+    try:
+        return time.mktime(time.strptime(directory + " " + name, "%Y_%b_%d %H_%M_%S"))
+    except ValueError:
+        return None
+
+
+def find_sessions(since, log_root="logs"):
+    """(directory, filename) of the sessions whose logs were opened at or after since, oldest first"""
+    brake_directory = stream_directories["brake"]
+    sessions = []
+    if not os.path.isdir(log_root):
+        return sessions
+    for directory in os.listdir(log_root):
+        stream_path = os.path.join(log_root, directory, brake_directory)
+        if not os.path.isdir(stream_path):
+            continue
+        for filename in os.listdir(stream_path):
+            if filename.endswith(compressed_log_extension):
+                filename = filename[:-len(compressed_log_extension)]
+            start_time = session_start_time(directory, filename)
+            if start_time is not None and start_time >= since:
+                sessions.append((start_time, directory, filename))
+    return [(directory, filename) for _, directory, filename in sorted(set(sessions))]
+
+
+def analyze_run(run_index, cycle, profile, directory, filename, run_duration, log_root="logs",
+                use_abs_encoders=False, enable_smoothing=True):
+    """Analysis worker entry point. Errors come back in the result so one bad run doesn't stop the queue"""
+    from data_processing.session import Session
+    from data_processing.experiment_helpers.frequency_response import session_frequency_response
+
+    t0 = time.time()
+    session = Session(directory, filename, profile.torque_table_path, log_root,
+                      use_abs_encoders=use_abs_encoders, enable_smoothing=enable_smoothing)
+    k = forward_backlash_deg = backward_backlash_deg = abs_encoder_fixed_diff = math.nan
+    error = None
+    try:
+        if profile.waveform is None:
+            k_source = "static"
+            result = session.analysis.result
+            if result.polynomial is None:
+                raise ValueError("couldn't find the brake ramps")
+            k = float(result.polynomial[0])
+            forward_backlash_deg = math.degrees(result.motor_forward_backlash_rad)
+            backward_backlash_deg = math.degrees(result.motor_backward_backlash_rad)
+            if session.analysis.abs_encoder_offset is not None:
+                abs_encoder_fixed_diff = session.analysis.abs_encoder_offset.fixed_diff
+        else:
+            k_source = "dynamic"
+            encoder_timestamps, brake_timestamps, start_time, stop_time, switch_time = session.rebased
+            response = session_frequency_response(
+                session.torque_table, encoder_timestamps, session.deflection, brake_timestamps,
+                session.brake_current, max(switch_time, 0.0), start_time, stop_time
+            )
+            k = float(response.stiffness)
+    except Exception as exception:
+        k_source = "none"
+        error = "%s: %s" % (exception.__class__.__name__, exception)
+
+    return RunResult(run_index, cycle, profile.name, directory, filename, k, k_source, forward_backlash_deg,
+                     backward_backlash_deg, abs_encoder_fixed_diff, run_duration, time.time() - t0, error)
+
+
+def check_analysis(log_root):
+    """Run analyze_run on a synthetic session of every experiment kind ExperimentNode runs. The logs have to have
+    the markers the analysis windows with, whichever path the run took. The staircase is analyzed a second time
+    with the absolute encoders, which estimates their offset"""
+    from hardware.experiment_profiles import default_profile
+    from data_processing.synthetic_session import generate_session, default_synthetic_config, \
+        synthetic_waveform_spec, experiment_kinds
+
+    runs = [(kind, False) for kind in experiment_kinds] + [("staircase", True)]
+    truths = {}
+    results = []
+    for run_index, (kind, use_abs_encoders) in enumerate(runs):
+        config = default_synthetic_config._replace(experiment_kind=kind)
+        if kind not in truths:
+            truths[kind] = generate_session("synthetic", "%s.log" % kind, config, log_root)
+        truth = truths[kind]
+        profile = default_profile._replace(
+            name="synthetic %s%s" % (kind, " (abs)" if use_abs_encoders else ""),
+            torque_table_path=config.torque_table_path, adaptive_stepping=kind == "adaptive",
+            waveform=synthetic_waveform_spec(config) if kind == "waveform" else None
+        )
+        result = analyze_run(run_index, 0, profile, "synthetic", "%s.log" % kind, 0.0, log_root, use_abs_encoders)
+        summary = format_result(result) + ", truth K = %0.4f Nm/rad" % truth.k
+        if not math.isnan(result.abs_encoder_fixed_diff):
+            summary += ", abs encoder offset %0.2f ticks (truth %0.2f)" % (
+                result.abs_encoder_fixed_diff, truth.abs_encoder_fixed_diff)
+        print(summary)
+        results.append((result, truth))
+    return results
+
+
+def check_failed(result, truth, tolerance):
+    if result.error is not None or abs(result.k - truth.k) / truth.k > tolerance:
+        return True
+    if math.isnan(result.abs_encoder_fixed_diff):
+        return False
+    # the estimate wraps around a rotation
+    offset_error = (result.abs_encoder_fixed_diff - truth.abs_encoder_fixed_diff + abs_ticks_per_rotation / 2.0) % \
+        abs_ticks_per_rotation - abs_ticks_per_rotation / 2.0
+    return abs(offset_error) > 1.0
+
+
+def format_result(result):
+    if result.error is not None:
+        return "run %s '%s' (%s/%s): analysis failed, %s" % (
+            result.run_index + 1, result.profile_name, result.directory, result.filename, result.error)
+    summary = "run %s '%s' (%s/%s): K = %0.4f Nm/rad (%s)" % (
+        result.run_index + 1, result.profile_name, result.directory, result.filename, result.k, result.k_source)
+    if not math.isnan(result.forward_backlash_deg):
+        summary += ", backlash %0.2f/%0.2f deg" % (result.forward_backlash_deg, result.backward_backlash_deg)
+    return summary + ", analyzed in %0.1fs" % result.analysis_duration
+
+
+def summarize_results(results):
+    """K per profile over every cycle, to see how repeatable each one is"""
+    by_profile = {}
+    for result in results:
+        if result.error is None:
+            by_profile.setdefault(result.profile_name, []).append(result.k)
+
+    lines = []
+    for name, values in by_profile.items():
+        mean = sum(values) / len(values)
+        std = math.sqrt(sum((value - mean) ** 2 for value in values) / len(values))
+        lines.append("%-40s %3d runs, K = %0.4f +/- %0.4f Nm/rad" % (name, len(values), mean, std))
+    return "\n".join(lines)
+
+
+class ExperimentQueue:
+    """Runs experiment profiles back to back, each in its own process, and analyzes every finished session in a
+    background worker while the next one runs. With forever set it cycles through the profiles until stopped."""
+
+    def __init__(self, profiles, num_cycles=1, forever=False, log_root="logs", results_path=None,
+                 rest_duration=5.0, max_consecutive_failures=3, report_interval=1.0,
+                 use_abs_encoders=False, enable_smoothing=True):
+        if len(profiles) == 0:
+            raise ValueError("The queue doesn't have any experiment profiles")
+        self.profiles = profiles
+        self.num_cycles = num_cycles
+        self.forever = forever
+        self.log_root = log_root
+        self.results_path = results_path
+        # time between runs for the motor to spin down
+        self.rest_duration = rest_duration
+        # a rig that keeps failing (unplugged arduino, dead supply) shouldn't be retried all night
+        self.max_consecutive_failures = max_consecutive_failures
+        self.report_interval = report_interval
+        self.use_abs_encoders = use_abs_encoders
+        self.enable_smoothing = enable_smoothing
+
+        # spawn instead of fork so runs don't inherit each other's event loop or device state
+        self.context = multiprocessing.get_context("spawn")
+        self.analysis_pool = None
+        self.pending_analyses = []
+        self.results = []
+
+    def runs(self):
+        cycle = 0
+        while self.forever or cycle < self.num_cycles:
+            for profile in self.profiles:
+                yield cycle, profile
+            cycle += 1
+
+    def run(self):
+        self.analysis_pool = ProcessPoolExecutor(max_workers=1, mp_context=self.context, initializer=lower_priority)
+        consecutive_failures = 0
+        process = None
+        try:
+            for run_index, (cycle, profile) in enumerate(self.runs()):
+                if run_index > 0:
+                    self.sleep(self.rest_duration)
+
+                print("Starting run %s (cycle %s): '%s'" % (run_index + 1, cycle + 1, profile.name))
+                run_start = time.time()
+                process = self.context.Process(target=run_profile, args=(profile,), name="run-%s" % run_index)
+                process.start()
+                while process.is_alive():
+                    self.sleep(self.report_interval)
+                    process.join(0.0)
+                run_duration = time.time() - run_start
+
+                # log names only have a resolution of a second
+                sessions = find_sessions(math.floor(run_start) - 1.0, self.log_root)
+                if process.exitcode != 0 or len(sessions) == 0:
+                    consecutive_failures += 1
+                    print("Run %s '%s' failed (exit code %s, %s session logs)" % (
+                        run_index + 1, profile.name, process.exitcode, len(sessions)))
+                    if consecutive_failures >= self.max_consecutive_failures:
+                        print("%s runs in a row failed, stopping the queue" % consecutive_failures)
+                        break
+                    continue
+                consecutive_failures = 0
+
+                directory, filename = sessions[-1]
+                print("Run %s '%s' finished in %0.1fs, analyzing %s/%s" % (
+                    run_index + 1, profile.name, run_duration, directory, filename))
+                self.pending_analyses.append(self.analysis_pool.submit(
+                    analyze_run, run_index, cycle, profile, directory, filename, run_duration, self.log_root,
+                    self.use_abs_encoders, self.enable_smoothing
+                ))
+        except KeyboardInterrupt:
+            print("Stopping the queue")
+            if process is not None and process.is_alive():
+                # the run got the interrupt too, give it a chance to stop the motor and brake itself
+                process.join(10.0)
+                if process.is_alive():
+                    process.terminate()
+                    process.join()
+        finally:
+            print("Waiting for %s analyses" % len(self.pending_analyses))
+            wait(self.pending_analyses)
+            self.collect_analyses()
+            self.analysis_pool.shutdown()
+            print(summarize_results(self.results))
+
+        return self.results
+
+    def sleep(self, duration):
+        """Sleep while reporting the analyses that finish in the meantime"""
+        stop_time = time.time() + duration
+        while True:
+            self.collect_analyses()
+            remaining = stop_time - time.time()
+            if remaining <= 0.0:
+                break
+            time.sleep(min(remaining, self.report_interval))
+
+    def collect_analyses(self):
+        for future in [future for future in self.pending_analyses if future.done()]:
+            self.pending_analyses.remove(future)
+            result = future.result()
+            self.results.append(result)
+            print(format_result(result))
+            self.save_result(result)
+
+    def save_result(self, result):
+        if self.results_path is None:
+            return
+        results_directory = os.path.split(self.results_path)[0]
+        if len(results_directory) > 0 and not os.path.isdir(results_directory):
+            os.makedirs(results_directory)
+        # one line per run, written as soon as it's analyzed so an overnight queue that dies keeps what it had
+        with open(self.results_path, "a") as results_file:
+            results_file.write(json.dumps(result._asdict()) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run experiment profiles back to back and report K per run")
+    parser.add_argument("profiles", nargs="?", default="experiment_profiles.json",
+                        help="JSON list of experiment profiles (hardware/experiment_profiles.py)")
+    parser.add_argument("--cycles", type=int, default=1, help="times to go through the profiles")
+    parser.add_argument("--forever", action="store_true", help="keep cycling through the profiles until stopped")
+    parser.add_argument("--rest", type=float, default=5.0, help="seconds between runs")
+    parser.add_argument("--results", default="logs/experiment_queue/%s.jsonl" % time.strftime("%Y_%b_%d-%H_%M_%S"),
+                        help="where each run's result is appended")
+    parser.add_argument("--abs", action="store_true", help="analyze with the absolute encoders")
+    parser.add_argument("--no-smoothing", action="store_true", help="don't smooth the encoder delta")
+    parser.add_argument("--check", action="store_true",
+                        help="analyze synthetic staircase, adaptive and waveform sessions instead of running anything")
+    parser.add_argument("--tolerance", type=float, default=0.05, help="relative K error --check accepts")
+    args = parser.parse_args()
+
+    if args.check:
+        log_root = tempfile.mkdtemp()
+        try:
+            results = check_analysis(log_root)
+        finally:
+            shutil.rmtree(log_root)
+        if any(check_failed(result, truth, args.tolerance) for result, truth in results):
+            sys.exit(1)
+        return
+
+    queue = ExperimentQueue(
+        load_experiment_profiles(args.profiles), num_cycles=args.cycles, forever=args.forever,
+        results_path=args.results, rest_duration=args.rest, use_abs_encoders=args.abs,
+        enable_smoothing=not args.no_smoothing
+    )
+    results = queue.run()
+    if any(result.error is not None for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
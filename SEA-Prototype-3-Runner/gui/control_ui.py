@@ -4,9 +4,6 @@ import asyncio
 from tkinter import *
 from atlasbuggy import Node
 
-import matplotlib
-matplotlib.use("TkAgg")  # keeps tkinter happy
-
 
 class TkinterGUI(Node):
     def __init__(self, pickle_file_path):
@@ -37,6 +34,7 @@ class TkinterGUI(Node):
         )
         self.take_sample_slider = Scale(self.root, label="Sample length (s)", from_=0.0, to=30.0, resolution=1.0, orient=HORIZONTAL, length=self.width)
         self.take_sample_button = Button(self.root, text="take sample", command=self.take_sample)
+        self.capture_profile_button = Button(self.root, text="Capture profile", command=self.capture_profile)
 
         self.motor_speed_slider.pack()
         self.set_motor_button.pack()
@@ -51,6 +49,8 @@ class TkinterGUI(Node):
         self.take_sample_slider.pack()
         self.take_sample_button.pack()
 
+        self.capture_profile_button.pack()
+
         self.brake_controller_bridge_tag = "brake_controller_bridge"
         self.brake_controller_bridge_sub = self.define_subscription(
             self.brake_controller_bridge_tag,
@@ -75,6 +75,14 @@ class TkinterGUI(Node):
         )
         self.experiment = None
 
+        self.loop_monitor_tag = "loop_monitor"
+        self.loop_monitor_sub = self.define_subscription(
+            self.loop_monitor_tag,
+            queue_size=None,
+            required_methods=("start_capture",)
+        )
+        self.loop_monitor = None
+
         self.pickle_file_path = pickle_file_path
 
         self.kp = 30.0
@@ -85,6 +93,8 @@ class TkinterGUI(Node):
         self.brake_controller_bridge = self.brake_controller_bridge_sub.get_producer()
         self.motor_controller_bridge = self.motor_controller_bridge_sub.get_producer()
         self.experiment = self.experiment_sub.get_producer()
+        if self.is_subscribed(self.loop_monitor_tag):
+            self.loop_monitor = self.loop_monitor_sub.get_producer()
 
     def load_constants(self):
         if os.path.isfile(self.pickle_file_path):
@@ -141,5 +151,9 @@ class TkinterGUI(Node):
     def take_sample(self):
         self.experiment.take_sample(self.take_sample_slider.get())
 
+    def capture_profile(self):
+        if self.is_subscribed(self.loop_monitor_tag):
+            self.loop_monitor.start_capture()
+
     def shutdown_tk(self):
         self.is_running = False
@@ -1,8 +1,10 @@
+import math
 import asyncio
 from threading import Event
 from atlasbuggy import Node
 
-from data_processing.experiment_helpers.k_calculator_helpers import *
+from data_processing.experiment_helpers.encoder_constants import *
+from data_processing.packet_blocks import message_field
 
 
 class LineArgsContainer:
@@ -65,9 +67,12 @@ class PlotContainer:
 
 
 class DataPlotter(Node):
-    def __init__(self, enabled=True):
+    def __init__(self, enabled=True, show_filtered=False):
         super(DataPlotter, self).__init__(enabled)
 
+        # encoder messages come from an EncoderFilterNode instead of the bridge and carry smoothed_deflection
+        self.show_filtered = show_filtered
+
         self.pause_time = 1 / 60
         self.exit_event = Event()
         self.plot_paused = False
@@ -100,6 +105,8 @@ class DataPlotter(Node):
             self.fig.canvas.mpl_connect('close_event', lambda event: self.exit_event.set())
 
     def enable_matplotlib(self):
+        import matplotlib
+        matplotlib.use("TkAgg")  # keeps tkinter happy
         from matplotlib import pyplot as plt
         self.plt = plt
 
@@ -117,6 +124,7 @@ class DataPlotter(Node):
             "diff", self.diff_plot,
             LineArgsContainer("abs", '-', enabled=False, label="abs diff"),
             LineArgsContainer("rel", '-', enabled=True, label="rel diff"),
+            LineArgsContainer("rel smoothed", '-', enabled=self.show_filtered, label="rel diff smoothed"),
             LineArgsContainer("motor", '-', enabled=False, label="motor diff"),
             x_data_window = 120.0
         )
@@ -193,11 +201,16 @@ class DataPlotter(Node):
         else:
             return
 
-        abs_encoder_1 = message.data[0] * math.pi / 180 * self.abs_gear_ratio
-        abs_encoder_2 = message.data[1] * math.pi / 180 * self.abs_gear_ratio
-        rel_encoder_1 = message.data[4] * self.rel_enc_ticks_to_rad
-        rel_encoder_2 = message.data[5] * self.rel_enc_ticks_to_rad
-        motor_encoder = message.data[6] * self.motor_enc_ticks_to_rad
+        # only the newest sample is plotted
+        def latest(field):
+            return message_field(message, "enc", field)[-1]
+
+        timestamp = latest("timestamp")
+        abs_encoder_1 = latest("abs_enc1_angle") * math.pi / 180 * self.abs_gear_ratio
+        abs_encoder_2 = latest("abs_enc2_angle") * math.pi / 180 * self.abs_gear_ratio
+        rel_encoder_1 = latest("enc1_pos") * self.rel_enc_ticks_to_rad
+        rel_encoder_2 = latest("enc2_pos") * self.rel_enc_ticks_to_rad
+        motor_encoder = latest("motor_pos") * self.motor_enc_ticks_to_rad
 
         if self.initial_val_enc_1 is None:
             self.initial_val_enc_1 = abs_encoder_1
@@ -211,16 +224,19 @@ class DataPlotter(Node):
         # enc1_angle = message.data[0] * self.gear_ratio
         # enc2_angle = message.data[1] * self.gear_ratio
 
-        self.encoder_plot_container.append_x(message.timestamp)
+        self.encoder_plot_container.append_x(timestamp)
         self.encoder_plot_container.append_y("abs enc 1", abs_enc1_angle)
         self.encoder_plot_container.append_y("abs enc 2", abs_enc2_angle)
         self.encoder_plot_container.append_y("rel enc 1", rel_encoder_1)
         self.encoder_plot_container.append_y("rel enc 2", rel_encoder_2)
         self.encoder_plot_container.append_y("motor", motor_encoder)
 
-        self.diff_plot_container.append_x(message.timestamp)
+        self.diff_plot_container.append_x(timestamp)
         self.diff_plot_container.append_y("abs", abs_enc1_angle - abs_enc2_angle)
         self.diff_plot_container.append_y("rel", rel_encoder_1 - rel_encoder_2)
+        if self.show_filtered:
+            # the filter node only broadcasts blocks
+            self.diff_plot_container.append_y("rel smoothed", message["smoothed_deflection"][-1])
         self.diff_plot_container.append_y("motor", rel_encoder_2 - motor_encoder)
 
     async def get_brake_data(self):
@@ -231,14 +247,18 @@ class DataPlotter(Node):
         else:
             return
 
-        current_mA = message.data[2]
-        pin_value = message.data[5]
-        setpoint = message.data[6]
+        def latest(field):
+            return message_field(message, "brake", field)[-1]
+
+        timestamp = latest("timestamp")
+        current_mA = latest("current_mA")
+        pin_value = latest("pwm_pin")
+        setpoint = latest("set_point")
 
-        self.brake_pin_plot_container.append_x(message.timestamp)
+        self.brake_pin_plot_container.append_x(timestamp)
         self.brake_pin_plot_container.append_y("pin", pin_value)
 
-        self.brake_current_plot_container.append_x(message.timestamp)
+        self.brake_current_plot_container.append_x(timestamp)
         self.brake_current_plot_container.append_y("current", current_mA)
         self.brake_current_plot_container.append_y("setpoint", setpoint)
 
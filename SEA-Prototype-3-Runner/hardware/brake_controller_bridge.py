@@ -3,18 +3,53 @@ import asyncio
 from atlasbuggy import Node
 from arduino_factory import Arduino
 
+from data_processing.packet_blocks import packets_to_block, has_record_layout
+from data_processing.brake_profile import start_profile_command, stop_profile_command, edge_packet_name
+from diagnostics.link_health import LinkHealth, format_report
+
 
 class BrakeControllerBridge(Node):
-    def __init__(self, factory, enabled=True, enable_reporting=True):
+    def __init__(self, factory, enabled=True, enable_reporting=True, arduino_name="brake_controller",
+                 telemetry_bus=None, block_mode=False, block_interval=0.05, metrics=None):
         self.set_logger(write=True)
         super(BrakeControllerBridge, self).__init__(enabled)
         self.factory = factory
-        self.brake_controller_bridge_arduino = Arduino("brake_controller", self.factory)
+        self.brake_controller_bridge_arduino = Arduino(arduino_name, self.factory)
 
         self.prev_broadcast_time = 0.0
         self.prev_report_time = 0.0
         self.enable_reporting = enable_reporting
 
+        # publishes every packet to shared memory for consumers in other processes
+        self.telemetry_bus = telemetry_bus
+
+        # subscribers get a record array of the packets since the last block instead of one packet at a time
+        self.block_mode = block_mode
+        self.block_interval = block_interval
+        self.pending_packets = []
+        self.prev_block_time = 0.0
+
+        # (receive time, step index, ms since profile start, set point) for every step the brake reports applying
+        self.profile_edges = []
+
+        self.link_health = LinkHealth("brake")
+        # garbled lines that parsed into a brake packet with the wrong number of values. Logged, not passed on
+        self.num_malformed_packets = 0
+
+        # MetricsRegistry to report to, or None
+        if metrics is not None:
+            self.packet_counter = metrics.counter("packets_total", "Packets read", labels=dict(stream="brake"))
+            self.current_gauge = metrics.gauge("brake_current_mA", "Last current the brake sensed")
+            self.set_point_gauge = metrics.gauge("brake_set_point_mA", "Last set point the brake reported")
+            self.current_error_histogram = metrics.histogram(
+                "brake_current_error_mA", "|sensed current - set point| per packet",
+                buckets=(0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 50.0, 100.0)
+            )
+            metrics.gauge("link_estimated_lost", "Packets missing from the device's timestamps",
+                          labels=dict(stream="brake"), function=lambda: self.link_health.estimated_lost)
+        else:
+            self.packet_counter = None
+
         self.kp = 0.0
         self.ki = 0.0
         self.kd = 0.0
@@ -35,10 +70,19 @@ class BrakeControllerBridge(Node):
             packet = self.brake_controller_bridge_arduino.read()
             self.logger.debug("packet: '%s'" % (str(packet)))
             await asyncio.sleep(0.0)
+            if packet.name is not None:
+                self.link_health.update(packet)
 
             if packet.name is None:
                 self.logger.warning("No packets found!")
 
+            elif packet.name == edge_packet_name:
+                self.log_to_buffer(packet.receive_time, packet)
+                self.profile_edges.append((packet.receive_time,) + tuple(packet.data))
+
+            elif packet.name == "brake" and not has_record_layout(packet, "brake"):
+                self.num_malformed_packets += 1
+
             elif packet.name == "brake":
                 # shunt_voltage = packet.data[0]
                 # bus_voltage = packet.data[1]
@@ -48,6 +92,13 @@ class BrakeControllerBridge(Node):
                 # current_pin_value = packet.data[5]
                 # set_point = packet.data[6]
                 self.log_to_buffer(packet.receive_time, packet)
+                if self.telemetry_bus is not None:
+                    self.telemetry_bus.publish(packet)
+                if self.packet_counter is not None:
+                    self.packet_counter.inc()
+                    self.current_gauge.set(packet.data[2])
+                    self.set_point_gauge.set(packet.data[6])
+                    self.current_error_histogram.observe(abs(packet.data[2] - packet.data[6]))
 
                 # if time.time() - self.prev_broadcast_time > 0.25:
                 if self.enable_reporting and time.time() - self.prev_report_time > 1.0:
@@ -65,11 +116,34 @@ class BrakeControllerBridge(Node):
                     self.prev_report_time = time.time()
                 self.prev_broadcast_time = time.time()
 
-                await self.broadcast(packet)
+                if not self.block_mode:
+                    await self.broadcast(packet)
+                else:
+                    self.pending_packets.append(packet)
+                    if time.time() - self.prev_block_time >= self.block_interval:
+                        await self.broadcast_block()
+
+    async def broadcast_block(self):
+        block = packets_to_block(self.pending_packets, "brake")
+        self.pending_packets = []
+        self.prev_block_time = time.time()
+        await self.broadcast(block)
 
     def command_brake(self, command):
         self.brake_controller_bridge_arduino.write("b" + str(float(command)))
 
+    def upload_profile(self, profile):
+        """Send a BrakeProfile's steps. The brake plays them back on its own clock once start_profile is sent"""
+        self.profile_edges = []
+        for command in profile.encode():
+            self.brake_controller_bridge_arduino.write(command)
+
+    def start_profile(self):
+        self.brake_controller_bridge_arduino.write(start_profile_command)
+
+    def stop_profile(self):
+        self.brake_controller_bridge_arduino.write(stop_profile_command)
+
     def set_kp(self, kp):
         self.kp = kp
         self.brake_controller_bridge_arduino.write("kp" + str(float(kp)))
@@ -83,4 +157,9 @@ class BrakeControllerBridge(Node):
         self.brake_controller_bridge_arduino.write("kd" + str(float(kd)))
 
     async def teardown(self):
+        # whatever came in since the last block
+        if self.block_mode and len(self.pending_packets) > 0:
+            await self.broadcast_block()
         self.factory.stop_all()
+        self.logger.info("link health: %s" % format_report(self.link_health.report()))
+        self.logger.info("malformed packets dropped: %s" % self.num_malformed_packets)
@@ -0,0 +1,139 @@
+import os
+import tty
+import time
+import select
+import threading
+
+from data_processing.brake_profile import BrakeProfile, clear_profile_command, append_profile_command, \
+    start_profile_command, stop_profile_command, edge_packet_name
+
+
+class BrakeProfilePlayer:
+    """Python copy of the BrakeProfile firmware library's stepping logic"""
+
+    def __init__(self):
+        self.commands = []
+        self.profile = BrakeProfile()
+        self.running = False
+        self.next_step = 0
+        self.start_time = 0.0
+
+    def handle(self, command):
+        if command == clear_profile_command:
+            self.commands = [command]
+            self.profile = BrakeProfile()
+            self.running = False
+        elif command.startswith(append_profile_command):
+            self.commands.append(command)
+            self.profile = BrakeProfile.decode(self.commands)
+        elif command == start_profile_command:
+            self.running = len(self.profile) > 0
+            self.next_step = 0
+            self.start_time = time.time()
+        elif command == stop_profile_command or command.startswith("b"):
+            self.running = False
+
+    def update(self):
+        """Returns (step index, ms since start, set point) if a step is due"""
+        if not self.running:
+            return None
+        elapsed = time.time() - self.start_time
+        if elapsed < self.profile.offsets[self.next_step]:
+            return None
+
+        step = self.next_step
+        self.next_step += 1
+        if self.next_step >= len(self.profile):
+            self.running = False
+        return step, int(elapsed * 1000.0), self.profile.currents_mA[step]
+
+
+class BrakeSimulator:
+    """Pretends to be the brake controller's profile player on a pseudo terminal.
+
+    The arduino_factory framing isn't reproduced. Commands are newline terminated and edges come back as
+    'edge\\t<index>\\t<ms since start>\\t<set point>' lines. Point serial code at port_path.
+    """
+
+    def __init__(self, update_interval=0.001):
+        self.master_fd, self.slave_fd = os.openpty()
+        # no echo or newline translation, like a real serial port
+        tty.setraw(self.slave_fd)
+        self.port_path = os.ttyname(self.slave_fd)
+        self.update_interval = update_interval
+
+        self.player = BrakeProfilePlayer()
+        self.set_point = 0.0
+
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="brake-simulator", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        os.close(self.master_fd)
+        os.close(self.slave_fd)
+
+    def run(self):
+        buffer = b""
+        while not self.stop_event.is_set():
+            readable, _, _ = select.select([self.master_fd], [], [], self.update_interval)
+            if len(readable) > 0:
+                buffer += os.read(self.master_fd, 1024)
+                while b"\n" in buffer:
+                    line, buffer = buffer.split(b"\n", 1)
+                    self.handle(line.decode().strip())
+
+            edge = self.player.update()
+            if edge is not None:
+                self.set_point = edge[2]
+                os.write(self.master_fd, ("%s\t%s\t%s\t%s\n" % ((edge_packet_name,) + edge)).encode())
+
+    def handle(self, command):
+        if command.startswith("b"):
+            self.set_point = float(command[1:])
+        self.player.handle(command)
+
+
+if __name__ == '__main__':
+    def test():
+        simulator = BrakeSimulator()
+        simulator.start()
+        port = os.open(simulator.port_path, os.O_RDWR | os.O_NOCTTY)
+
+        profile = BrakeProfile()
+        for index in range(20):
+            profile.append(index * 0.05, 10.0 + index * 1.25)
+        expected = profile.quantized()
+
+        for command in profile.encode() + [start_profile_command]:
+            os.write(port, (command + "\n").encode())
+
+        edges = []
+        buffer = b""
+        deadline = time.time() + profile.duration + 1.0
+        while len(edges) < len(profile) and time.time() < deadline:
+            readable, _, _ = select.select([port], [], [], 0.1)
+            if len(readable) > 0:
+                buffer += os.read(port, 1024)
+                while b"\n" in buffer:
+                    line, buffer = buffer.split(b"\n", 1)
+                    name, index, edge_ms, set_point = line.decode().split("\t")
+                    assert name == edge_packet_name, name
+                    edges.append((int(index), int(edge_ms), float(set_point)))
+
+        os.close(port)
+        simulator.stop()
+
+        assert len(edges) == len(profile), "%s of %s edges reported" % (len(edges), len(profile))
+        lateness = []
+        for index, edge_ms, set_point in edges:
+            assert abs(set_point - expected.currents_mA[index]) < 1E-9, (index, set_point)
+            lateness.append(edge_ms / 1000.0 - expected.offsets[index])
+        assert min(lateness) >= -0.001 and max(lateness) < 0.02, lateness
+        print("%s edges, late by at most %0.1fms" % (len(edges), max(lateness) * 1000.0))
+
+    test()
@@ -0,0 +1,40 @@
+import numpy as np
+from atlasbuggy import Node
+
+from data_processing.experiment_helpers.encoder_constants import rel_enc_ticks_to_rad
+from data_processing.packet_blocks import as_block, filtered_encoder_dtype
+from data_processing.streaming_filter import AlphaBetaFilter
+
+
+class EncoderFilterNode(Node):
+    """Sits between the encoder bridge and live consumers. Republishes every encoder record with the spring
+    deflection, its smoothed value and its rate added, one block per message it receives"""
+
+    def __init__(self, enabled=True, time_constant=0.1):
+        super(EncoderFilterNode, self).__init__(enabled)
+
+        self.encoder_reader_bridge_tag = "encoder_reader_bridge"
+        self.encoder_reader_bridge_sub = self.define_subscription(self.encoder_reader_bridge_tag, queue_size=None)
+        self.encoder_reader_bridge_queue = None
+
+        self.deflection_filter = AlphaBetaFilter(time_constant)
+
+    def take(self):
+        self.encoder_reader_bridge_queue = self.encoder_reader_bridge_sub.get_queue()
+
+    async def loop(self):
+        while True:
+            block = as_block(await self.encoder_reader_bridge_queue.get(), "enc")
+            await self.broadcast(self.filter_block(block))
+
+    def filter_block(self, block):
+        filtered = np.empty(len(block), dtype=filtered_encoder_dtype)
+        for name in block.dtype.names:
+            filtered[name] = block[name]
+
+        filtered["deflection"] = (block["enc1_pos"] - block["enc2_pos"]) * rel_enc_ticks_to_rad
+        for index in range(len(filtered)):
+            filtered["smoothed_deflection"][index], filtered["deflection_rate"][index] = \
+                self.deflection_filter.update(float(filtered["timestamp"][index]),
+                                              float(filtered["deflection"][index]))
+        return filtered
@@ -4,19 +4,46 @@ import asyncio
 from atlasbuggy import Node
 from arduino_factory import Arduino
 
+from data_processing.packet_blocks import packets_to_block, has_record_layout
+from diagnostics.link_health import LinkHealth, format_report
+
 
 class EncoderReaderBridge(Node):
-    def __init__(self, factory, enabled=True, enable_reporting=True):
+    def __init__(self, factory, enabled=True, enable_reporting=True, arduino_name="encoder_reader",
+                 telemetry_bus=None, block_mode=False, block_interval=0.05, metrics=None):
         self.set_logger(write=True)
         super(EncoderReaderBridge, self).__init__(enabled)
         self.factory = factory
-        self.encoder_reader_bridge_arduino = Arduino("encoder_reader", self.factory)
+        self.encoder_reader_bridge_arduino = Arduino(arduino_name, self.factory)
 
         self.prev_broadcast_time = 0.0
         self.prev_report_time = 0.0
         self.enable_reporting = enable_reporting
 
+        # publishes every packet to shared memory for consumers in other processes
+        self.telemetry_bus = telemetry_bus
+
         self.num_packets_received = 0
+        # garbled lines that parsed into an enc packet with the wrong number of values. Logged, not passed on
+        self.num_malformed_packets = 0
+        self.link_health = LinkHealth("enc")
+
+        # MetricsRegistry to report to, or None
+        if metrics is not None:
+            self.packet_counter = metrics.counter("packets_total", "Packets read", labels=dict(stream="enc"))
+            self.packet_age_histogram = metrics.histogram(
+                "encoder_packet_age_seconds", "Time from a packet arriving to the bridge reading it")
+            metrics.gauge("link_estimated_lost", "Packets missing from the device's timestamps",
+                          labels=dict(stream="enc"), function=lambda: self.link_health.estimated_lost)
+        else:
+            self.packet_counter = None
+
+        # in block mode every packet read is collected and subscribers get a record array of them
+        # every block_interval instead of one broadcast per packet
+        self.block_mode = block_mode
+        self.block_interval = block_interval
+        self.pending_packets = []
+        self.prev_block_time = 0.0
 
     async def setup(self):
         start_packet = self.encoder_reader_bridge_arduino.start()
@@ -34,8 +61,23 @@ class EncoderReaderBridge(Node):
             while time_diff == 0.0 or time_diff > 0.1: # don't let the packets get behind
                 packet = self.encoder_reader_bridge_arduino.read()
                 self.log_to_buffer(packet.receive_time, packet)
+                if packet.name == "enc" and not has_record_layout(packet, "enc"):
+                    self.num_malformed_packets += 1
+                    # read another, this one can't be broadcast
+                    time_diff = 0.0
+                    continue
+                if packet.name is not None:
+                    self.link_health.update(packet)
+                if self.telemetry_bus is not None:
+                    self.telemetry_bus.publish(packet)
+                if self.block_mode and packet.name == "enc":
+                    # stale packets are skipped one at a time but still make it into the block
+                    self.pending_packets.append(packet)
                 self.num_packets_received += 1
                 time_diff = time.time() - packet.receive_time
+                if self.packet_counter is not None:
+                    self.packet_counter.inc()
+                    self.packet_age_histogram.observe(time_diff)
 
             await asyncio.sleep(0.0)
 
@@ -68,8 +110,22 @@ class EncoderReaderBridge(Node):
                     self.prev_report_time = time.time()
                 self.prev_broadcast_time = time.time()
 
-                await self.broadcast(packet)
+                if not self.block_mode:
+                    await self.broadcast(packet)
+                elif time.time() - self.prev_block_time >= self.block_interval:
+                    await self.broadcast_block()
+
+    async def broadcast_block(self):
+        block = packets_to_block(self.pending_packets, "enc")
+        self.pending_packets = []
+        self.prev_block_time = time.time()
+        await self.broadcast(block)
 
     async def teardown(self):
+        # whatever came in since the last block
+        if self.block_mode and len(self.pending_packets) > 0:
+            await self.broadcast_block()
         self.factory.stop_all()
         self.logger.info("packets per sec: %s" % (self.num_packets_received / (time.time() - self.start_time)))
+        self.logger.info("malformed packets dropped: %s" % self.num_malformed_packets)
+        self.logger.info("link health: %s" % format_report(self.link_health.report()))
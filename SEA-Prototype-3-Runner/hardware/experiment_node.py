@@ -1,16 +1,26 @@
 import time
 import asyncio
+import numpy as np
 from atlasbuggy import Node
 
 from data_processing.experiment_helpers import *
 from data_processing.experiment_helpers.single_weight_helpers import average_sample
 from data_processing.torque_table import TorqueTable
+from data_processing.packet_blocks import message_field
+from data_processing.brake_profile import build_ramp_profile, max_profile_steps
+from data_processing.settle_detector import SettleDetector
+from data_processing.waveforms import WaveformPacket
+from data_processing.experiment_helpers.encoder_constants import rel_enc_ticks_to_rad
 
 
 class ExperimentNode(Node):
-    def __init__(self, step_duration, num_steps, min_current_mA, torque_table_path, max_current_mA=None, enabled=True):
+    def __init__(self, step_duration, num_steps, min_current_mA, torque_table_path, max_current_mA=None, enabled=True,
+                 clock=time, motor_speed=3200, use_brake_profile=False, adaptive_stepping=False, min_dwell=0.5,
+                 max_dwell=None, waveform=None):
         self.set_logger(write=True)
         super(ExperimentNode, self).__init__(enabled)
+        # anything with a time() method. Replays pass in a virtual clock
+        self.clock = clock
         self.brake_controller_bridge_tag = "brake_controller_bridge"
         self.brake_controller_bridge_sub = self.define_subscription(
             self.brake_controller_bridge_tag,
@@ -24,7 +34,8 @@ class ExperimentNode(Node):
         self.motor_controller_bridge_sub = self.define_subscription(
             self.motor_controller_bridge_tag,
             queue_size=None,
-            required_methods=("queue_speed", "write_pause", "run_queue", "clear_write_queue"),
+            required_methods=("queue_speed", "write_pause", "run_queue", "clear_write_queue", "log_experiment_start",
+                              "log_experiment_stop"),
         )
         self.motor_controller_bridge = None
 
@@ -32,6 +43,49 @@ class ExperimentNode(Node):
         self.encoder_reader_bridge_sub = self.define_subscription(self.encoder_reader_bridge_tag, queue_size=5)
         self.encoder_reader_bridge_queue = None
 
+        self.torque_table = None
+        self.min_torque_forcing = 0.0
+        self.min_torque_unforcing = 0.0
+        self.max_torque_forcing = 0.0
+        self.max_torque_unforcing = 0.0
+        self.experiment_step_duration = 0.0
+        self.experiment_num_steps = 0
+        self.motor_speed = 0
+
+        # upload each ramp to the brake so its steps are timed by the brake instead of the host
+        self.use_brake_profile = use_brake_profile
+        self.brake_profile = None
+
+        # move on to the next brake step as soon as the spring's deflection settles instead of
+        # waiting out step_duration. Settled means less than a tick of drift and noise over half a second
+        self.adaptive_stepping = adaptive_stepping
+        self.min_dwell = min_dwell
+        self.max_dwell = max_dwell
+        self.settle_detector = SettleDetector(
+            window_duration=0.5, slope_threshold=2.0 * rel_enc_ticks_to_rad, std_threshold=rel_enc_ticks_to_rad
+        )
+        self.dwell_times = []
+        self.adaptive_task = None
+
+        # a Waveform (data_processing/waveforms.py) to stream instead of the staircase, sample by sample
+        # at its deadlines. Every sample sent is logged as a "waveform" packet
+        self.waveform = waveform
+        self.waveform_task = None
+        self.waveform_lateness = []
+        self.missed_waveform_samples = 0
+
+        # (time the command should go out, current) for every brake command of the last experiment
+        self.brake_schedule = []
+
+        self.experiment_time = self.clock.time()
+
+        self.taking_sample_lock = asyncio.Event()
+        self.sample_duration = 0.0
+
+        self.configure(step_duration, num_steps, min_current_mA, torque_table_path, max_current_mA, motor_speed)
+
+    def configure(self, step_duration, num_steps, min_current_mA, torque_table_path, max_current_mA=None,
+                  motor_speed=3200):
         self.torque_table = TorqueTable(torque_table_path)
         self.min_torque_forcing = self.torque_table.to_torque(True, min_current_mA)
         self.min_torque_unforcing = self.torque_table.to_torque(False, min_current_mA)
@@ -44,11 +98,13 @@ class ExperimentNode(Node):
 
         self.experiment_step_duration = step_duration
         self.experiment_num_steps = num_steps
+        self.motor_speed = motor_speed
 
-        self.experiment_time = time.time()
-
-        self.taking_sample_lock = asyncio.Event()
-        self.sample_duration = 0.0
+        self.brake_profile = build_ramp_profile(self.torque_table, step_duration, num_steps, min_current_mA,
+                                                max_current_mA)
+        if self.use_brake_profile and len(self.brake_profile) > max_profile_steps:
+            self.logger.warning("%s brake steps don't fit on the brake controller (max %s). "
+                                "Sending them one at a time" % (len(self.brake_profile), max_profile_steps))
 
         self.logger.info(
             "Experiment:\n"
@@ -57,14 +113,16 @@ class ExperimentNode(Node):
             "\tApprox. experiment duration: %f\n"
             "\tTorque step resolution: %f\n"
             "\tTorque range: %f..%f (forcing), %f..%f (unforcing)\n"
+            "\tMotor speed: %d\n"
             "\tTorque table path: %s" % (
                 self.experiment_step_duration,
                 self.experiment_num_steps,
                 # experiments consist of a ramp up, ramp down, motor direction change and repeat
                 self.experiment_step_duration * self.experiment_num_steps * 4,
                 self.torque_table.max_torque / self.experiment_num_steps,
-                self.min_torque_forcing, self.torque_table.max_torque,
-                self.min_torque_unforcing, self.torque_table.max_torque,
+                self.min_torque_forcing, self.max_torque_forcing,
+                self.min_torque_unforcing, self.max_torque_unforcing,
+                self.motor_speed,
                 torque_table_path
             )
         )
@@ -78,27 +136,164 @@ class ExperimentNode(Node):
         self.encoder_reader_bridge_sub.enabled = False
 
     def run_experiment(self):
-        self.experiment_time = time.time()
-        self.motor_controller_bridge.queue_speed(3200)
+        if self.waveform is not None:
+            self.waveform_task = asyncio.ensure_future(self.run_waveform_experiment())
+            return
+
+        if self.adaptive_stepping:
+            self.adaptive_task = asyncio.ensure_future(self.run_adaptive_experiment())
+            return
+
+        self.experiment_time = self.clock.time()
+        self.brake_schedule = []
+        if self.is_using_brake_profile():
+            self.brake_controller_bridge.upload_profile(self.brake_profile)
+        self.motor_controller_bridge.queue_speed(self.motor_speed)
         self.write_pause(self.experiment_step_duration + 2.0)
 
-        self.ramp_up_brake()
-        self.ramp_down_brake()
+        self.ramp_brake()
         self.write_pause(self.experiment_step_duration + 2.0)
 
-        self.motor_controller_bridge.queue_speed(-3200)
+        self.motor_controller_bridge.queue_speed(-self.motor_speed)
         self.write_pause(self.experiment_step_duration + 2.0)
 
-        self.ramp_up_brake()
-        self.ramp_down_brake()
+        self.ramp_brake()
         self.write_pause(self.experiment_step_duration + 2.0)
 
         self.motor_controller_bridge.queue_speed(0)
-        self.brake_controller_bridge.command_brake(0)
+        self.command_brake(0.0)
 
         self.motor_controller_bridge.run_queue()
 
+    async def run_adaptive_experiment(self):
+        # steps are timed live here so nothing is queued on the bridges. The start and stop markers the queue
+        # would log are logged by hand, and set_speed logs the direction switch as a command like the queue does
+        self.brake_schedule = []
+        self.dwell_times = []
+        self.encoder_reader_bridge_sub.enabled = True
+        settle_duration = self.experiment_step_duration + 2.0
+        self.motor_controller_bridge.log_experiment_start()
+        try:
+            for motor_direction in (1, -1):
+                self.motor_controller_bridge.set_speed(motor_direction * self.motor_speed)
+                await asyncio.sleep(settle_duration)
+
+                for step_num in range(self.experiment_num_steps):
+                    self.command_brake_now(self.get_forcing_current_mA(step_num))
+                    await self.dwell()
+                for step_num in range(self.experiment_num_steps - 1, -1, -1):
+                    self.command_brake_now(self.get_unforcing_current_mA(step_num))
+                    await self.dwell()
+
+                await asyncio.sleep(settle_duration)
+        finally:
+            self.motor_controller_bridge.set_speed(0)
+            self.command_brake_now(0.0)
+            self.motor_controller_bridge.log_experiment_stop()
+            self.encoder_reader_bridge_sub.enabled = False
+
+        self.logger.info("Adaptive experiment finished. Step dwell min/mean/max: %0.2f/%0.2f/%0.2fs" % (
+            min(self.dwell_times), sum(self.dwell_times) / len(self.dwell_times), max(self.dwell_times)
+        ))
+
+    async def run_waveform_experiment(self):
+        """Send each sample when it's due. When the loop falls behind, samples that are already past due are dropped
+        and the latest one goes out instead, the controllers never get a burst of stale commands"""
+        waveform = self.waveform
+        self.brake_schedule = []
+        self.waveform_lateness = []
+        self.missed_waveform_samples = 0
+        self.logger.info("Streaming waveform %s" % waveform)
+
+        prev_current_mA = None
+        prev_speed = None
+        # same markers as the queue so the analysis finds the window. A reversal in motor_speed gets logged by
+        # set_speed as the direction switch, a waveform that never reverses has none
+        self.motor_controller_bridge.log_experiment_start()
+        index = 0
+        try:
+            # get the motor up to speed and let it settle before the first sample, like the staircase does
+            prev_speed = int(waveform.motor_speed[0])
+            self.motor_controller_bridge.set_speed(prev_speed)
+            await asyncio.sleep(self.experiment_step_duration + 2.0)
+
+            start_time = self.clock.time()
+            while index < len(waveform):
+                delay = start_time + waveform.times[index] - self.clock.time()
+                if delay > 0.0:
+                    await asyncio.sleep(delay)
+
+                latest_index = min(int((self.clock.time() - start_time) * waveform.rate), len(waveform) - 1)
+                if latest_index > index:
+                    self.missed_waveform_samples += latest_index - index
+                    index = latest_index
+
+                deadline = start_time + waveform.times[index]
+                current_mA = float(waveform.current_mA[index])
+                speed = int(waveform.motor_speed[index])
+                self.experiment_time = deadline
+                if prev_current_mA is None or abs(current_mA - prev_current_mA) >= 0.01:
+                    self.command_brake(current_mA)
+                    prev_current_mA = current_mA
+                if speed != prev_speed:
+                    self.motor_controller_bridge.set_speed(speed)
+                    prev_speed = speed
+
+                sent_time = self.clock.time()
+                self.waveform_lateness.append(sent_time - deadline)
+                self.log_to_buffer(sent_time, WaveformPacket(deadline, index, current_mA, speed,
+                                                             waveform.torque_nm[index], sent_time))
+                index += 1
+        finally:
+            self.motor_controller_bridge.set_speed(0)
+            self.command_brake_now(0.0)
+            self.motor_controller_bridge.log_experiment_stop()
+
+        self.logger.info("Waveform finished. %s of %s samples dropped, max lateness %0.1fms" % (
+            self.missed_waveform_samples, len(waveform), max(self.waveform_lateness) * 1000.0))
+
+    def command_brake_now(self, current_mA):
+        self.experiment_time = self.clock.time()
+        self.command_brake(current_mA)
+
+    async def dwell(self):
+        """Wait for the encoder delta to settle after a brake step, between min_dwell and max_dwell"""
+        max_dwell = self.experiment_step_duration if self.max_dwell is None else self.max_dwell
+        self.settle_detector.reset()
+
+        # packets from before the step would make it look settled right away
+        while not self.encoder_reader_bridge_queue.empty():
+            await self.encoder_reader_bridge_queue.get()
+
+        step_start_time = self.clock.time()
+        while True:
+            while not self.encoder_reader_bridge_queue.empty():
+                message = await self.encoder_reader_bridge_queue.get()
+                encoder_1_ticks = np.asarray(message_field(message, "enc", "enc1_pos"), dtype=float)
+                encoder_2_ticks = np.asarray(message_field(message, "enc", "enc2_pos"), dtype=float)
+                self.settle_detector.extend(message_field(message, "enc", "timestamp"),
+                                            (encoder_1_ticks - encoder_2_ticks) * rel_enc_ticks_to_rad)
+
+            dwell_time = self.clock.time() - step_start_time
+            if dwell_time >= max_dwell or (dwell_time >= self.min_dwell and self.settle_detector.is_settled()):
+                break
+            await asyncio.sleep(0.01)
+
+        self.dwell_times.append(dwell_time)
+
+    async def wait_for_experiment(self):
+        if self.waveform_task is not None:
+            await self.waveform_task
+        elif self.adaptive_stepping:
+            await self.adaptive_task
+        else:
+            await self.motor_controller_bridge.queue_finished_event.wait()
+
     def cancel_experiment(self):
+        if self.adaptive_task is not None and not self.adaptive_task.done():
+            self.adaptive_task.cancel()
+        if self.waveform_task is not None and not self.waveform_task.done():
+            self.waveform_task.cancel()
         self.motor_controller_bridge.clear_write_queue()
         self.brake_controller_bridge.brake_controller_bridge_arduino.clear_write_queue()
 
@@ -121,14 +316,14 @@ class ExperimentNode(Node):
             # brake_timestamps = []
             # brake_current = []
 
-            sample_start_time = time.time()
-            while time.time() - sample_start_time < self.sample_duration:
+            sample_start_time = self.clock.time()
+            while self.clock.time() - sample_start_time < self.sample_duration:
                 while not self.encoder_reader_bridge_queue.empty():
                     message = await self.encoder_reader_bridge_queue.get()
 
-                    # encoder_timestamps.append(message.timestamp)
-                    encoder_1_ticks.append(message.data[4])
-                    encoder_2_ticks.append(message.data[5])
+                    # encoder_timestamps.extend(message_field(message, "enc", "timestamp"))
+                    encoder_1_ticks.extend(message_field(message, "enc", "enc1_pos"))
+                    encoder_2_ticks.extend(message_field(message, "enc", "enc2_pos"))
                 await asyncio.sleep(0.0)
 
             encoder_delta_rad_avg = average_sample(encoder_1_ticks, encoder_2_ticks)
@@ -141,18 +336,39 @@ class ExperimentNode(Node):
             # self.brake_controller_bridge_sub.enabled = False
             self.taking_sample_lock.clear()
 
+    def is_using_brake_profile(self):
+        return self.use_brake_profile and len(self.brake_profile) <= max_profile_steps
+
+    def ramp_brake(self):
+        if self.is_using_brake_profile():
+            self.play_brake_profile()
+        else:
+            self.ramp_up_brake()
+            self.ramp_down_brake()
+
+    def play_brake_profile(self):
+        # the start command is the only thing timed by the host, the brake times the steps after it
+        for offset, current_mA in zip(self.brake_profile.offsets, self.brake_profile.currents_mA):
+            self.brake_schedule.append((self.experiment_time + offset, current_mA))
+        self.brake_controller_bridge.start_profile()
+        self.write_pause(len(self.brake_profile) * self.experiment_step_duration)
+
     def ramp_up_brake(self):
         for step_num in range(self.experiment_num_steps):
             current_mA = self.get_forcing_current_mA(step_num)
-            self.brake_controller_bridge.command_brake(current_mA)
+            self.command_brake(current_mA)
             self.write_pause(self.experiment_step_duration)
 
     def ramp_down_brake(self):
         for step_num in range(self.experiment_num_steps - 1, -1, -1):
             current_mA = self.get_unforcing_current_mA(step_num)
-            self.brake_controller_bridge.command_brake(current_mA)
+            self.command_brake(current_mA)
             self.write_pause(self.experiment_step_duration)
 
+    def command_brake(self, current_mA):
+        self.brake_schedule.append((self.experiment_time, float(current_mA)))
+        self.brake_controller_bridge.command_brake(current_mA)
+
     def get_forcing_current_mA(self, step_num):
         percent_torque = (step_num + 1) / self.experiment_num_steps
         torque = percent_torque * (self.max_torque_forcing - self.min_torque_forcing) + self.min_torque_forcing
@@ -0,0 +1,48 @@
+import json
+from collections import namedtuple
+
+ExperimentProfile = namedtuple(
+    "ExperimentProfile",
+
+    "name "
+    "step_duration "
+    "num_steps "
+    "min_current_mA "
+    "max_current_mA "
+    "torque_table_path "
+    "motor_speed "
+    "adaptive_stepping "
+    "min_dwell "
+    "max_dwell "
+    "waveform "  # None for the staircase, or a waveform spec for data_processing.waveforms.build_waveform
+)
+
+default_profile = ExperimentProfile(
+    name="default",
+    step_duration=2.0,
+    num_steps=50,
+    min_current_mA=15.0,
+    max_current_mA=None,
+    torque_table_path="brake_torque_data/B5Z Torque Table.csv",
+    motor_speed=3200,
+    adaptive_stepping=False,
+    min_dwell=0.5,
+    max_dwell=None,
+    waveform=None,
+)
+
+
+def load_experiment_profiles(path):
+    """Read a JSON list of experiment profiles. Fields that are left out take the default profile's value"""
+    with open(path) as file:
+        entries = json.load(file)
+
+    profiles = []
+    for index, entry in enumerate(entries):
+        unknown_fields = set(entry.keys()) - set(ExperimentProfile._fields)
+        if len(unknown_fields) > 0:
+            raise ValueError("Profile #%s in %s has unknown fields: %s" % (index, path, sorted(unknown_fields)))
+        if "name" not in entry:
+            entry["name"] = "profile_%s" % index
+        profiles.append(default_profile._replace(**entry))
+    return profiles
@@ -3,38 +3,142 @@ import asyncio
 from smc import SMC
 from queue import Queue
 from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
 from atlasbuggy import Node
 
+from .smc_telemetry import MotorPacket, read_telemetry, default_telemetry_variables
+
+# logged around every experiment. MotorPlayback and iter_motor_events look for these to find where it starts and stops
+experiment_start_message = "Executing motor command queue backlog"
+experiment_stop_message = "Command queue backlog finished!"
+
+default_smc_device_path = '/dev/serial/by-id/usb-Pololu_Corporation_Pololu_Simple_High-Power_Motor_Controller_18v15_33FF-6806-4D4B-3731-5147-1543-if00'
+
 
 class MotorControllerBridge(Node):
-    def __init__(self, enabled=True):
+    def __init__(self, enabled=True, device_path=default_smc_device_path, metrics=None, telemetry_interval=0.1,
+                 telemetry_variables=default_telemetry_variables, serial_timeout=0.1):
         self.set_logger(write=True)
         super(MotorControllerBridge, self).__init__(enabled)
+        self.device_path = device_path
         if enabled:
-            self.mc = SMC('/dev/serial/by-id/usb-Pololu_Corporation_Pololu_Simple_High-Power_Motor_Controller_18v15_33FF-6806-4D4B-3731-5147-1543-if00', 115200)
+            self.mc = SMC(self.device_path, 115200)
+            # SMC keeps its timeout to itself, reads would block forever on a controller that doesn't answer
+            self.mc.ser.timeout = serial_timeout
         else:
             self.mc = None
 
+        # every call into the driver goes through this one thread. The event loop never waits on the serial port
+        # and commands and telemetry reads never interleave on it
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="smc")
+
+        # seconds between telemetry reads, None to not poll
+        self.telemetry_interval = telemetry_interval
+        self.telemetry_variables = telemetry_variables
+        self.telemetry_task = None
+        self.num_telemetry_packets = 0
+        self.num_skipped_polls = 0
+
+        # speed commands submitted but not sent yet. Telemetry polls make way for them
+        self.pending_commands = 0
+        self.pending_lock = Lock()
+
         self.queue_active_event = asyncio.Event()
+        self.queue_finished_event = asyncio.Event()
         self.queue_lock = Lock()
         self.command_queue = Queue()
         self.pause_timestamp = None
 
+        # how late each command went out after the pause before it expired
+        self.expired_pause_timestamp = None
+        self.command_lateness = []
+
+        # MetricsRegistry to report to, or None
+        if metrics is not None:
+            self.command_counter = metrics.counter("motor_commands_total", "Speed commands sent to the motor")
+            self.command_lateness_histogram = metrics.histogram(
+                "motor_command_lateness_seconds", "How late a command went out after the pause before it expired")
+            self.telemetry_gauges = [
+                metrics.gauge("motor_telemetry", "Last value the motor controller reported", labels=dict(variable=name))
+                for name in self.telemetry_variables
+            ]
+        else:
+            self.command_counter = None
+            self.telemetry_gauges = None
+
     async def setup(self):
         self.logger.debug("Initializing...")
-        self.mc.init()
-        self.mc.speed(0)
+        await self.run_in_executor(self.mc.init)
+        await self.run_in_executor(self.mc.speed, 0)
         self.logger.debug("done!")
 
+        if self.telemetry_interval is not None:
+            self.telemetry_task = asyncio.ensure_future(self.poll_telemetry())
+
+    def run_in_executor(self, function, *args):
+        return asyncio.get_event_loop().run_in_executor(self.executor, function, *args)
+
+    def submit(self, function, *args):
+        """Queue a driver call without waiting for it. Calls go out in the order they were submitted"""
+        future = self.executor.submit(function, *args)
+        future.add_done_callback(self.check_driver_call)
+        return future
+
+    def check_driver_call(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            self.logger.error("motor controller call failed: %r" % future.exception())
+
     def set_speed(self, command):
         command = int(-command)
         self.logger.debug("command: %s" % command)
-        self.mc.speed(command)
+        with self.pending_lock:
+            self.pending_commands += 1
+        self.submit(self.mc.speed, command).add_done_callback(self.command_sent)
+
+    def command_sent(self, future):
+        with self.pending_lock:
+            self.pending_commands -= 1
+
+    def commands_pending(self):
+        return self.pending_commands > 0
+
+    async def poll_telemetry(self):
+        while True:
+            request_time = time.time()
+            data = None
+            try:
+                if not self.commands_pending():
+                    # a command submitted while this is reading aborts it before the next variable
+                    data = await self.run_in_executor(read_telemetry, self.mc, self.telemetry_variables,
+                                                      self.commands_pending)
+            except IOError as error:
+                self.logger.warning(str(error))
+            else:
+                if data is None:
+                    # commands go first, this poll's packet is dropped
+                    self.num_skipped_polls += 1
+                else:
+                    packet = MotorPacket(request_time, self.num_telemetry_packets, data, time.time())
+                    self.num_telemetry_packets += 1
+                    self.log_to_buffer(packet.receive_time, packet)
+                    if self.telemetry_gauges is not None:
+                        for gauge, value in zip(self.telemetry_gauges, data):
+                            gauge.set(value)
+                    await self.broadcast(packet)
+            await asyncio.sleep(max(self.telemetry_interval - (time.time() - request_time), 0.0))
+
+    def log_experiment_start(self):
+        """For experiments that command the motor live instead of through the queue"""
+        self.logger.info(experiment_start_message)
+
+    def log_experiment_stop(self):
+        self.logger.info(experiment_stop_message)
 
     def queue_speed(self, command):
         self.command_queue.put(int(command))
 
     def run_queue(self):
+        self.queue_finished_event.clear()
         self.queue_active_event.set()
 
     def write_pause(self, timestamp):
@@ -47,12 +151,13 @@ class MotorControllerBridge(Node):
         while True:
             await self.queue_active_event.wait()
 
-            self.logger.info("Executing motor command queue backlog")
+            self.log_experiment_start()
             with self.queue_lock:
                 while not self.command_queue.empty():
                     if self.pause_timestamp is not None:
                         # if pause timer has expired, reset the timer and continue sending commands
                         if time.time() > self.pause_timestamp:
+                            self.expired_pause_timestamp = self.pause_timestamp
                             self.pause_timestamp = None
                         await asyncio.sleep(0.0)
                         continue
@@ -60,6 +165,13 @@ class MotorControllerBridge(Node):
                     command = self.command_queue.get()
                     if type(command) == int:
                         self.set_speed(command)
+                        if self.command_counter is not None:
+                            self.command_counter.inc()
+                        if self.expired_pause_timestamp is not None:
+                            self.command_lateness.append(time.time() - self.expired_pause_timestamp)
+                            if self.command_counter is not None:
+                                self.command_lateness_histogram.observe(self.command_lateness[-1])
+                            self.expired_pause_timestamp = None
                     elif type(command) == float:
                         self.pause_timestamp = command
                     else:
@@ -69,11 +181,15 @@ class MotorControllerBridge(Node):
                         break
                     await asyncio.sleep(0.0)
 
-            self.logger.info("Command queue backlog finished!")
+            self.log_experiment_stop()
             self.queue_active_event.clear()
+            self.queue_finished_event.set()
 
 
     async def teardown(self):
         self.logger.debug("Tearing down")
-        self.mc.speed(0)
+        if self.telemetry_task is not None:
+            self.telemetry_task.cancel()
+        await self.run_in_executor(self.mc.speed, 0)
         # self.mc.stop()
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,58 @@
+from collections import namedtuple
+
+from .motor_controller_bridge import default_smc_device_path
+
+RigConfig = namedtuple(
+    "RigConfig",
+
+    "name "
+    "motor_device_path "
+    "brake_arduino_name "
+    "encoder_arduino_name "
+    "step_duration "
+    "num_steps "
+    "min_current_mA "
+    "torque_table_path "
+    "pid_constants_path "
+    "enable_reporting "
+    "enable_plotting "
+    "enable_gui "
+    "enable_loop_monitor "
+    "enable_telemetry_bus "
+    "enable_block_mode "
+    "use_brake_profile "
+    "adaptive_stepping "
+    "compress_logs "
+    "enable_encoder_filter "
+    "enable_metrics "
+    "metrics_port "  # localhost port the metrics are served on, give each rig its own
+)
+
+default_rig = RigConfig(
+    name="rig",
+    motor_device_path=default_smc_device_path,
+    brake_arduino_name="brake_controller",
+    encoder_arduino_name="encoder_reader",
+    step_duration=2.0,
+    num_steps=50,
+    min_current_mA=15.0,
+    torque_table_path="brake_torque_data/B5Z Torque Table.csv",
+    pid_constants_path="pickled/pid_constants.pkl",
+    enable_reporting=True,
+    enable_plotting=True,
+    enable_gui=True,
+    enable_loop_monitor=False,
+    enable_telemetry_bus=False,
+    enable_block_mode=False,
+    use_brake_profile=False,
+    adaptive_stepping=False,
+    compress_logs=False,
+    enable_encoder_filter=False,
+    enable_metrics=False,
+    metrics_port=9107,
+)
+
+
+def make_rig(name, **kwargs):
+    """Create a rig config that differs from the default rig only by the given fields"""
+    return default_rig._replace(name=name, **kwargs)
@@ -0,0 +1,53 @@
+import struct
+
+from data_processing.packet_blocks import LoggedPacket
+
+motor_packet_name = "motor"
+
+# Simple Motor Controller "get variable" command, followed by a variable id. The SMC answers with 2 bytes
+get_variable_command = 0xA1
+
+# name -> (variable id, signed, scale to the units in the name)
+smc_variables = {
+    "error_status": (0, False, 1.0),
+    "target_speed": (20, True, 1.0),
+    "speed": (21, True, 1.0),
+    "input_voltage_V": (23, False, 0.001),
+    "temperature_C": (24, False, 0.1),
+    # only the G2 controllers measure current
+    "current_mA": (44, False, 1.0),
+}
+
+# what the 18v15 on the rig can report, in the order it's put in MotorPacket.data
+default_telemetry_variables = ("speed", "target_speed", "input_voltage_V", "temperature_C", "error_status")
+
+
+class MotorPacket(LoggedPacket):
+    """Telemetry read back from the SMC. timestamp is when the request went out"""
+
+    def __init__(self, timestamp, global_sequence_num, data, receive_time):
+        super(MotorPacket, self).__init__(motor_packet_name, timestamp, global_sequence_num, data, receive_time)
+
+
+def read_variable(mc, name):
+    """Blocks on the serial port, only call it from the SMC's I/O thread"""
+    variable_id, signed, scale = smc_variables[name]
+    # a byte left over from a request that timed out would shift every answer after it onto the wrong variable
+    mc.ser.reset_input_buffer()
+    mc.write((get_variable_command, variable_id))
+    response = mc.ser.read(2)
+    if len(response) != 2:
+        raise IOError("SMC didn't answer a request for %s (got %s bytes)" % (name, len(response)))
+    value = struct.unpack("<h" if signed else "<H", response)[0]
+    return round(value * scale, 3)
+
+
+def read_telemetry(mc, names=default_telemetry_variables, interrupted=None):
+    """Read the variables one at a time. Gives up and returns None as soon as interrupted() is true, so something
+    more urgent waiting on the serial port only waits for the read in flight"""
+    data = []
+    for name in names:
+        if interrupted is not None and interrupted():
+            return None
+        data.append(read_variable(mc, name))
+    return data
@@ -0,0 +1,211 @@
+import sys
+import time
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+from data_processing.packet_blocks import stream_dtypes, packet_to_record, has_record_layout
+
+# header: number of records ever written, capacity, record size. Padded to a cache line
+header_size = 64
+header_dtype = np.uint64
+
+
+def shared_memory_name(bus_name, stream):
+    return "sea_%s_%s" % (bus_name, stream)
+
+
+class RingBufferOverrun(Exception):
+    pass
+
+
+class SharedRingBuffer:
+    """Single writer, many reader ring of fixed size records in shared memory.
+
+    The writer fills a record and then bumps the write count in the header, so a reader never sees a record
+    before it's complete. Readers keep their own cursor and can fall behind by up to capacity records
+    before the writer starts overwriting what they haven't read yet.
+    """
+
+    def __init__(self, name, dtype, capacity=None, create=False):
+        self.name = name
+        self.dtype = np.dtype(dtype)
+        self.is_owner = create
+
+        if create:
+            size = header_size + capacity * self.dtype.itemsize
+            try:
+                self.memory = shared_memory.SharedMemory(name, create=True, size=size)
+            except FileExistsError:
+                # left behind by a process that didn't shut down cleanly
+                stale = shared_memory.SharedMemory(name)
+                stale.close()
+                stale.unlink()
+                self.memory = shared_memory.SharedMemory(name, create=True, size=size)
+        else:
+            self.memory = self.attach(name)
+
+        self.header = np.ndarray((3,), dtype=header_dtype, buffer=self.memory.buf)
+        if create:
+            self.header[:] = (0, capacity, self.dtype.itemsize)
+        elif int(self.header[2]) != self.dtype.itemsize:
+            raise ValueError("%s holds %s byte records, expected %s" % (
+                name, int(self.header[2]), self.dtype.itemsize))
+
+        self.capacity = int(self.header[1])
+        self.records = np.ndarray((self.capacity,), dtype=self.dtype, buffer=self.memory.buf, offset=header_size)
+
+    @staticmethod
+    def attach(name):
+        # readers mustn't register the block with a resource tracker. Their own would unlink it when they exit
+        # and one shared with the writer would lose the writer's registration
+        if sys.version_info >= (3, 13):
+            return shared_memory.SharedMemory(name, track=False)
+        register = resource_tracker.register
+        resource_tracker.register = lambda *args: None
+        try:
+            return shared_memory.SharedMemory(name)
+        finally:
+            resource_tracker.register = register
+
+    @property
+    def write_count(self):
+        return int(self.header[0])
+
+    def write(self, record):
+        count = int(self.header[0])
+        self.records[count % self.capacity] = record
+        self.header[0] = count + 1
+
+    def close(self):
+        # views into the buffer have to go before the memory can be closed
+        self.header = None
+        self.records = None
+        self.memory.close()
+        if self.is_owner:
+            self.memory.unlink()
+
+
+class TelemetryBus:
+    """The bridges' side of the bus: one ring buffer per packet stream"""
+
+    def __init__(self, bus_name, capacity=2 ** 16, streams=None):
+        if streams is None:
+            streams = list(stream_dtypes.keys())
+        self.bus_name = bus_name
+        self.buffers = {}
+        # packets dropped for not having their stream's number of values
+        self.num_malformed = 0
+        for stream in streams:
+            self.buffers[stream] = SharedRingBuffer(
+                shared_memory_name(bus_name, stream), stream_dtypes[stream], capacity, create=True
+            )
+
+    def publish(self, packet):
+        if packet.name not in self.buffers:
+            return
+        if not has_record_layout(packet, packet.name):
+            self.num_malformed += 1
+            return
+        self.buffers[packet.name].write(packet_to_record(packet))
+
+    def close(self):
+        for ring_buffer in self.buffers.values():
+            ring_buffer.close()
+        self.buffers = {}
+
+
+class TelemetryReader:
+    """Reads one stream of a bus from another process. Each reader has its own cursor.
+
+    read() returns views into shared memory, not copies. A view stays valid until the writer wraps around
+    onto it. Copy anything that has to be kept longer, or call check() after using it to find out whether
+    it was overwritten while being read.
+    """
+
+    def __init__(self, bus_name, stream, start_at_oldest=False):
+        self.stream = stream
+        self.ring_buffer = SharedRingBuffer(shared_memory_name(bus_name, stream), stream_dtypes[stream])
+        self.capacity = self.ring_buffer.capacity
+
+        write_count = self.ring_buffer.write_count
+        if start_at_oldest:
+            self.cursor = max(0, write_count - self.capacity)
+        else:
+            self.cursor = write_count
+        self.read_start = self.cursor
+        self.num_dropped = 0
+
+    def available(self):
+        return self.ring_buffer.write_count - self.cursor
+
+    def read(self, max_records=None):
+        """Every record written since the last read as a list of at most two contiguous views
+        (two when the unread records wrap around the end of the ring)"""
+        write_count = self.ring_buffer.write_count
+        if write_count - self.cursor > self.capacity:
+            # fell behind, skip to the oldest record that's still intact
+            skipped_to = write_count - self.capacity
+            self.num_dropped += skipped_to - self.cursor
+            self.cursor = skipped_to
+
+        end = write_count
+        if max_records is not None:
+            end = min(end, self.cursor + max_records)
+        if end == self.cursor:
+            return []
+
+        start_index = self.cursor % self.capacity
+        stop_index = end % self.capacity
+        self.read_start = self.cursor
+        self.cursor = end
+        records = self.ring_buffer.records
+        if start_index < stop_index:
+            return [records[start_index:stop_index]]
+        if stop_index == 0:
+            return [records[start_index:]]
+        return [records[start_index:], records[:stop_index]]
+
+    def read_copy(self, max_records=None):
+        """Like read but concatenated into one array that's safe to keep"""
+        views = self.read(max_records)
+        if len(views) == 0:
+            return np.empty(0, dtype=stream_dtypes[self.stream])
+        block = np.concatenate(views)
+        self.check()
+        return block
+
+    def check(self):
+        """Raise if the writer lapped the records returned by the last read while they were being used"""
+        if self.ring_buffer.write_count - self.read_start > self.capacity:
+            raise RingBufferOverrun("%s: writer overwrote records that were still being read" % self.stream)
+
+    def close(self):
+        self.ring_buffer.close()
+
+
+def monitor(bus_name, interval=1.0):
+    """Attach to a running rig's bus and print what's coming through it.
+    Run with: python -m hardware.telemetry_bus <rig name>"""
+    readers = [TelemetryReader(bus_name, stream) for stream in stream_dtypes.keys()]
+    try:
+        while True:
+            time.sleep(interval)
+            for reader in readers:
+                block = reader.read_copy()
+                if len(block) == 0:
+                    print("%-6s no new samples" % reader.stream)
+                    continue
+                latency = time.time() - block["receive_time"][-1]
+                print("%-6s %6d samples, %7.2f Hz, dropped: %d, latest: %s (%0.1fms old)" % (
+                    reader.stream, len(block), len(block) / interval, reader.num_dropped, block[-1], latency * 1000.0
+                ))
+            print()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for reader in readers:
+            reader.close()
+
+
+if __name__ == '__main__':
+    monitor(sys.argv[1] if len(sys.argv) > 1 else "rig")
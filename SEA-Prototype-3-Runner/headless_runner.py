@@ -0,0 +1,218 @@
+import sys
+import time
+import asyncio
+import numpy as np
+from atlasbuggy import Node, Orchestrator, run
+from arduino_factory import DeviceFactory
+
+from hardware import BrakeControllerBridge, MotorControllerBridge, EncoderReaderBridge, ExperimentNode
+from hardware.rig_config import default_rig
+from hardware.experiment_profiles import load_experiment_profiles
+from data_processing.waveforms import build_waveform
+from data_processing.packet_blocks import message_field
+
+
+class PacketRateMonitor(Node):
+    """Counts the packets coming out of the bridges and keeps their receive times for the end of run report"""
+
+    def __init__(self, enabled=True):
+        self.set_logger(write=True)
+        super(PacketRateMonitor, self).__init__(enabled)
+
+        self.brake_controller_bridge_tag = "brake_controller_bridge"
+        self.brake_controller_bridge_sub = self.define_subscription(self.brake_controller_bridge_tag, queue_size=None)
+        self.brake_controller_bridge_queue = None
+
+        self.encoder_reader_bridge_tag = "encoder_reader_bridge"
+        self.encoder_reader_bridge_sub = self.define_subscription(self.encoder_reader_bridge_tag, queue_size=None)
+        self.encoder_reader_bridge_queue = None
+
+        self.receive_times = {"brake": [], "enc": []}
+        # (receive time, set point) whenever the brake's set point changes
+        self.brake_setpoint_changes = []
+
+    def take(self):
+        self.brake_controller_bridge_queue = self.brake_controller_bridge_sub.get_queue()
+        self.encoder_reader_bridge_queue = self.encoder_reader_bridge_sub.get_queue()
+
+    async def loop(self):
+        while True:
+            while not self.brake_controller_bridge_queue.empty():
+                message = await self.brake_controller_bridge_queue.get()
+                receive_times = message_field(message, "brake", "receive_time")
+                self.receive_times["brake"].extend(receive_times)
+                for receive_time, set_point in zip(receive_times, message_field(message, "brake", "set_point")):
+                    if len(self.brake_setpoint_changes) == 0 or self.brake_setpoint_changes[-1][1] != set_point:
+                        self.brake_setpoint_changes.append((float(receive_time), float(set_point)))
+
+            while not self.encoder_reader_bridge_queue.empty():
+                message = await self.encoder_reader_bridge_queue.get()
+                self.receive_times["enc"].extend(message_field(message, "enc", "receive_time"))
+
+            await asyncio.sleep(0.05)
+
+    def rate_summary(self, name):
+        times = self.receive_times[name]
+        if len(times) < 2:
+            return "%-6s %d packets" % (name, len(times))
+        intervals = np.diff(times)
+        return "%-6s %7d packets, %7.2f Hz, interval p50/p99/max: %7.2f/%7.2f/%7.2fms" % (
+            name, len(times), (len(times) - 1) / (times[-1] - times[0]),
+            np.percentile(intervals, 50) * 1000.0,
+            np.percentile(intervals, 99) * 1000.0,
+            np.max(intervals) * 1000.0,
+        )
+
+    def brake_command_lateness(self, brake_schedule, window, tolerance_mA=0.05):
+        """Match each scheduled brake command to the first set point change reporting it within the window.
+        The brake reports at 10 Hz, so these are only accurate to the packet interval."""
+        lateness = []
+        change_index = 0
+        for scheduled_time, current_mA in brake_schedule:
+            while change_index < len(self.brake_setpoint_changes) and \
+                    self.brake_setpoint_changes[change_index][0] < scheduled_time:
+                change_index += 1
+
+            # a command that repeats the previous set point won't show up as a change
+            for receive_time, set_point in self.brake_setpoint_changes[change_index:]:
+                if receive_time - scheduled_time > window:
+                    break
+                if abs(set_point - current_mA) <= tolerance_mA:
+                    lateness.append(receive_time - scheduled_time)
+                    break
+        return lateness
+
+
+def lateness_summary(name, lateness):
+    if len(lateness) == 0:
+        return "%-6s no commands matched" % name
+    return "%-6s %5d commands, late by p50/p99/max: %7.2f/%7.2f/%7.2fms (min %0.2fms)" % (
+        name, len(lateness),
+        np.percentile(lateness, 50) * 1000.0,
+        np.percentile(lateness, 99) * 1000.0,
+        max(lateness) * 1000.0, min(lateness) * 1000.0,
+    )
+
+
+def profile_edge_lateness(brake_profile, profile_edges):
+    """How late the brake applied each profile step by its own clock"""
+    offsets = brake_profile.quantized().offsets
+    return [edge_ms / 1000.0 - offsets[int(index)] for receive_time, index, edge_ms, set_point in profile_edges]
+
+
+class HeadlessOrchestrator(Orchestrator):
+    """Runs every experiment profile back to back with only the bridges and the experiment node on the event loop.
+    No Tk update loop or plotting to compete with the command timing."""
+
+    rig = default_rig
+    profiles_path = "experiment_profiles.json"
+    # run these instead of the ones in profiles_path. experiment_queue.py sets it to one profile per process
+    queued_profiles = None
+
+    # time between profiles for the motor to spin down
+    rest_duration = 5.0
+
+    def __init__(self, event_loop):
+        self.set_default(write=False)
+        super(HeadlessOrchestrator, self).__init__(event_loop, return_when=asyncio.FIRST_COMPLETED)
+
+        rig = self.rig
+        if self.queued_profiles is not None:
+            self.profiles = list(self.queued_profiles)
+        else:
+            self.profiles = load_experiment_profiles(self.profiles_path)
+        if len(self.profiles) == 0:
+            raise ValueError("%s doesn't contain any experiment profiles" % self.profiles_path)
+        first = self.profiles[0]
+
+        factory = DeviceFactory()
+        self.motor = MotorControllerBridge(enabled=True, device_path=rig.motor_device_path)
+        self.brake = BrakeControllerBridge(factory, enable_reporting=False, arduino_name=rig.brake_arduino_name,
+                                           block_mode=rig.enable_block_mode)
+        self.encoders = EncoderReaderBridge(factory, enable_reporting=False, arduino_name=rig.encoder_arduino_name,
+                                            block_mode=rig.enable_block_mode)
+        self.experiment = ExperimentNode(first.step_duration, first.num_steps, first.min_current_mA,
+                                         first.torque_table_path, first.max_current_mA, enabled=True,
+                                         motor_speed=first.motor_speed, use_brake_profile=rig.use_brake_profile)
+        self.rates = PacketRateMonitor()
+
+        self.subscribe(self.brake, self.experiment, self.experiment.brake_controller_bridge_tag)
+        self.subscribe(self.motor, self.experiment, self.experiment.motor_controller_bridge_tag)
+        self.subscribe(self.encoders, self.experiment, self.experiment.encoder_reader_bridge_tag)
+        self.subscribe(self.brake, self.rates, self.rates.brake_controller_bridge_tag)
+        self.subscribe(self.encoders, self.rates, self.rates.encoder_reader_bridge_tag)
+
+        self.brake_schedules = []
+        self.profile_edge_lateness = []
+        self.waveform_lateness = []
+        self.t0 = 0.0
+
+        factory.init()
+
+    async def setup(self):
+        self.t0 = time.time()
+
+    async def loop(self):
+        for index, profile in enumerate(self.profiles):
+            if index > 0:
+                await asyncio.sleep(self.rest_duration)
+                self.experiment.configure(profile.step_duration, profile.num_steps, profile.min_current_mA,
+                                          profile.torque_table_path, profile.max_current_mA, profile.motor_speed)
+
+            self.experiment.adaptive_stepping = profile.adaptive_stepping
+            self.experiment.min_dwell = profile.min_dwell
+            self.experiment.max_dwell = profile.max_dwell
+            if profile.waveform is not None:
+                self.experiment.waveform = build_waveform(
+                    self.experiment.torque_table, profile.waveform, self.experiment.min_torque_forcing,
+                    self.experiment.max_torque_forcing, profile.motor_speed
+                )
+            else:
+                self.experiment.waveform = None
+            self.experiment.waveform_task = None
+
+            print("Running profile %s of %s: '%s'" % (index + 1, len(self.profiles), profile.name))
+            profile_start = time.time()
+            self.experiment.run_experiment()
+            await self.experiment.wait_for_experiment()
+            print("Profile '%s' finished in %0.1fs" % (profile.name, time.time() - profile_start))
+
+            if self.experiment.waveform is not None:
+                self.waveform_lateness.extend(self.experiment.waveform_lateness)
+            else:
+                self.brake_schedules.append((self.experiment.brake_schedule,
+                                             self.experiment.experiment_step_duration))
+            if self.experiment.is_using_brake_profile():
+                self.profile_edge_lateness.extend(profile_edge_lateness(
+                    self.experiment.brake_profile, self.brake.profile_edges
+                ))
+
+        # let the last packets reach the rate monitor
+        await asyncio.sleep(0.5)
+
+    async def teardown(self):
+        brake_lateness = []
+        for brake_schedule, step_duration in self.brake_schedules:
+            brake_lateness.extend(self.rates.brake_command_lateness(brake_schedule, step_duration))
+
+        report = "Ran %s profiles in %0.1fs\n" \
+                 "Packet rates:\n\t%s\n\t%s\n" \
+                 "Schedule jitter:\n\t%s\n\t%s\n\t%s\n\t%s" % (
+                     len(self.profiles), time.time() - self.t0,
+                     self.rates.rate_summary("brake"), self.rates.rate_summary("enc"),
+                     lateness_summary("motor", self.motor.command_lateness),
+                     lateness_summary("brake", brake_lateness),
+                     lateness_summary("edges", self.profile_edge_lateness),
+                     lateness_summary("waveform", self.waveform_lateness),
+                 )
+        print(report)
+
+
+def main():
+    if len(sys.argv) > 1:
+        HeadlessOrchestrator.profiles_path = sys.argv[1]
+    run(HeadlessOrchestrator)
+
+
+if __name__ == "__main__":
+    main()
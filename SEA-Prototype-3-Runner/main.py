@@ -1,42 +1,128 @@
 from arduino_factory import DeviceFactory
 from atlasbuggy import Orchestrator, run
 
-from gui.data_plotter import DataPlotter
-from gui.control_ui import TkinterGUI
 from hardware import BrakeControllerBridge, MotorControllerBridge, EncoderReaderBridge, ExperimentNode
+from hardware.rig_config import default_rig
 
 
 class ExperimentOrchestrator(Orchestrator):
+    # replaced per process by multi_rig.py so each rig gets its own devices
+    rig = default_rig
+    log_handler = None
+
     def __init__(self, event_loop):
         self.set_default(write=False)
         super(ExperimentOrchestrator, self).__init__(event_loop)
 
+        rig = self.rig
+
+        # gui, matplotlib and the profilers are only imported by the nodes that are enabled
+        if rig.enable_loop_monitor:
+            from diagnostics.loop_monitor import LoopMonitor
+            # installed before any node starts so slow setups are caught too
+            self.loop_monitor = LoopMonitor(stall_threshold=0.05)
+            self.loop_monitor.install()
+        else:
+            self.loop_monitor = None
+
+        if rig.enable_metrics:
+            from diagnostics.metrics import MetricsRegistry, MetricsNode
+            # scrape http://127.0.0.1:<rig.metrics_port>/metrics
+            self.metrics = MetricsRegistry()
+            self.metrics_node = MetricsNode(self.metrics, rig.metrics_port)
+        else:
+            self.metrics = None
+            self.metrics_node = None
+
+        if rig.enable_telemetry_bus:
+            from hardware.telemetry_bus import TelemetryBus
+            # consumers in other processes attach with TelemetryReader(rig.name, stream)
+            self.telemetry_bus = TelemetryBus(rig.name)
+        else:
+            self.telemetry_bus = None
 
         factory = DeviceFactory()
-        self.motor = MotorControllerBridge(enabled=True)
-        self.brake = BrakeControllerBridge(factory, enable_reporting=True)
-        self.encoders = EncoderReaderBridge(factory, enable_reporting=True)
+        self.motor = MotorControllerBridge(enabled=True, device_path=rig.motor_device_path, metrics=self.metrics)
+        self.brake = BrakeControllerBridge(factory, enable_reporting=rig.enable_reporting,
+                                           arduino_name=rig.brake_arduino_name, telemetry_bus=self.telemetry_bus,
+                                           block_mode=rig.enable_block_mode, metrics=self.metrics)
+        self.encoders = EncoderReaderBridge(factory, enable_reporting=rig.enable_reporting,
+                                            arduino_name=rig.encoder_arduino_name,
+                                            telemetry_bus=self.telemetry_bus, block_mode=rig.enable_block_mode,
+                                            metrics=self.metrics)
 
-        self.experiment = ExperimentNode(2.0, 50, 15.0, "brake_torque_data/B5Z Torque Table.csv", enabled=True)
+        self.experiment = ExperimentNode(rig.step_duration, rig.num_steps, rig.min_current_mA, rig.torque_table_path,
+                                         enabled=True, use_brake_profile=rig.use_brake_profile,
+                                         adaptive_stepping=rig.adaptive_stepping)
         # self.experiment = ExperimentNode(2.0, 50, 15.0, "brake_torque_data/B15 Torque Table.csv", enabled=True)
-        self.plot = DataPlotter(enabled=True)
-        self.ui = TkinterGUI("pickled/pid_constants.pkl")
 
         # self.add_nodes()
-        self.subscribe(self.brake, self.plot, self.plot.brake_controller_bridge_tag)
-        self.subscribe(self.encoders, self.plot, self.plot.encoder_reader_bridge_tag)
-        self.subscribe(self.brake, self.ui, self.ui.brake_controller_bridge_tag)
-        self.subscribe(self.motor, self.ui, self.ui.motor_controller_bridge_tag)
-        self.subscribe(self.experiment, self.ui, self.ui.experiment_tag)
         self.subscribe(self.brake, self.experiment, self.experiment.brake_controller_bridge_tag)
         self.subscribe(self.motor, self.experiment, self.experiment.motor_controller_bridge_tag)
         self.subscribe(self.encoders, self.experiment, self.experiment.encoder_reader_bridge_tag)
 
+        nodes = [self.motor, self.brake, self.encoders, self.experiment]
+
+        if rig.enable_encoder_filter:
+            from hardware.encoder_filter_node import EncoderFilterNode
+            self.encoder_filter = EncoderFilterNode(enabled=True)
+            self.subscribe(self.encoders, self.encoder_filter, self.encoder_filter.encoder_reader_bridge_tag)
+            nodes.append(self.encoder_filter)
+        else:
+            self.encoder_filter = None
+
+        if rig.enable_plotting:
+            from gui.data_plotter import DataPlotter
+            self.plot = DataPlotter(enabled=True, show_filtered=self.encoder_filter is not None)
+            self.subscribe(self.brake, self.plot, self.plot.brake_controller_bridge_tag)
+            if self.encoder_filter is not None:
+                self.subscribe(self.encoder_filter, self.plot, self.plot.encoder_reader_bridge_tag)
+            else:
+                self.subscribe(self.encoders, self.plot, self.plot.encoder_reader_bridge_tag)
+            nodes.append(self.plot)
+        else:
+            self.plot = None
+
+        if rig.enable_gui:
+            from gui.control_ui import TkinterGUI
+            self.ui = TkinterGUI(rig.pid_constants_path)
+            self.subscribe(self.brake, self.ui, self.ui.brake_controller_bridge_tag)
+            self.subscribe(self.motor, self.ui, self.ui.motor_controller_bridge_tag)
+            self.subscribe(self.experiment, self.ui, self.ui.experiment_tag)
+            if self.loop_monitor is not None:
+                self.subscribe(self.loop_monitor, self.ui, self.ui.loop_monitor_tag)
+            nodes.append(self.ui)
+        else:
+            self.ui = None
+
+        if self.loop_monitor is not None:
+            self.add_nodes(self.loop_monitor)
+            nodes.append(self.loop_monitor)
+
+        if self.metrics_node is not None:
+            self.metrics_node.watch_queues(*nodes)
+            self.add_nodes(self.metrics_node)
+            nodes.append(self.metrics_node)
+
+        if rig.compress_logs:
+            from data_processing.compressed_log import compress_file_handlers
+            for node in nodes:
+                compress_file_handlers(node.logger)
+
+        if self.log_handler is not None:
+            for node in nodes:
+                node.logger.addHandler(self.log_handler)
+
         factory.init()
 
+    async def teardown(self):
+        if self.telemetry_bus is not None:
+            self.telemetry_bus.close()
+
 
 def main():
     run(ExperimentOrchestrator)
 
 
-main()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+import os
+import time
+import queue
+import logging
+import traceback
+import multiprocessing
+from logging.handlers import QueueHandler, QueueListener
+
+from hardware.rig_config import make_rig
+
+
+class RigLogFilter(logging.Filter):
+    def __init__(self, rig_name):
+        super(RigLogFilter, self).__init__()
+        self.rig_name = rig_name
+
+    def filter(self, record):
+        record.rig = self.rig_name
+        return True
+
+
+def run_rig(rig, status_queue, log_queue):
+    """Worker process entry point. Each rig gets its own interpreter, event loop and devices"""
+    from atlasbuggy import run
+    from main import ExperimentOrchestrator
+
+    # resolve paths before moving into the rig's directory so logs from different rigs don't collide
+    rig = rig._replace(
+        torque_table_path=os.path.abspath(rig.torque_table_path),
+        pid_constants_path=os.path.abspath(rig.pid_constants_path),
+    )
+    rig_directory = os.path.join("rigs", rig.name)
+    if not os.path.isdir(rig_directory):
+        os.makedirs(rig_directory)
+    os.chdir(rig_directory)
+
+    log_handler = QueueHandler(log_queue)
+    log_handler.addFilter(RigLogFilter(rig.name))
+
+    ExperimentOrchestrator.rig = rig
+    ExperimentOrchestrator.log_handler = log_handler
+
+    status_queue.put((rig.name, "running", time.time(), os.getpid()))
+    try:
+        run(ExperimentOrchestrator)
+    except BaseException:
+        status_queue.put((rig.name, "error", time.time(), traceback.format_exc()))
+        raise
+    else:
+        status_queue.put((rig.name, "finished", time.time(), None))
+
+
+class RigCoordinator:
+    def __init__(self, rigs, log_path=None, report_interval=1.0):
+        names = [rig.name for rig in rigs]
+        if len(set(names)) != len(names):
+            raise ValueError("Rig names must be unique: %s" % names)
+
+        self.rigs = rigs
+        self.report_interval = report_interval
+
+        # spawn instead of fork so no rig inherits another's Tk, matplotlib or event loop state
+        self.context = multiprocessing.get_context("spawn")
+        self.status_queue = self.context.Queue()
+        self.log_queue = self.context.Queue()
+
+        self.processes = {}
+        self.statuses = {}
+        for rig in rigs:
+            self.statuses[rig.name] = ("waiting", time.time(), None)
+
+        formatter = logging.Formatter("[%(rig)s: %(name)s][%(levelname)s] %(asctime)s: %(message)s")
+        handlers = [logging.StreamHandler()]
+        if log_path is not None:
+            log_directory = os.path.split(log_path)[0]
+            if len(log_directory) > 0 and not os.path.isdir(log_directory):
+                os.makedirs(log_directory)
+            handlers.append(logging.FileHandler(log_path))
+        for handler in handlers:
+            handler.setFormatter(formatter)
+        self.log_listener = QueueListener(self.log_queue, *handlers, respect_handler_level=True)
+
+    def start(self):
+        self.log_listener.start()
+        for rig in self.rigs:
+            process = self.context.Process(
+                target=run_rig, args=(rig, self.status_queue, self.log_queue), name="rig-%s" % rig.name
+            )
+            process.start()
+            self.processes[rig.name] = process
+
+    def update_statuses(self):
+        while True:
+            try:
+                name, status, timestamp, info = self.status_queue.get_nowait()
+            except queue.Empty:
+                break
+            self.statuses[name] = (status, timestamp, info)
+            if status == "error":
+                print("Rig '%s' encountered an error:\n%s" % (name, info))
+
+        for name, process in self.processes.items():
+            status = self.statuses[name][0]
+            if not process.is_alive() and status in ("waiting", "running"):
+                self.statuses[name] = ("exited (%s)" % process.exitcode, time.time(), None)
+
+    def report(self):
+        print("Rig status:")
+        for name, (status, timestamp, info) in self.statuses.items():
+            print("\t%s: %s for %0.1fs" % (name, status, time.time() - timestamp))
+        print()
+
+    def any_alive(self):
+        return any(process.is_alive() for process in self.processes.values())
+
+    def run(self):
+        self.start()
+        try:
+            while self.any_alive():
+                time.sleep(self.report_interval)
+                self.update_statuses()
+                self.report()
+        except KeyboardInterrupt:
+            print("Stopping all rigs")
+            for process in self.processes.values():
+                process.terminate()
+        finally:
+            for process in self.processes.values():
+                process.join()
+            self.update_statuses()
+            self.report()
+            self.log_listener.stop()
+
+
+def main():
+    rigs = [
+        make_rig("rig_a"),
+        make_rig(
+            "rig_b",
+            motor_device_path="/dev/ttyACM0",
+            brake_arduino_name="brake_controller_2",
+            encoder_arduino_name="encoder_reader_2",
+            torque_table_path="brake_torque_data/B15 Torque Table.csv",
+            metrics_port=9108,
+            enable_plotting=False,
+        ),
+    ]
+    coordinator = RigCoordinator(rigs, log_path="logs/multi_rig/%s.log" % time.strftime("%Y_%b_%d-%H_%M_%S"))
+    coordinator.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+import time
+import asyncio
+from atlasbuggy import Orchestrator, run
+
+from data_processing.replay import ReplayEngine
+from gui.data_plotter import DataPlotter
+from hardware import ExperimentNode
+
+
+class ReplayOrchestrator(Orchestrator):
+    def __init__(self, event_loop):
+        self.set_default(write=False)
+        super(ReplayOrchestrator, self).__init__(event_loop, return_when=asyncio.FIRST_COMPLETED)
+
+        # 1.0 for real time, 10.0 for 10x, None to replay as fast as possible
+        speed = 10.0
+        enable_plotting = True
+
+        filename = "22_08_46.log"
+        directory = "2019_Mar_01"
+        torque_table_path = "brake_torque_data/B15 Torque Table.csv"
+
+        self.replay = ReplayEngine(filename, directory, speed=speed)
+        self.experiment = ExperimentNode(2.0, 50, 15.0, torque_table_path, enabled=True, clock=self.replay.clock)
+        self.plot = DataPlotter(enabled=enable_plotting)
+
+        self.add_nodes(self.replay)
+        self.subscribe(self.replay.brake, self.plot, self.plot.brake_controller_bridge_tag)
+        self.subscribe(self.replay.encoders, self.plot, self.plot.encoder_reader_bridge_tag)
+        self.subscribe(self.replay.brake, self.experiment, self.experiment.brake_controller_bridge_tag)
+        self.subscribe(self.replay.motor, self.experiment, self.experiment.motor_controller_bridge_tag)
+        self.subscribe(self.replay.encoders, self.experiment, self.experiment.encoder_reader_bridge_tag)
+
+        self.t0 = 0.0
+
+    async def setup(self):
+        self.t0 = time.time()
+
+    async def loop(self):
+        await self.replay.exit_event.wait()
+
+    async def teardown(self):
+        print("took: %ss" % (time.time() - self.t0))
+
+
+if __name__ == "__main__":
+    run(ReplayOrchestrator)
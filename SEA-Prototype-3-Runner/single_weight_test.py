@@ -1,6 +1,7 @@
 from data_processing.experiment_helpers.single_weight_helpers import *
 from data_processing.experiment_helpers.k_calculator_helpers import compute_linear_regression
 from data_processing.experiment_helpers.plot_helpers import *
+import matplotlib.pyplot as plt
 
 
 def run_single_weight_tests():